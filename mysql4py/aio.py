@@ -0,0 +1,562 @@
+"""asyncio connection and cursor
+
+Each `Connection` is an asyncio protocol that feeds the bytes it receives
+to the sans-IO `engine.Engine`, so the parsing, the message classes and
+the row decoders are those of the blocking driver, and one event loop can
+drive thousands of connections.  Methods talking to the server return
+futures to await; ``async for`` iterates over the rows of a cursor.
+
+Rows are buffered as they arrive.  Reading from the server pauses while
+a resultset has ROW_BUFFER_SIZE unread rows.  A connection runs one
+command at a time: a command issued while the previous one still has
+unread results is sent once those results are discarded.  Use one
+connection per concurrent task.
+
+This module has no async syntax so it can be imported everywhere, but it
+needs asyncio (Python 3.5+) to connect.  Not supported: SSL, the
+compressed protocol and prepared statements.  LOAD DATA LOCAL INFILE
+requests are refused unless the file is allowed on the connection's
+engine (see `engine.Engine.local_infile_reply`).
+"""
+
+from collections import deque
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+import errors
+from conversions import row_decoder
+from dbapi import DEFAULT_SOCKET_PATH, paramstyle
+from engine import Engine, ResultHeader, Row, OldPasswordRequest, \
+                   LocalInfileRequest
+from paramstyle import paramstyles as _paramstyles
+from protocol import Handshake, EOF, Field, STATE_READY, STATE_DATA
+
+# unread rows buffered per resultset before reading from the server pauses
+ROW_BUFFER_SIZE = 1000
+
+if asyncio is not None:
+    _BaseProtocol = asyncio.Protocol
+else:
+    _BaseProtocol = object
+
+def _then(loop, future, callback):
+    """Return a future for ``callback(result)`` once ``future`` is done
+
+    Exceptions and cancellation are passed on to the returned future.
+    """
+    chained = loop.create_future()
+    def done(future):
+        if chained.done():
+            return
+        if future.cancelled():
+            chained.cancel()
+        elif future.exception() is not None:
+            chained.set_exception(future.exception())
+        else:
+            try:
+                chained.set_result(callback(future.result()))
+            except Exception, exc:
+                chained.set_exception(exc)
+    future.add_done_callback(done)
+    return chained
+
+def connect(user=None, passwd=None,
+            db=None,
+            host='localhost', port=3306,
+            unix_socket=None,
+            charset='utf8',
+            loop=None):
+    """Open and authenticate a `Connection`
+
+    :returns: future for the connection
+    :raises: errors.NotSupportedError without asyncio
+    """
+    if asyncio is None:
+        raise errors.NotSupportedError(-1, "asyncio is not available")
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if host == 'localhost' and not unix_socket:
+        unix_socket = DEFAULT_SOCKET_PATH
+    connection = Connection(loop, charset)
+    connected = connection._start(user, passwd, db)
+    if unix_socket:
+        opening = loop.create_unix_connection(lambda: connection, unix_socket)
+        error = errors.OperationalError(2002, "Can't connect to local MySQL "
+                                              "server through socket %s" %
+                                              unix_socket)
+    else:
+        opening = loop.create_connection(lambda: connection, host, port)
+        error = errors.OperationalError(2003, "Can't connect to MySQL server "
+                                              "on %s" % host)
+
+    def opened(opening):
+        if connected.done():
+            return
+        if opening.cancelled():
+            connected.cancel()
+        elif opening.exception() is not None:
+            connected.set_exception(error)
+
+    def finished(connected):
+        if connected.cancelled() and connection.transport is not None:
+            connection.transport.close()
+
+    loop.create_task(opening).add_done_callback(opened)
+    connected.add_done_callback(finished)
+    return connected
+
+class Connection(_BaseProtocol):
+    """asyncio counterpart of `dbapi.Connection`; see `connect`"""
+    Error = errors.Error
+    Warning = errors.Warning
+    InterfaceError = errors.InterfaceError
+    DatabaseError = errors.DatabaseError
+    InternalError = errors.InternalError
+    OperationalError = errors.OperationalError
+    ProgrammingError = errors.ProgrammingError
+    IntegrityError = errors.IntegrityError
+    DataError = errors.DataError
+    NotSupportedError = errors.NotSupportedError
+
+    def __init__(self, loop, charset='utf8'):
+        self.loop = loop
+        self.charset = charset
+        self.engine = Engine(charset=charset, row_decoder=row_decoder)
+        self.transport = None
+        self.info = None
+        # (user, password, schema) while authenticating
+        self._credentials = None
+        # future for the connection while it is set up, see `connect`
+        self._connecting = None
+        # results of the current command not handed out yet, and the
+        # future waiting for the next one
+        self._results = deque()
+        self._waiter = None
+        # resultset whose rows are being received
+        self._active = None
+        # commands waiting for the current one to complete, as
+        # (function returning the bytes to send, future) pairs
+        self._commands = deque()
+        self._closed = loop.create_future()
+
+    def _start(self, user, password, schema):
+        """Authenticate once the server handshake arrives
+
+        :returns: future for the connection, once autocommit is off
+        """
+        self._credentials = (user, password, schema)
+        self._connecting = self.loop.create_future()
+        return self._connecting
+
+    # asyncio protocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.engine.receive_data(data)
+        try:
+            for event in self.engine.events():
+                self._on_event(event)
+        except errors.Error, exc:
+            self._fail(exc)
+            self.transport.close()
+            return
+        self._wake()
+        self._send_next()
+
+    def connection_lost(self, exc):
+        self._fail(errors.OperationalError(2013, "Lost connection to MySQL "
+                                                 "server during query"))
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    # engine events
+    def _on_event(self, event):
+        if self._connecting is not None:
+            self._on_connect_event(event)
+        elif isinstance(event, Row):
+            self._active.add_row(event.values)
+        elif isinstance(event, Field):
+            self._active.fields.append(event)
+        elif isinstance(event, ResultHeader):
+            self._active = AsyncResultSet(self)
+        elif isinstance(event, EOF):
+            if self.engine.state == STATE_DATA:
+                # end of the field definitions
+                self._results.append(self._active)
+            else:
+                self._active.finish()
+                self._active = None
+        elif isinstance(event, LocalInfileRequest):
+            # refused unless allowed on the engine; the error then arrives
+            # in place of the server's reply
+            self.transport.write(self.engine.local_infile_reply(event))
+        elif isinstance(event, errors.Error) and self._active is not None:
+            # the resultset was cut short
+            self._active.fail(event)
+            self._active = None
+        else:
+            # OK message or server error
+            self._results.append(event)
+
+    def _on_connect_event(self, event):
+        if isinstance(event, errors.Error):
+            self._fail(event)
+            self.transport.close()
+        elif isinstance(event, Handshake):
+            self.info = event
+            self.transport.write(self.engine.authenticate(*self._credentials))
+        elif isinstance(event, OldPasswordRequest):
+            # fallback to 3.23 style crypt() passwords
+            self.transport.write(
+                self.engine.old_password(self._credentials[1]))
+        elif self._credentials is not None:
+            self._credentials = None
+            # autocommit is off initially per dbapi spec, as in
+            # dbapi.Connection
+            self.transport.write(self.engine.query('SET autocommit=0'))
+        else:
+            connecting, self._connecting = self._connecting, None
+            if not connecting.done():
+                connecting.set_result(self)
+
+    def _wake(self):
+        """Hand the next result to the future waiting for it"""
+        waiter = self._waiter
+        if waiter is None:
+            return
+        if waiter.done():
+            # cancelled
+            self._waiter = None
+        elif self._results:
+            self._waiter = None
+            result = self._results.popleft()
+            if isinstance(result, Exception):
+                waiter.set_exception(result)
+            else:
+                waiter.set_result(result)
+        elif self.engine.state == STATE_READY and self._active is None:
+            self._waiter = None
+            waiter.set_result(None)
+
+    def _send_next(self):
+        """Send the next queued command once the current one is complete
+
+        Unread results of the current command are discarded.
+        """
+        if not self._commands or self._connecting is not None:
+            return
+        if self._active is not None:
+            self._active.discard()
+        if self.engine.state != STATE_READY or self._active is not None:
+            return
+        self._results.clear()
+        command, future = self._commands.popleft()
+        self._waiter = future
+        self.transport.write(command())
+
+    def _fail(self, exc):
+        """Fail every pending future with ``exc``"""
+        futures = [self._waiter, self._connecting]
+        futures.extend([future for command, future in self._commands])
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(exc)
+        self._waiter = self._connecting = None
+        self._commands.clear()
+        if self._active is not None:
+            self._active.fail(exc)
+            self._active = None
+
+    def _command(self, command):
+        """Queue a command; ``command()`` returns the bytes to send
+
+        :returns: future for the first result of the command
+        """
+        future = self.loop.create_future()
+        if self.transport is None or self.transport.is_closing():
+            future.set_exception(errors.InterfaceError(-1, "connection is "
+                                                           "closed"))
+            return future
+        self._commands.append((command, future))
+        self._send_next()
+        return future
+
+    def next_result(self):
+        """Read the next result of the last command
+
+        Unread rows of the current resultset are discarded.
+
+        :returns: future for an `OK` message, an `AsyncResultSet`, or None
+                  after the last result
+        """
+        if self._waiter is not None:
+            raise errors.InterfaceError(-1, "Already waiting for a result")
+        if self._active is not None:
+            self._active.discard()
+        waiter = self._waiter = self.loop.create_future()
+        self._wake()
+        return waiter
+
+    def query(self, sql):
+        """Send a query
+
+        :returns: future for its first result, see `next_result`
+        """
+        return self._command(lambda: self.engine.query(sql))
+
+    def ping(self):
+        """Check the connection to the server; returns a future for True"""
+        return _then(self.loop, self._command(self.engine.ping),
+                     lambda result: True)
+
+    def commit(self):
+        """Commit any open transactions"""
+        return _then(self.loop, self.query('COMMIT'), lambda result: None)
+
+    def rollback(self):
+        """Rollback any open transactions"""
+        return _then(self.loop, self.query('ROLLBACK'), lambda result: None)
+
+    def cursor(self):
+        return Cursor(self)
+
+    def close(self):
+        """Close this connection
+
+        :returns: future resolved once the connection is closed
+        """
+        transport = self.transport
+        if transport is not None and not transport.is_closing():
+            if self.engine.state == STATE_READY and self._active is None:
+                transport.write(self.engine.quit())
+            transport.close()
+        return self._closed
+
+class AsyncResultSet(object):
+    """Rows of a resultset, buffered as they arrive from the server"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.fields = []
+        self.rows = deque()
+        self.done = False
+        # server error that cut the resultset short
+        self.error = None
+        # whether rows are dropped as they arrive
+        self.discarding = False
+        # whether reading from the server is paused
+        self.paused = False
+        # futures waiting for rows or the end of the resultset
+        self._waiters = []
+
+    # called by the connection
+    def add_row(self, row):
+        if self.discarding:
+            return
+        self.rows.append(row)
+        if len(self.rows) >= ROW_BUFFER_SIZE and not self.paused:
+            self.paused = True
+            self.connection.transport.pause_reading()
+        self._wake()
+
+    def finish(self):
+        self.done = True
+        self._resume()
+        self._wake()
+
+    def fail(self, exc):
+        self.error = exc
+        self.finish()
+
+    def discard(self):
+        """Drop the unread rows and those still to arrive"""
+        self.discarding = True
+        self.rows.clear()
+        self._resume()
+        self._wake()
+
+    def _resume(self):
+        if self.paused:
+            self.paused = False
+            transport = self.connection.transport
+            if not transport.is_closing():
+                transport.resume_reading()
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _fetch(self, future, rows, size):
+        if future.done():
+            # cancelled
+            return
+        while self.rows and (size is None or len(rows) < size):
+            rows.append(self.rows.popleft())
+        if self.paused and len(self.rows) < ROW_BUFFER_SIZE // 2:
+            self._resume()
+        if size is not None and len(rows) == size:
+            future.set_result(rows)
+        elif self.error is not None:
+            future.set_exception(self.error)
+        elif self.done or self.discarding:
+            future.set_result(rows)
+        else:
+            waiter = self.connection.loop.create_future()
+            waiter.add_done_callback(
+                lambda waiter: self._fetch(future, rows, size))
+            self._waiters.append(waiter)
+
+    def fetchmany(self, size=None):
+        """Read up to ``size`` rows (all remaining rows if size is None)
+
+        :returns: future for the list of rows
+        """
+        future = self.connection.loop.create_future()
+        self._fetch(future, [], size)
+        return future
+
+    def next_row(self):
+        """Read the next row; returns a future for the row, or None after
+        the last one"""
+        return _then(self.connection.loop, self.fetchmany(1), _first_row)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return _then(self.connection.loop, self.fetchmany(1), _next_row)
+
+def _first_row(rows):
+    if rows:
+        return rows[0]
+    return None
+
+def _next_row(rows):
+    if not rows:
+        raise StopAsyncIteration
+    return rows[0]
+
+class Cursor(object):
+    """asyncio counterpart of `dbapi.Cursor`
+
+    Methods talking to the server return futures.  Rows are read from the
+    server as they are fetched; use ``async for`` to iterate over them.
+    """
+    rowcount = -1
+    description = None
+    arraysize = 1
+    lastrowid = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._result = None
+
+    def execute(self, operation, params=()):
+        """Execute a database operation (query or command)
+
+        :returns: future for the cursor
+        """
+        sql = _paramstyles[paramstyle].format(operation, *params or ())
+        return _then(self.connection.loop, self.connection.query(sql),
+                     self._executed)
+
+    def _executed(self, result):
+        self._set_result(result)
+        return self
+
+    def executemany(self, operation, seq_of_params):
+        """Execute the operation with each parameter sequence in turn,
+        stopping at the first error
+
+        :returns: future resolved once all of them are executed
+        """
+        future = self.connection.loop.create_future()
+        self._execute_each(future, operation, iter(seq_of_params), 0)
+        return future
+
+    def _execute_each(self, future, operation, seq_of_params, rowcount):
+        if future.done():
+            # cancelled
+            return
+        try:
+            params = seq_of_params.next()
+        except StopIteration:
+            self.rowcount = rowcount
+            future.set_result(None)
+            return
+        try:
+            executed = self.execute(operation, params)
+        except Exception, exc:
+            future.set_exception(exc)
+            return
+
+        def done(executed):
+            if executed.cancelled():
+                future.cancel()
+            elif executed.exception() is not None:
+                future.set_exception(executed.exception())
+            else:
+                self._execute_each(future, operation, seq_of_params,
+                                   rowcount + self.rowcount)
+        executed.add_done_callback(done)
+
+    def _set_result(self, result):
+        if isinstance(result, AsyncResultSet):
+            self.description = [(field.column, None, None, None,
+                                 None, None, None)
+                                for field in result.fields]
+            self.rowcount = -1
+            self._result = result
+        else:
+            self.description = None
+            self.rowcount = result.affected_rows
+            self.lastrowid = result.insert_id
+            self._result = None
+
+    def _resultset(self):
+        if self._result is None:
+            raise errors.ProgrammingError(2053,
+                                          "Attempt to read a row while "
+                                          "there is no result set")
+        return self._result
+
+    def fetchone(self):
+        """Fetch the next row of the query result set"""
+        return self._resultset().next_row()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._resultset().fetchmany(size)
+
+    def fetchall(self):
+        return self._resultset().fetchmany()
+
+    def nextset(self):
+        """Skip to the next result of the last operation
+
+        :returns: future for True, or None if there are no more results
+        """
+        if self._result is not None:
+            self._result.discard()
+        return _then(self.connection.loop, self.connection.next_result(),
+                     self._next_result)
+
+    def _next_result(self, result):
+        if result is None:
+            return None
+        self._set_result(result)
+        return True
+
+    def close(self):
+        if self._result is not None:
+            self._result.discard()
+        self.connection = None
+
+    def __aiter__(self):
+        return self._resultset()
@@ -1,39 +1,150 @@
 import socket
 import errno
-from array import array
 from ssl import start_ssl
 
 class BufferedChannel(object):
-    BLOCK_SIZE = 4096
+    """Buffered reader/writer for a connected socket
 
-    def __init__(self, sock):
+    Incoming data is received directly into a preallocated buffer with
+    ``recv_into()`` and handed out as memoryview slices of that buffer, so
+    bytes are not copied between the socket and the packet decoders.
+    """
+    BUFFER_SIZE = 65536
+    # maximum number of buffers passed to a single sendmsg() call
+    IOV_MAX = 1024
+    # without sendmsg(), buffers up to this size are joined into one send()
+    # so that a packet header and its payload are not sent as separate
+    # segments
+    JOIN_THRESHOLD = 65536
+
+    def __init__(self, sock, buffer_size=None):
+        if buffer_size is None:
+            buffer_size = self.BUFFER_SIZE
         self.socket = sock
-        self.buf = array('B')
-        self.size = 0
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        # unread data lives in buf[start:end]
+        self.start = 0
+        self.end = 0
+        self._bind_recv()
+        # plain sockets can gather buffers with sendmsg() (python3.3+)
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+
+    def _bind_recv(self):
+        """Select the receive method for the current socket object"""
+        recv_into = getattr(self.socket, 'recv_into', None)
+        if recv_into is None:
+            # some SSL implementations (e.g. M2Crypto) only provide recv()
+            recv = self.socket.recv
+            def recv_into(view):
+                chunk = recv(len(view))
+                view[0:len(chunk)] = chunk
+                return len(chunk)
+        self._recv_into = recv_into
 
     def read(self, n_bytes):
-        buf = self.buf
-        size = self.size
+        """Read exactly ``n_bytes`` from the socket
 
-        if size < n_bytes:
-            recv = self.socket.recv
-            while size < n_bytes:
-                chunk = recv(4096)
-                if not chunk:
-                    raise socket.error("Socket EOF")
-                size += len(chunk)
-                buf.fromstring(chunk)
-
-        self.size = size - n_bytes
-        result = buf[0:n_bytes]
-        del buf[0:n_bytes]
-        return result
+        Returns a memoryview which is only valid until the next call to
+        read(); callers must decode or copy the data before reading again.
+        """
+        start = self.start
+        end = self.end
+        if end - start >= n_bytes:
+            self.start = start + n_bytes
+            return self.view[start:start + n_bytes]
+
+        capacity = len(self.buf)
+        if n_bytes > capacity:
+            return self._read_large(n_bytes)
+
+        view = self.view
+        if start + n_bytes > capacity:
+            # not enough room left at the tail; move the partial data to
+            # the front of the buffer
+            pending = end - start
+            self.buf[0:pending] = view[start:end].tobytes()
+            start, end = 0, pending
+
+        recv_into = self._recv_into
+        while end - start < n_bytes:
+            n = recv_into(view[end:capacity])
+            if not n:
+                raise socket.error("Socket EOF")
+            end += n
+
+        self.start = start + n_bytes
+        self.end = end
+        return view[start:start + n_bytes]
+
+    def _read_large(self, n_bytes):
+        """Read a payload larger than our buffer into a dedicated buffer"""
+        data = bytearray(n_bytes)
+        view = memoryview(data)
+        pending = self.end - self.start
+        view[0:pending] = self.view[self.start:self.end]
+        self.start = self.end = 0
+
+        recv_into = self._recv_into
+        while pending < n_bytes:
+            n = recv_into(view[pending:])
+            if not n:
+                raise socket.error("Socket EOF")
+            pending += n
+        return view
 
     def write(self, data):
-        while data:
-            n = self.socket.send(data)
-            data = data[n:]
-        return n
+        """Write all of ``data`` to the socket"""
+        data = memoryview(data)
+        send = self.socket.send
+        offset = 0
+        size = len(data)
+        while offset < size:
+            offset += send(data[offset:])
+        return size
+
+    def writev(self, buffers):
+        """Write a sequence of buffers to the socket
+
+        The buffers are gathered into as few sendmsg() calls as possible
+        without being joined first; partial sends only advance a view over
+        the current buffer.  Sockets without sendmsg() get the small
+        buffers joined, large ones are sent as they are.
+        """
+        sendmsg = self._sendmsg
+        if sendmsg is None:
+            threshold = self.JOIN_THRESHOLD
+            size = 0
+            pending = bytearray()
+            for buf in buffers:
+                if len(pending) + len(buf) > threshold:
+                    if pending:
+                        size += self.write(pending)
+                        pending = bytearray()
+                    if len(buf) >= threshold:
+                        size += self.write(buf)
+                        continue
+                pending += buf
+            if pending:
+                size += self.write(pending)
+            return size
+
+        buffers = [memoryview(buf) for buf in buffers if len(buf)]
+        size = 0
+        index = 0
+        iov_max = self.IOV_MAX
+        while index < len(buffers):
+            n = sendmsg(buffers[index:index + iov_max])
+            size += n
+            # skip past everything that was fully sent
+            while n:
+                remaining = len(buffers[index])
+                if n < remaining:
+                    buffers[index] = buffers[index][n:]
+                    break
+                n -= remaining
+                index += 1
+        return size
 
     def start_ssl(self, ssl_ca=None, ssl_key=None, ssl_cert=None, ssl_cipher=None):
         if start_ssl:
@@ -41,6 +152,9 @@ class BufferedChannel(object):
                                     ssl_ca=ssl_ca,
                                     ssl_client_key=ssl_key,
                                     ssl_client_cert=ssl_cert)
+            self._bind_recv()
+            # SSL sockets do not support sendmsg()
+            self._sendmsg = None
         else:
             raise IOError(errno.EOPNOTSUPP, "SSL not supported")
 
@@ -50,6 +164,9 @@ class BufferedChannel(object):
 
 def connect_tcp(host, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # requests are written whole; don't let Nagle's algorithm hold back
+    # their last segment waiting for a delayed ACK
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     sock.connect((host, port))
     return BufferedChannel(sock)
 
@@ -0,0 +1,131 @@
+"""Columnar accumulation of resultset rows
+
+Rather than building a tuple of python objects for every row, numeric
+columns are collected into an array.array and all other columns into a
+single byte buffer indexed by an array of offsets.  NULLs are tracked in a
+bitmap per column.
+"""
+
+from array import array
+
+import constants
+
+try:
+    array('q')
+    INT64, UINT64 = 'q', 'Q'
+except ValueError:
+    # python2 arrays have no 'q'; a C long is 64 bits on LP64 platforms
+    INT64, UINT64 = 'l', 'L'
+
+# (signed, unsigned) array typecodes for integer field types
+INTEGER_TYPECODES = {
+    constants.FIELD_TYPE_TINY       : ('b', 'B'),
+    constants.FIELD_TYPE_SHORT      : ('h', 'H'),
+    constants.FIELD_TYPE_INT24      : ('i', 'I'),
+    constants.FIELD_TYPE_LONG       : ('i', 'I'),
+    constants.FIELD_TYPE_LONGLONG   : (INT64, UINT64),
+    constants.FIELD_TYPE_YEAR       : ('H', 'H'),
+}
+
+# array typecodes for floating point field types
+FLOAT_TYPECODES = {
+    constants.FIELD_TYPE_FLOAT      : 'f',
+    constants.FIELD_TYPE_DOUBLE     : 'd',
+}
+
+class Column(object):
+    """Base class for the values of one resultset column
+
+    Bit ``i % 8`` of ``nulls[i // 8]`` is set when row ``i`` is NULL.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.nulls = bytearray()
+        self.length = 0
+        self.null_count = 0
+
+    def __len__(self):
+        return self.length
+
+    def is_null(self, index):
+        """Check whether the value in row ``index`` is NULL"""
+        return bool(self.nulls[index >> 3] & (1 << (index & 7)))
+
+    def append(self, value):
+        """Append the raw (text protocol) value of the next row"""
+        length = self.length
+        if not length & 7:
+            self.nulls.append(0)
+        if value is None:
+            self.nulls[length >> 3] |= 1 << (length & 7)
+            self.null_count += 1
+            self.append_null()
+        else:
+            self.append_value(value)
+        self.length = length + 1
+
+    def append_value(self, value):
+        raise NotImplementedError()
+
+    def append_null(self):
+        raise NotImplementedError()
+
+    def __getitem__(self, index):
+        raise NotImplementedError()
+
+class NumericColumn(Column):
+    """Integer or floating point column backed by an array.array
+
+    NULL rows hold 0 in ``values``.
+    """
+
+    def __init__(self, field, typecode, parse):
+        Column.__init__(self, field)
+        self.values = array(typecode)
+        self.parse = parse
+
+    def append_value(self, value):
+        self.values.append(self.parse(value))
+
+    def append_null(self):
+        self.values.append(0)
+
+    def __getitem__(self, index):
+        if self.is_null(index):
+            return None
+        return self.values[index]
+
+class BinaryColumn(Column):
+    """Column of byte strings stored back to back in one buffer
+
+    Row ``i`` is ``data[offsets[i]:offsets[i + 1]]``.
+    """
+
+    def __init__(self, field):
+        Column.__init__(self, field)
+        self.data = bytearray()
+        self.offsets = array(UINT64, [0])
+
+    def append_value(self, value):
+        self.data += value
+        self.offsets.append(len(self.data))
+
+    def append_null(self):
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, index):
+        if self.is_null(index):
+            return None
+        return bytes(self.data[self.offsets[index]:self.offsets[index + 1]])
+
+def make_column(field):
+    """Create the column container suited to ``field``'s type"""
+    if field.type_code in INTEGER_TYPECODES:
+        signed, unsigned = INTEGER_TYPECODES[field.type_code]
+        if field.flags & constants.UNSIGNED_FLAG:
+            return NumericColumn(field, unsigned, int)
+        return NumericColumn(field, signed, int)
+    elif field.type_code in FLOAT_TYPECODES:
+        return NumericColumn(field, FLOAT_TYPECODES[field.type_code], float)
+    return BinaryColumn(field)
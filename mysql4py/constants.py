@@ -17,6 +17,12 @@ CLIENT_RESERVED             = 16384
 CLIENT_SECURE_CONNECTION    = 32768
 CLIENT_MULTI_STATEMENTS     = 65536
 CLIENT_MULTI_RESULTS        = 131072
+CLIENT_PS_MULTI_RESULTS     = 1 << 18
+CLIENT_PLUGIN_AUTH          = 1 << 19
+CLIENT_CONNECT_ATTRS        = 1 << 20
+CLIENT_SESSION_TRACK        = 1 << 23
+CLIENT_DEPRECATE_EOF        = 1 << 24
+CLIENT_ZSTD_COMPRESSION_ALGORITHM = 1 << 26
 
 # command constants
 COM_QUIT                    = 0x01
@@ -43,6 +49,7 @@ COM_STMT_CLOSE              = 0x19
 COM_STMT_RESET              = 0x1a
 COM_SET_OPTION              = 0x1b
 COM_STMT_FETCH              = 0x1c
+COM_RESET_CONNECTION        = 0x1f
 
 # server status constants
 SERVER_STATUS_IN_TRANS              = 1
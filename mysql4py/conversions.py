@@ -1,4 +1,6 @@
+import codecs
 import datetime
+import inspect
 import time
 import re
 try:
@@ -9,7 +11,11 @@ except ImportError:
     # precision
     Decimal = float
 
+import struct
+
 import constants
+from util import unpack_int8, decode_lcb, encode_lcb
+from paramstyle import encode_timedelta
 
 to_string = unicode
 
@@ -28,10 +34,13 @@ def parse_date(value):
     return datetime.datetime(*date_parts)
 
 def parse_time(value):
-    value = value.encode('ascii')
+    value = value.decode('ascii')
     hours, minutes, seconds = [int(part) for part in value.split(':')]
     return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
 
+def to_decimal(value):
+    return Decimal(value.decode('ascii'))
+
 def to_set(value):
     return value.decode('ascii').split(',')
 
@@ -39,7 +48,7 @@ def raise_unsupported(value):
     raise ValueError("Unsupported type")
 
 TYPE_MAP = {
-    constants.FIELD_TYPE_DECIMAL        : Decimal,
+    constants.FIELD_TYPE_DECIMAL        : to_decimal,
     constants.FIELD_TYPE_TINY           : int,
     constants.FIELD_TYPE_SHORT          : int,
     constants.FIELD_TYPE_LONG           : int,
@@ -56,7 +65,7 @@ TYPE_MAP = {
     constants.FIELD_TYPE_NEWDATE        : parse_date,
     #constants.FIELD_TYPE_VARCHAR        : to_string,
     constants.FIELD_TYPE_BIT            : int,
-    constants.FIELD_TYPE_NEWDECIMAL     : Decimal,
+    constants.FIELD_TYPE_NEWDECIMAL     : to_decimal,
     #constants.FIELD_TYPE_ENUM           : to_string,
     constants.FIELD_TYPE_SET            : to_set,
     constants.FIELD_TYPE_TINY_BLOB      : to_bytes,
@@ -67,3 +76,385 @@ TYPE_MAP = {
     #constants.FIELD_TYPE_STRING         : to_string,
     constants.FIELD_TYPE_GEOMETRY       : raise_unsupported,
 }
+
+# Source for decoding one column of a text protocol row.  %(n)d is the
+# column number and %(expr)s the expression converting the column bytes
+# held in data[start:end]
+_COLUMN_SOURCE = """
+    first = int8(data, index)[0]
+    if first < 251:
+        start = index + 1
+        end = start + first
+        c%(n)d = %(expr)s
+        index = end
+    elif first == 251:
+        c%(n)d = None
+        index += 1
+    else:
+        size, start = decode_lcb(data, index)
+        end = start + size
+        c%(n)d = %(expr)s
+        index = end
+"""
+
+def row_decoder(fields, charset='utf8'):
+    """Build a function decoding text protocol rows for ``fields``
+
+    The returned function takes a row payload (a memoryview) and returns a
+    tuple of converted values.  Its source is generated once per resultset
+    with the column loop unrolled and the conversion for each column
+    inlined: binary columns are copied out of the payload, strings are
+    decoded straight from it and only the remaining types call a converter
+    from TYPE_MAP.
+    """
+    namespace = {
+        'int8'          : unpack_int8,
+        'decode_lcb'    : decode_lcb,
+    }
+    source = ['def decode_row(data):',
+              '    index = 0']
+    for n, field in enumerate(fields):
+        source.append(_COLUMN_SOURCE %
+                      dict(n=n, expr=_column_expr(namespace, n, field,
+                                                  charset)))
+    source.append('    if index > len(data):')
+    source.append('        raise IndexError("read past end of packet")')
+    source.append('    return (%s)' %
+                  ''.join(['c%d, ' % n for n in range(len(fields))]))
+    exec compile('\n'.join(source), '<row decoder>', 'exec') in namespace
+    return namespace['decode_row']
+
+def _column_expr(namespace, n, field, charset):
+    """Return the expression converting the length coded value of column
+    ``n`` held in data[start:end], adding what it needs to ``namespace``
+
+    Each value is copied out of the payload once, by the decoder or by
+    tobytes().
+    """
+    convert = TYPE_MAP.get(field.type_code, to_string)
+    if field.type_code not in TYPE_MAP:
+        namespace['decode_text'] = codecs.getdecoder(charset)
+        return 'decode_text(data[start:end])[0]'
+    elif convert is None or convert is to_bytes:
+        return 'data[start:end].tobytes()'
+    namespace['convert%d' % n] = convert
+    return 'convert%d(data[start:end].tobytes())' % n
+
+# struct formats for fixed width binary protocol values as
+# (signed format, unsigned format)
+BINARY_FORMATS = {
+    constants.FIELD_TYPE_TINY       : ('<b', '<B'),
+    constants.FIELD_TYPE_SHORT      : ('<h', '<H'),
+    constants.FIELD_TYPE_INT24      : ('<i', '<I'),
+    constants.FIELD_TYPE_LONG       : ('<i', '<I'),
+    constants.FIELD_TYPE_LONGLONG   : ('<q', '<Q'),
+    constants.FIELD_TYPE_YEAR       : ('<h', '<H'),
+    constants.FIELD_TYPE_FLOAT      : ('<f', '<f'),
+    constants.FIELD_TYPE_DOUBLE     : ('<d', '<d'),
+}
+
+_unpack_date = struct.Struct('<HBB').unpack_from
+_unpack_datetime = struct.Struct('<HBBBBB').unpack_from
+_unpack_datetime_us = struct.Struct('<HBBBBBI').unpack_from
+_unpack_time = struct.Struct('<BIBBB').unpack_from
+_unpack_time_us = struct.Struct('<BIBBBI').unpack_from
+
+def read_binary_datetime(raw, index):
+    """Read a binary protocol DATE/DATETIME/TIMESTAMP value at ``index``
+
+    Zero dates are returned as None.
+
+    :returns: tuple of (value, index past the value)
+    """
+    length = unpack_int8(raw, index)[0]
+    index += 1
+    if length == 4:
+        parts = _unpack_date(raw, index)
+    elif length == 7:
+        parts = _unpack_datetime(raw, index)
+    elif length == 11:
+        parts = _unpack_datetime_us(raw, index)
+    else:
+        return None, index + length
+    if not parts[0] and not parts[1] and not parts[2]:
+        return None, index + length
+    return datetime.datetime(*parts), index + length
+
+def read_binary_time(raw, index):
+    """Read a binary protocol TIME value at ``index`` as a timedelta
+
+    :returns: tuple of (value, index past the value)
+    """
+    length = unpack_int8(raw, index)[0]
+    index += 1
+    if length == 8:
+        negative, days, hours, minutes, seconds = _unpack_time(raw, index)
+        microseconds = 0
+    elif length == 12:
+        negative, days, hours, minutes, seconds, microseconds = \
+            _unpack_time_us(raw, index)
+    else:
+        return datetime.timedelta(), index + length
+    value = datetime.timedelta(days=days, hours=hours, minutes=minutes,
+                               seconds=seconds, microseconds=microseconds)
+    if negative:
+        value = -value
+    return value, index + length
+
+# Source for decoding one column of a binary protocol row.  %(byte)d and
+# %(mask)d locate the column's bit in the NULL bitmap, %(body)s reads the
+# value into c%(n)d and advances index
+_BINARY_COLUMN_SOURCE = """
+    if nulls[%(byte)d] & %(mask)d:
+        c%(n)d = None
+    else:
+%(body)s
+"""
+
+_BINARY_FIXED_SOURCE = """
+        c%(n)d = unpack%(n)d(data, index)[0]
+        index += %(size)d
+"""
+
+_BINARY_CALL_SOURCE = """
+        c%(n)d, index = %(reader)s(data, index)
+"""
+
+def _indent(source, prefix='    '):
+    return '\n'.join([line and prefix + line for line in source.split('\n')])
+
+def binary_row_decoder(fields, charset='utf8'):
+    """Build a function decoding binary protocol rows for ``fields``
+
+    Binary rows are sent in reply to COM_STMT_EXECUTE: a 0x00 header, a
+    NULL bitmap (offset by 2 bits) and the non-NULL values in their binary
+    encoding.  As with `row_decoder` the source is generated once per
+    resultset: integers and doubles are read with a precompiled struct per
+    column, dates and times are unpacked directly from the packet and only
+    length coded values (strings, decimals, ...) go through TYPE_MAP.
+    """
+    bitmap_size = (len(fields) + 7 + 2) // 8
+    namespace = {
+        'int8'          : unpack_int8,
+        'decode_lcb'    : decode_lcb,
+        'unpack_nulls'  : struct.Struct('<%dB' % bitmap_size).unpack_from,
+        'read_datetime' : read_binary_datetime,
+        'read_time'     : read_binary_time,
+    }
+    source = ['def decode_row(data):',
+              '    nulls = unpack_nulls(data, 1)',
+              '    index = %d' % (1 + bitmap_size)]
+    for n, field in enumerate(fields):
+        type_code = field.type_code
+        if type_code in BINARY_FORMATS:
+            signed, unsigned = BINARY_FORMATS[type_code]
+            if field.flags & constants.UNSIGNED_FLAG:
+                unpack = struct.Struct(unsigned)
+            else:
+                unpack = struct.Struct(signed)
+            namespace['unpack%d' % n] = unpack.unpack_from
+            body = _BINARY_FIXED_SOURCE % dict(n=n, size=unpack.size)
+        elif type_code in (constants.FIELD_TYPE_DATE,
+                           constants.FIELD_TYPE_NEWDATE,
+                           constants.FIELD_TYPE_DATETIME,
+                           constants.FIELD_TYPE_TIMESTAMP):
+            body = _BINARY_CALL_SOURCE % dict(n=n, reader='read_datetime')
+        elif type_code == constants.FIELD_TYPE_TIME:
+            body = _BINARY_CALL_SOURCE % dict(n=n, reader='read_time')
+        else:
+            # everything else is sent as a length coded string, as in the
+            # text protocol
+            expr = _column_expr(namespace, n, field, charset)
+            body = _indent(_COLUMN_SOURCE % dict(n=n, expr=expr))
+        bit = n + 2
+        source.append(_BINARY_COLUMN_SOURCE % dict(n=n,
+                                                   byte=bit >> 3,
+                                                   mask=1 << (bit & 7),
+                                                   body=body.rstrip('\n')))
+    source.append('    if index > len(data):')
+    source.append('        raise IndexError("read past end of packet")')
+    source.append('    return (%s)' %
+                  ''.join(['c%d, ' % n for n in range(len(fields))]))
+    exec compile('\n'.join(source), '<binary row decoder>', 'exec') \
+        in namespace
+    return namespace['decode_row']
+
+# parameter types sent to the server as binary data; as in
+# `paramstyle.encode_literal`, python 2 byte strings are text
+try:
+    BINARY_PARAM_TYPES = (bytearray, memoryview, buffer)
+except NameError:
+    # python 3
+    BINARY_PARAM_TYPES = (bytearray, memoryview)
+if bytes is not str:
+    BINARY_PARAM_TYPES += (bytes,)
+
+def encode_binary_param(value, charset='utf8'):
+    """Encode a parameter for COM_STMT_EXECUTE
+
+    Integers that do not fit in 64 bits are sent as DECIMAL strings.
+    As with the literals of the text protocol, strings are sent as
+    VAR_STRING, so they compare by collation, and BINARY_PARAM_TYPES as BLOB.
+
+    :returns: tuple of (field type, unsigned flag, encoded value)
+    :raises: TypeError for unsupported python types
+    """
+    if isinstance(value, (int, long)):
+        if -1 << 63 <= value < 1 << 63:
+            return constants.FIELD_TYPE_LONGLONG, 0, struct.pack('<q', value)
+        elif 0 < value < 1 << 64:
+            return constants.FIELD_TYPE_LONGLONG, 0x80, struct.pack('<Q', value)
+        # beyond 64 bits; the server converts (or rejects) it like a
+        # literal of the same value
+        value = str(value).encode('ascii')
+        return (constants.FIELD_TYPE_NEWDECIMAL, 0,
+                encode_lcb(len(value)) + value)
+    elif isinstance(value, float):
+        return constants.FIELD_TYPE_DOUBLE, 0, struct.pack('<d', value)
+    elif isinstance(value, unicode):
+        value = value.encode(charset)
+        return (constants.FIELD_TYPE_VAR_STRING, 0,
+                encode_lcb(len(value)) + value)
+    elif isinstance(value, BINARY_PARAM_TYPES):
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        else:
+            value = bytes(value)
+        return (constants.FIELD_TYPE_BLOB, 0, encode_lcb(len(value)) + value)
+    elif isinstance(value, str):
+        return (constants.FIELD_TYPE_VAR_STRING, 0,
+                encode_lcb(len(value)) + value)
+    elif isinstance(value, Decimal):
+        value = str(value).encode('ascii')
+        return (constants.FIELD_TYPE_NEWDECIMAL, 0,
+                encode_lcb(len(value)) + value)
+    elif isinstance(value, datetime.datetime):
+        return constants.FIELD_TYPE_DATETIME, 0, \
+               struct.pack('<BHBBBBBI', 11, value.year, value.month,
+                           value.day, value.hour, value.minute,
+                           value.second, value.microsecond)
+    elif isinstance(value, datetime.date):
+        return constants.FIELD_TYPE_DATE, 0, \
+               struct.pack('<BHBB', 4, value.year, value.month, value.day)
+    elif isinstance(value, datetime.timedelta):
+        negative = value < datetime.timedelta(0)
+        if negative:
+            value = -value
+        hours, seconds = divmod(value.seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        return constants.FIELD_TYPE_TIME, 0, \
+               struct.pack('<BBIBBBI', 12, negative, value.days, hours,
+                           minutes, seconds, value.microseconds)
+    elif isinstance(value, datetime.time):
+        return constants.FIELD_TYPE_TIME, 0, \
+               struct.pack('<BBIBBBI', 12, 0, 0, value.hour, value.minute,
+                           value.second, value.microsecond)
+    raise TypeError("Unsupported parameter type %r" % type(value))
+
+# backslash escapes of the characters that would end a field or line in
+# LOAD DATA INFILE's default format (FIELDS ESCAPED BY '\\')
+TSV_ESCAPES = {
+    '\0'    : '\\0',
+    '\t'    : '\\t',
+    '\n'    : '\\n',
+    '\r'    : '\\r',
+    '\\'    : '\\\\',
+}
+
+# unicode.translate() table built from TSV_ESCAPES
+TSV_ESCAPE_TABLE = dict([(ord(char), unicode(escaped))
+                         for char, escaped in TSV_ESCAPES.items()])
+
+_tsv_byte_escapes = dict([(char.encode('ascii'), escaped.encode('ascii'))
+                          for char, escaped in TSV_ESCAPES.items()])
+_tsv_escape_pattern = re.compile('[\\0\\t\\n\\r\\\\]'.encode('ascii'))
+
+def _tsv_escape_match(match):
+    return _tsv_byte_escapes[match.group()]
+
+TSV_NULL = '\\N'.encode('ascii')
+
+def encode_tsv_null(value, charset):
+    return TSV_NULL
+
+def encode_tsv_bool(value, charset):
+    return (value and '1' or '0').encode('ascii')
+
+def encode_tsv_number(value, charset):
+    return str(value).encode('ascii')
+
+def encode_tsv_float(value, charset):
+    return repr(value).encode('ascii')
+
+def encode_tsv_string(value, charset):
+    if isinstance(value, unicode):
+        return value.translate(TSV_ESCAPE_TABLE).encode(charset)
+    return _tsv_escape_pattern.sub(_tsv_escape_match, bytes(value))
+
+def encode_tsv_datetime(value, charset):
+    return value.isoformat(' ').encode('ascii')
+
+def encode_tsv_isoformat(value, charset):
+    return value.isoformat().encode('ascii')
+
+def encode_tsv_timedelta(value, charset):
+    # strip the quotes of the TIME literal
+    return encode_timedelta(value)[1:-1].encode('ascii')
+
+# LOAD DATA INFILE field encoders keyed by value type
+TSV_ENCODERS = {
+    type(None)          : encode_tsv_null,
+    bool                : encode_tsv_bool,
+    int                 : encode_tsv_number,
+    long                : encode_tsv_number,
+    float               : encode_tsv_float,
+    Decimal             : encode_tsv_number,
+    str                 : encode_tsv_string,
+    unicode             : encode_tsv_string,
+    bytes               : encode_tsv_string,
+    bytearray           : encode_tsv_string,
+    datetime.datetime   : encode_tsv_datetime,
+    datetime.date       : encode_tsv_isoformat,
+    datetime.time       : encode_tsv_isoformat,
+    datetime.timedelta  : encode_tsv_timedelta,
+}
+
+def encode_tsv_field(value, charset='utf8'):
+    """Encode a value as a LOAD DATA INFILE field
+
+    None is written as \\N.  Subclasses of the types in TSV_ENCODERS use
+    the encoder of their nearest base class.
+
+    :raises: TypeError for unsupported types
+    """
+    # inspect.getmro also handles python 2 old-style classes
+    for base in inspect.getmro(value.__class__):
+        if base in TSV_ENCODERS:
+            return TSV_ENCODERS[base](value, charset)
+    raise TypeError("Unsupported value type %r" % type(value))
+
+def tsv_chunks(rows, charset='utf8', chunk_size=1 << 20):
+    """Encode rows in the tab separated format LOAD DATA INFILE reads by
+    default
+
+    Rows are encoded as they are consumed.  Lines are yielded in chunks
+    of at most ``chunk_size`` bytes, unless a single line is longer.
+    """
+    tab = '\t'.encode('ascii')
+    newline = '\n'.encode('ascii')
+    empty = ''.encode('ascii')
+    encoders = TSV_ENCODERS
+    lines = []
+    size = 0
+    for row in rows:
+        line = tab.join([encoders.get(type(value), encode_tsv_field)(value,
+                                                                   charset)
+                         for value in row]) + newline
+        if lines and size + len(line) > chunk_size:
+            yield empty.join(lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield empty.join(lines)
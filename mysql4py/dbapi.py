@@ -1,11 +1,14 @@
 """DBAPI 2.0 interface"""
 import codecs
+import re
 
 import errors
+import numpy_support
 from channel import connect_unix, connect_tcp
-from protocol import Protocol
-from conversions import TYPE_MAP
-from paramstyle import paramstyles as _paramstyles
+from protocol import Protocol, LongData, LOCAL_INFILE_CHUNK_SIZE
+from conversions import row_decoder, tsv_chunks
+from paramstyle import paramstyles as _paramstyles, format_to_qmark, \
+                       quote_identifier
 from parser import OptionFile
 
 DEFAULT_OPTION_PATHS = ['/etc/mysql/my.cnf', '/etc/my.cnf', '~/.my.cnf']
@@ -15,6 +18,15 @@ apilevel = '2.0'
 threadsafety = 1
 paramstyle = 'format'
 
+# INSERT/REPLACE statements that executemany() sends as multi-row inserts:
+# (statement up to VALUES, the row's parenthesized placeholders, any
+# ON DUPLICATE KEY UPDATE clause)
+INSERT_VALUES = re.compile(r"""^(\s*(?:INSERT|REPLACE)\b.+?\bVALUES?\s*)"""
+                           r"""(\(\s*%s\s*(?:,\s*%s\s*)*\))"""
+                           r"""(\s*(?:ON\s+DUPLICATE\s+KEY\s+UPDATE\b.*?)?)"""
+                           r"""\s*;?\s*$""",
+                           re.IGNORECASE | re.DOTALL)
+
 class Connection(object):
     Error = errors.Error
     Warning = errors.Warning
@@ -37,6 +49,12 @@ class Connection(object):
                  ssl_key=None,
                  ssl_cert=None,
                  compress=False,
+                 compress_threshold=None,
+                 compress_level=None,
+                 compression_algorithms=None,
+                 zstd_compression_level=None,
+                 statement_cache_size=None,
+                 local_infile_paths=None,
                  charset='utf8',
                  read_default_group=None,
                  read_default_file=None):
@@ -57,13 +75,28 @@ class Connection(object):
             self._host_info = '%s via TCP/IP' % host
 
         self.protocol = Protocol(channel)
+        self.charset = charset
+        self._max_allowed_packet = None
+        # rows are converted to python types as they are decoded
+        self.protocol.row_decoder = row_decoder
+        if statement_cache_size is not None:
+            # the statement being executed always has to stay open
+            self.protocol.statements.capacity = max(statement_cache_size, 1)
+        if local_infile_paths is not None:
+            # files LOAD DATA LOCAL INFILE may read; see Cursor.bulk_load()
+            # for loading data from memory
+            self.protocol.local_infile_paths = tuple(local_infile_paths)
 
         if ssl:
                 self.protocol.enable_ssl(ssl_ca=ssl_ca,
                                          ssl_key=ssl_key,
                                          ssl_cert=ssl_cert)
         if compress:
-            self.protocol.enable_compression()
+            self.protocol.enable_compression(
+                threshold=compress_threshold,
+                level=compress_level,
+                algorithms=compression_algorithms,
+                zstd_level=zstd_compression_level)
 
         if read_default_file or read_default_group:
             if not read_default_group:
@@ -80,6 +113,14 @@ class Connection(object):
             db = auth_params.get('db')
 
         self.protocol.authenticate(user, passwd, db)
+        self.init_session()
+
+    def init_session(self):
+        """Set up a new session
+
+        Called once the connection is authenticated, and again by
+        `pool.ConnectionPool` after the session was reset.
+        """
         # toggle autocommit to off initially per dbapi spec
         self.autocommit()
 
@@ -98,6 +139,17 @@ class Connection(object):
     def ping(self):
         self.protocol.ping()
 
+    def max_allowed_packet(self):
+        """Return the server's max_allowed_packet
+
+        The value is queried once per connection.
+        """
+        if self._max_allowed_packet is None:
+            self.protocol.query('SELECT @@max_allowed_packet')
+            rows = self.protocol.nextset().fetchmany()
+            self._max_allowed_packet = int(rows[0][0])
+        return self._max_allowed_packet
+
     def thread_id(self):
         """Fetch the current thread if of the underlying connection"""
         return self.protocol.info.thread_id
@@ -123,9 +175,15 @@ class Connection(object):
         """
         return debug.capabilities(self.capabilities())
 
-    def cursor(self):
-        """Create a new cursor object to issue queries"""
-        return Cursor(self)
+    def cursor(self, cursorclass=None):
+        """Create a new cursor object to issue queries
+
+        :param cursorclass: cursor implementation to use; defaults to the
+                            unbuffered `Cursor`.  See `BufferedCursor`.
+        """
+        if cursorclass is None:
+            cursorclass = Cursor
+        return cursorclass(self)
 
     def close(self):
         """Close this connection
@@ -147,6 +205,8 @@ class Connection(object):
 class Cursor(object):
     rowcount = -1
     description = None
+    # default number of rows fetched by fetchmany()
+    arraysize = 1
 
     # Supported extension attributes
     rownumber = None
@@ -155,7 +215,9 @@ class Cursor(object):
     lastrowid = None
 
     def __init__(self, connection):
+        self.connection = connection
         self.protocol = connection.protocol
+        self._result = None
 
     def callproc(procname, parameters=None):
         """Call a stored database procedure with the given name. The sequence
@@ -185,30 +247,208 @@ class Cursor(object):
         self.nextset()
         return self
 
-    def executemany(operation, seq_of_params):
+    def executemany(self, operation, seq_of_params):
         """Prepare a database operation and then execute it against all
         parameter sequences or mappings found in the sequence seq_of_params
+
+        INSERT and REPLACE statements with a single VALUES row are sent as
+        multi-row statements, each as large as the server's
+        max_allowed_packet permits.  rowcount is the total number of
+        affected rows.
         """
+        match = INSERT_VALUES.match(operation)
+        if match is None or '%s' in match.group(3):
+            rowcount = 0
+            for params in seq_of_params:
+                self.execute(operation, params)
+                rowcount += self.rowcount
+            self.rowcount = rowcount
+            return
+
+        format_row = _paramstyles[paramstyle].format
+        # formatted without parameters so that escapes such as %% are
+        # handled as in execute()
+        prefix, suffix = format_row(match.group(1)), format_row(match.group(3))
+        values = match.group(2)
+        charset = self.connection.charset
+        # the COM_QUERY command byte is part of the packet
+        limit = self.connection.max_allowed_packet() - 1
+        base_size = len((prefix + suffix).encode(charset))
+        rowcount = 0
+        rows = []
+        size = base_size
         for params in seq_of_params:
-            self.execute(operation, params)
+            row = format_row(values, *params)
+            row_size = len(row.encode(charset)) + 1 # separating comma
+            if rows and size + row_size > limit:
+                self.protocol.query(prefix + ','.join(rows) + suffix)
+                self.nextset()
+                rowcount += self.rowcount
+                rows = []
+                size = base_size
+            rows.append(row)
+            size += row_size
+        if rows:
+            self.protocol.query(prefix + ','.join(rows) + suffix)
+            self.nextset()
+            rowcount += self.rowcount
+        self.rowcount = rowcount
+
+    def pipeline(self, operations):
+        """Execute several operations, sending them without waiting for
+        each one's response
+
+        ``operations`` is a sequence of SQL strings or (operation, params)
+        pairs.  All resultsets are read in full; the result of the last
+        operation becomes the cursor's current result.
+
+        :returns: list with the list of results of each operation
+        :raises: errors.PipelineError if any operation failed; its
+                 ``index`` is the position of the first failed operation
+
+        Extension to PEP249
+        """
+        format = _paramstyles[paramstyle].format
+        queries = []
+        for operation in operations:
+            if not isinstance(operation, basestring):
+                operation, params = operation
+                operation = format(operation, *params or ())
+            queries.append(operation)
+        results = self.protocol.pipeline(queries)
+        self.rowcount = -1
+        self.description = None
+        self._result = None
+        if results and results[-1]:
+            result = self._result = results[-1][-1]
+            if result:
+                self.description = self._fields_to_description(result.fields)
+                self.rowcount = len(result)
+            else:
+                self.rowcount = result.affected_rows
+        return results
+
+    def execute_batch(self, statements):
+        """Execute a sequence of statements as multi-statement queries
+
+        ``statements`` holds SQL strings or (operation, params) pairs.  They
+        are joined with ';' into as few queries as max_allowed_packet
+        permits.  Each statement must produce a single result, so CALL is
+        not supported.
+
+        :returns: list of `BatchResult`, one per statement in order
+        :raises: errors.BatchError for a failed statement; the following
+                 statements are not executed
+
+        Extension to PEP249
+        """
+        format = _paramstyles[paramstyle].format
+        charset = self.connection.charset
+        # the COM_QUERY command byte is part of the packet
+        limit = self.connection.max_allowed_packet() - 1
+        results = []
+        batch = []
+        size = 0
+        for statement in statements:
+            if not isinstance(statement, basestring):
+                operation, params = statement
+                statement = format(operation, *params or ())
+            statement = statement.rstrip().rstrip(';')
+            statement_size = len(statement.encode(charset)) + 1 # separator
+            if batch and size + statement_size > limit:
+                self._execute_batch(batch, results)
+                batch = []
+                size = 0
+            batch.append(statement)
+            size += statement_size
+        if batch:
+            self._execute_batch(batch, results)
+        return results
+
+    def _execute_batch(self, batch, results):
+        """Send ``batch`` as one multi-statement query and append the result
+        of each statement to ``results``"""
+        index = len(results)
+        self.protocol.query(';'.join(batch))
+        for offset in xrange(len(batch)):
+            try:
+                result = self.protocol.nextset()
+            except errors.DatabaseError, exc:
+                # nextset() left the protocol ready for the next command
+                raise errors.BatchError(index + offset, exc)
+            if result is None:
+                break
+            description = None
+            if result:
+                description = self._fields_to_description(result.fields)
+                result = result.store()
+            results.append(BatchResult(index + offset, result, description))
+        self.protocol.sync()
+
+    def bulk_load(self, table, rows, columns=None):
+        """Insert rows with LOAD DATA LOCAL INFILE
+
+        ``rows`` is an iterable of sequences, encoded as tab separated
+        values while they are sent (see `conversions.tsv_chunks`), so a
+        generator can load more rows than fit in memory.  ``table`` may be
+        qualified as 'schema.table'; ``columns`` names the table columns
+        the row values go to, by default all of them in table order.
+
+        Rows that cannot be encoded raise TypeError.  If that happens after
+        the first chunk of data was sent, the connection is closed so that
+        the server aborts the statement rather than load the rows sent so
+        far; tables of non-transactional engines such as MyISAM keep them.
+
+        :returns: the number of rows inserted
+
+        Extension to PEP249
+        """
+        protocol = self.protocol
+        name = 'bulk_load-%d' % id(rows)
+        sql = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s CHARACTER SET %s" % (
+            name,
+            '.'.join(['`%s`' % quote_identifier(name)
+                      for name in table.split('.')]),
+            protocol.charset.replace('-', ''))
+        if columns is not None:
+            sql += ' (%s)' % ', '.join(['`%s`' % quote_identifier(column)
+                                        for column in columns])
+        protocol.local_infile_sources[name] = tsv_chunks(
+                                                rows, protocol.charset,
+                                                LOCAL_INFILE_CHUNK_SIZE)
+        try:
+            protocol.query(sql)
+            self.nextset()
+        finally:
+            protocol.local_infile_sources.pop(name, None)
+        return self.rowcount
 
     #@staticmethod
     def _fields_to_description(fields):
         """Convert a list of protcol.Field instances into dbapiv2 compliant
         description tuples
         """
-        for field in fields:
-            if field.type_code in TYPE_MAP:
-                field.convert = TYPE_MAP[field.type_code]
-            else:
-                field.convert = lambda value: value.decode('utf8')
         return [(field.column, None, None, None, None, None, None)
                     for field in fields]
     _fields_to_description = staticmethod(_fields_to_description)
 
+    def _resultset(self):
+        """Return the current resultset
+
+        :raises: ProgrammingError if the last operation did not produce one
+        """
+        if not self._result:
+            raise errors.ProgrammingError(2053,
+                                          "Attempt to read a row while "
+                                          "there is no result set")
+        return self._result
+
     def fetchone(self):
         """Fetch the next row of the query result set"""
-        return iter(self).next()
+        rows = self._resultset().fetchmany(1)
+        if rows:
+            return rows[0]
+        return None
 
     def fetchmany(self, size=None):
         """Fetch the next set of rows of a query result, returning a sequence
@@ -219,17 +459,62 @@ class Cursor(object):
         it is not given, the cursor's arraysize determines the number of rows
         to be fetched.
         """
-        while size:
-            row = self.fetchone()
-            yield row
-            if row is None: break
-            size -= 1
+        if size is None:
+            size = self.arraysize
+        return self._resultset().fetchmany(size)
 
     def fetchall(self):
         """Fetch all remaining rows of a query result, returning them as a
         sequence of sequences.
         """
-        return iter(self)
+        return self._resultset().fetchmany()
+
+    def fetch_columns(self, size=None):
+        """Fetch the remaining rows (or at most ``size`` rows) of the current
+        resultset column-wise.
+
+        Returns a list of `columnar.Column` objects, one per column in
+        description order.  Numeric columns keep their values in an
+        array.array, other columns in a single byte buffer with offsets.
+
+        Extension to PEP249
+        """
+        return self._resultset().columns(size)
+
+    def fetch_numpy(self, batch_size=None, structured=False):
+        """Iterate over the remaining rows of the current resultset in
+        batches of NumPy arrays.
+
+        Each batch is a dict of arrays keyed by column name or, if
+        ``structured`` is true, a structured array.  dtypes follow the MySQL
+        field types; columns containing NULLs are returned as masked
+        arrays.  Requires numpy.
+
+        :raises: NotSupportedError if numpy is not installed and
+                 ProgrammingError if there is no resultset, when called
+                 rather than on first iteration
+
+        Extension to PEP249
+        """
+        if numpy_support.numpy is None:
+            raise errors.NotSupportedError(-1, "fetch_numpy() requires numpy")
+        result = self._resultset()
+        if batch_size is None:
+            batch_size = numpy_support.BATCH_SIZE
+        if structured:
+            convert = numpy_support.columns_to_records
+        else:
+            convert = numpy_support.columns_to_dict
+        return self._numpy_batches(result, batch_size, convert)
+
+    def _numpy_batches(self, result, batch_size, convert):
+        while True:
+            columns = result.columns(batch_size)
+            if not len(columns[0]):
+                break
+            yield convert(columns)
+            if len(columns[0]) < batch_size:
+                break
 
     def next(self):
         """Fetch the next available row from the cursor
@@ -241,6 +526,7 @@ class Cursor(object):
         row = self.fetchone()
         if row is None:
             raise StopIteration
+        return row
 
     def nextset(self):
         """This method will make the cursor skip to the next available set,
@@ -263,8 +549,11 @@ class Cursor(object):
     def scroll(self, value, mode='relative'):
         """Scroll the cursor in the result set to a new position according to
         mode
+
+        Only supported by `BufferedCursor`
         """
-        raise self.NotSupportedError("scroll() is currently not supported")
+        raise errors.NotSupportedError(-1, "scroll() is not supported by "
+                                           "unbuffered cursors")
 
     def setinputsizes(self, sizes):
         """Set sizes for input parameters.
@@ -279,7 +568,127 @@ class Cursor(object):
         """
 
     def __iter__(self):
-        for row in self._result:
-            yield [column is not None and field.convert(column) or None
-                   for column, field in zip(row, self._result.fields)]
+        return iter(self._result)
+
+class BatchResult(object):
+    """Outcome of one statement run by `Cursor.execute_batch`
+
+    ``rows`` is a `protocol.StoredResult` for statements returning a
+    resultset and None otherwise.
+    """
+    def __init__(self, index, result, description=None):
+        self.index = index
+        self.description = description
+        if result:
+            self.rows = result
+            self.rowcount = len(result)
+            self.insert_id = None
+        else:
+            self.rows = None
+            self.rowcount = result.affected_rows
+            self.insert_id = result.insert_id
+
+class BufferedCursor(Cursor):
+    """Cursor that reads each resultset completely when it is executed
+
+    Rows are kept undecoded in a single contiguous buffer (see
+    `protocol.StoredResult`) and decoded as they are fetched.  The
+    connection is free for other commands as soon as execute() returns,
+    rowcount is known for SELECTs and the cursor supports scroll() and
+    random access by row index.
+    """
 
+    def nextset(self):
+        """Skip to the next available set and read all of its rows
+
+        If there are no more sets, the method returns None
+        """
+        if Cursor.nextset(self) is None:
+            return None
+        if self._result:
+            self._result = self._result.store()
+            self.rowcount = len(self._result)
+        return True
+
+    #@property
+    def rownumber(self):
+        """Index of the next row to fetch in the current resultset"""
+        if not self._result:
+            return None
+        return self._result.position
+    rownumber = property(rownumber)
+
+    def scroll(self, value, mode='relative'):
+        """Scroll the cursor in the result set to a new position according to
+        mode
+
+        :raises: IndexError if the position would be outside the resultset
+        """
+        result = self._resultset()
+        if mode == 'relative':
+            value += result.position
+        elif mode != 'absolute':
+            raise errors.ProgrammingError(-1, "unknown scroll mode %r" % mode)
+        result.scroll(value)
+
+    def __getitem__(self, index):
+        """Return row ``index`` of the current resultset"""
+        return self._resultset()[index]
+
+    def __len__(self):
+        return len(self._resultset())
+
+class PreparedCursor(Cursor):
+    """Cursor executing each operation as a server side prepared statement
+
+    Parameters are sent in the binary protocol instead of being escaped into
+    the query text and result rows are decoded from the binary row format.
+    Statements are prepared once per connection and cached by their SQL
+    text (see ``statement_cache_size``), so repeated executions of the same
+    operation skip the prepare round trip.  File objects and `LongData`
+    iterables passed as parameters are streamed to the server in chunks.
+    """
+
+    def execute(self, operation, params=()):
+        """Prepare (or reuse) the operation and execute it with ``params``"""
+        statement = self.protocol.prepare(format_to_qmark(operation))
+        self.protocol.execute(statement, params or ())
+        self.nextset()
+        return self
+
+class ServerSideCursor(PreparedCursor):
+    """Prepared statement cursor whose resultsets stay on the server
+
+    Rows are requested with COM_STMT_FETCH in chunks of `fetch_size` rows,
+    so the client never holds more than one chunk of a resultset.  The
+    connection is free for other commands between fetches, which allows
+    several large resultsets to be consumed side by side on one
+    connection.  Each cursor uses its own statement handle, released when
+    the next operation is executed or the cursor is closed.
+    """
+    # number of rows requested per COM_STMT_FETCH
+    fetch_size = 1000
+
+    def __init__(self, connection):
+        PreparedCursor.__init__(self, connection)
+        self._statement = None
+
+    def execute(self, operation, params=()):
+        """Prepare the operation and execute it with a server side cursor"""
+        self._close_statement()
+        self._statement = self.protocol.prepare(format_to_qmark(operation),
+                                                cache=False)
+        self.protocol.execute(self._statement, params or (),
+                              fetch_size=self.fetch_size)
+        self.nextset()
+        return self
+
+    def close(self):
+        """Close the cursor and its server side statement"""
+        self._close_statement()
+        PreparedCursor.close(self)
+
+    def _close_statement(self):
+        if self._statement is not None:
+            self.protocol.close_statement(self._statement)
+            self._statement = None
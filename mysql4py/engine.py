@@ -0,0 +1,328 @@
+"""Sans-IO MySQL protocol engine
+
+`Engine` performs no I/O.  Bytes received from the server are handed to
+receive_data() and the engine turns them into events; commands return the
+bytes to send.  Any transport - a blocking socket, asyncio, a selector loop
+or an in-memory buffer for benchmarks - can drive it::
+
+    engine = Engine()
+    engine.receive_data(sock.recv(65536))
+    for event in engine.events():
+        ...
+
+Events are the message objects of `protocol` (`Handshake`, `OK`, `EOF`,
+`Field`), plus `ResultHeader`, `Row`, `OldPasswordRequest`,
+`LocalInfileRequest` and server errors as `errors.DatabaseError`
+instances.  Only the uncompressed, non-SSL text protocol is handled.
+
+`multi` and `aio` drive the engine.  The blocking `protocol.Protocol` does
+not: it reads packets itself for SSL, compression, prepared statements
+and server side cursors, so the response handling exists twice.  The two
+share the message classes, capability negotiation (`protocol.client_flags`)
+and LOAD DATA LOCAL INFILE rules (`protocol.open_local_infile`); any other
+change to one has to be made to the other as well.
+"""
+
+from struct import pack
+
+import constants
+import packet
+from protocol import Handshake, ClientAuthentication, OK, EOF, Field, \
+                     STATE_INIT, STATE_AUTH, STATE_READY, STATE_FIELDS, \
+                     STATE_DATA, STATE_RESULT, LOCAL_INFILE_CHUNK_SIZE, \
+                     client_flags, open_local_infile, raw_row_decoder, \
+                     scramble, scramble_323
+from errors import InterfaceError, OperationalError
+from util import unpack_int32
+
+# waiting for the server to ask for or acknowledge LOAD DATA LOCAL INFILE
+STATE_LOCAL_INFILE = 256
+
+class ResultHeader(object):
+    """Start of a resultset: the number of Field events that follow"""
+    def __init__(self, field_count):
+        self.field_count = field_count
+
+class Row(object):
+    """A row of the current resultset"""
+    __slots__ = ('values',)
+    def __init__(self, values):
+        self.values = values
+
+class OldPasswordRequest(object):
+    """The server did not accept the authentication reply and asks for a
+    3.23 style password; reply with `Engine.old_password`"""
+
+class LocalInfileRequest(object):
+    """The server asks for the contents of ``filename``; reply with
+    `Engine.local_infile_reply`"""
+    def __init__(self, filename):
+        self.filename = filename
+
+class PacketParser(object):
+    """Split a byte stream into logical packets
+
+    Payloads larger than MAX_PAYLOAD_SIZE are joined from their
+    continuation packets.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0
+
+    def feed(self, data):
+        if self.start and self.start == len(self.buf):
+            del self.buf[:]
+            self.start = 0
+        self.buf += data
+
+    def next_packet(self):
+        """Return the next complete `packet.Packet`, or None if more data
+        is needed"""
+        buf = self.buf
+        offset = self.start
+        end = len(buf)
+        parts = []
+        while True:
+            if end - offset < 4:
+                return None
+            i, = unpack_int32(buf, offset)
+            size, seqno = i & 0x00ffffff, i >> 24
+            if end - offset - 4 < size:
+                return None
+            parts.append((offset + 4, size))
+            offset += 4 + size
+            if size < packet.MAX_PAYLOAD_SIZE:
+                break
+        if len(parts) == 1:
+            payload = bytes(buf[offset - size:offset])
+        else:
+            payload = ''.encode('utf8').join([bytes(buf[start:start + n])
+                                              for start, n in parts])
+        self.start = offset
+        if offset > len(buf) // 2:
+            # drop consumed data once it dominates the buffer
+            del buf[:offset]
+            self.start = 0
+        return packet.Packet(len(payload), seqno, memoryview(payload))
+
+class Engine(object):
+    """MySQL client protocol state machine
+
+    Uses the same states as `protocol.Protocol`.  Commands may only be
+    issued in STATE_READY, i.e. once the previous response has been
+    completely consumed as events.
+    """
+
+    def __init__(self, charset='utf8', row_decoder=raw_row_decoder):
+        self.charset = charset
+        self.row_decoder = row_decoder
+        self.parser = PacketParser()
+        self.state = STATE_INIT
+        self.info = None
+        self.flags = 0
+        self.field_count = 0
+        self.fields = None
+        self.decode_row = None
+        # sequence number of the next packet this client sends
+        self.seqno = 0
+        # LOAD DATA LOCAL INFILE data that may be sent, as in
+        # `protocol.Protocol`
+        self.local_infile_sources = {}
+        self.local_infile_paths = ()
+        # why the requested LOAD DATA LOCAL INFILE data was not sent
+        self.local_infile_error = None
+        # packet handler for each state
+        self.handlers = {
+            STATE_INIT          : self._on_handshake,
+            STATE_AUTH          : self._on_auth_reply,
+            STATE_READY         : self._on_unexpected,
+            STATE_RESULT        : self._on_result,
+            STATE_FIELDS        : self._on_field,
+            STATE_DATA          : self._on_row,
+            STATE_LOCAL_INFILE  : self._on_local_infile_reply,
+        }
+
+    def receive_data(self, data):
+        """Feed bytes received from the server"""
+        self.parser.feed(data)
+
+    def next_event(self):
+        """Process the next packet
+
+        :returns: the next event, or None if more data is needed
+        """
+        pkt = self.parser.next_packet()
+        if pkt is None:
+            return None
+        self.seqno = (pkt.seqno + 1) & 0xff
+        if pkt.is_error_packet():
+            error = packet.pkt2error(pkt.data.tobytes())
+            if self.local_infile_error is not None:
+                error, self.local_infile_error = self.local_infile_error, None
+            # an error ends a command; a failed handshake or
+            # authentication leaves the engine where it was, as the server
+            # closes the connection
+            if self.state not in (STATE_INIT, STATE_AUTH):
+                self.state = STATE_READY
+            return error
+        return self.handlers[self.state](pkt)
+
+    def events(self):
+        """Iterate over the events available from the data received so
+        far"""
+        event = self.next_event()
+        while event is not None:
+            yield event
+            event = self.next_event()
+
+    # packet handlers; see self.handlers
+    def _on_handshake(self, pkt):
+        self.info = Handshake.decode(pkt)
+        return self.info
+
+    def _on_auth_reply(self, pkt):
+        if not pkt.is_ok_packet():
+            # as in `protocol.Protocol`, anything else asks for an old
+            # style password; see old_password()
+            return OldPasswordRequest()
+        self.state = STATE_READY
+        return OK.decode(pkt)
+
+    def _on_unexpected(self, pkt):
+        raise InterfaceError(-1, "Unexpected packet with no command pending")
+
+    def _on_result(self, pkt):
+        if pkt.is_ok_packet():
+            info = OK.decode(pkt)
+            self.__end_command(info.server_status)
+            return info
+        if pkt.first_byte() == 0xfb:
+            pkt.skip(1)
+            self.state = STATE_LOCAL_INFILE
+            return LocalInfileRequest(pkt.read())
+        self.field_count = pkt.read_lcb()
+        self.fields = []
+        self.state = STATE_FIELDS
+        return ResultHeader(self.field_count)
+
+    def _on_field(self, pkt):
+        if pkt.is_eof_packet():
+            self.decode_row = self.row_decoder(self.fields, self.charset)
+            self.state = STATE_DATA
+            return EOF.decode(pkt)
+        field = Field.decode(pkt)
+        self.fields.append(field)
+        return field
+
+    def _on_row(self, pkt):
+        if pkt.is_eof_packet():
+            info = EOF.decode(pkt)
+            self.__end_command(info.status)
+            return info
+        return Row(self.decode_row(pkt.data))
+
+    def _on_local_infile_reply(self, pkt):
+        info = OK.decode(pkt)
+        self.__end_command(info.server_status)
+        if self.local_infile_error is not None:
+            error, self.local_infile_error = self.local_infile_error, None
+            return error
+        return info
+
+    def __end_command(self, status):
+        if status & constants.SERVER_MORE_RESULTS_EXISTS:
+            self.state = STATE_RESULT
+        else:
+            self.state = STATE_READY
+
+    # commands; each returns the bytes to send to the server
+    def __frame(self, payload):
+        buffers, self.seqno = packet.split_payload(payload, self.seqno)
+        # bytes() of a memoryview is its repr on python 2
+        return ''.encode('utf8').join([memoryview(buf).tobytes()
+                                       for buf in buffers])
+
+    def __command(self, payload):
+        if self.state != STATE_READY:
+            raise InterfaceError(-1, "Command issued in state %d but expected "
+                                     "STATE_READY" % self.state)
+        self.seqno = 0
+        self.state = STATE_RESULT
+        return self.__frame(payload)
+
+    def authenticate(self, user=None, password=None, schema=None):
+        """Reply to the server handshake
+
+        Capabilities are negotiated as in `protocol.Protocol` without SSL
+        and compression.
+        """
+        if self.info is None:
+            raise InterfaceError(-1, "No server handshake received")
+        self.flags = client_flags(self.info.server_capabilities)
+        auth = ClientAuthentication(user=user,
+                                    token=scramble(password, self.info.salt),
+                                    schema=schema,
+                                    client_flags=self.flags)
+        self.state = STATE_AUTH
+        return self.__frame(auth.serialize())
+
+    def old_password(self, password):
+        """Answer the server's request for a 3.23 style password"""
+        return self.__frame(scramble_323(password, self.info.salt[0:8]))
+
+    def query(self, sql):
+        return self.__command(pack('B', constants.COM_QUERY) +
+                              sql.encode(self.charset))
+
+    def ping(self):
+        return self.__command(pack('B', constants.COM_PING))
+
+    def quit(self):
+        data = self.__command(pack('B', constants.COM_QUIT))
+        self.state = STATE_INIT
+        return data
+
+    def local_infile_reply(self, request):
+        """Answer a `LocalInfileRequest`
+
+        As in `protocol.Protocol`, the data comes from local_infile_sources
+        or one of the files in local_infile_paths, and other requests are
+        refused by sending no data.  All of the data is read before any is
+        returned, so if reading fails no data is sent either.  Either way
+        the error takes the place of the server's reply.
+        """
+        try:
+            chunks, fileobj = open_local_infile(
+                                request.filename.decode(self.charset),
+                                self.local_infile_sources,
+                                self.local_infile_paths)
+        except (OperationalError, IOError), exc:
+            self.local_infile_error = exc
+            return self.local_infile_data([])
+        try:
+            try:
+                chunks = list(chunks)
+            except Exception, exc:
+                self.local_infile_error = exc
+                chunks = []
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+        return self.local_infile_data(chunks)
+
+    def local_infile_data(self, chunks):
+        """Frame LOAD DATA LOCAL INFILE data in packets of at most
+        LOCAL_INFILE_CHUNK_SIZE bytes, including the terminating empty
+        packet"""
+        if self.state != STATE_LOCAL_INFILE:
+            raise InterfaceError(-1, "No LOAD DATA LOCAL INFILE request "
+                                     "pending")
+        output = []
+        for chunk in chunks:
+            # an empty packet would end the data early
+            for offset in xrange(0, len(chunk), LOCAL_INFILE_CHUNK_SIZE):
+                output.append(self.__frame(
+                    chunk[offset:offset + LOCAL_INFILE_CHUNK_SIZE]))
+        output.append(self.__frame(''.encode('utf8')))
+        return ''.encode('utf8').join(output)
@@ -64,6 +64,36 @@ class NotSupportedError(DatabaseError):
     transaction or has transactions turned off.
     """
 
+class BatchError(DatabaseError):
+    """Exception raised when a statement of a multi-statement batch failed.
+
+    ``index`` is the position of the failed statement in the batch; the
+    statements following it were not executed.
+    """
+    def __init__(self, index, error):
+        DatabaseError.__init__(self, error.args[0],
+                               "Statement %d of the batch failed: %s" %
+                               (index, error.args[1]),
+                               getattr(error, 'sqlstate', None))
+        self.index = index
+
+class PipelineError(DatabaseError):
+    """Exception raised after a pipeline of statements in which at least
+    one statement failed.
+
+    ``index`` is the position of the first failed statement and
+    ``results`` holds the outcome of every statement of the pipeline in
+    order: either its list of results or the exception it raised.
+    """
+    def __init__(self, index, results):
+        error = results[index]
+        DatabaseError.__init__(self, error.args[0],
+                               "Statement %d of the pipeline failed: %s" %
+                               (index, error.args[1]),
+                               getattr(error, 'sqlstate', None))
+        self.index = index
+        self.results = results
+
 errno_to_exception = {
     # server errors
     1043 : InternalError,       # ER_BAD_HANDSHAKE
@@ -101,11 +131,15 @@ errno_to_exception = {
     2006 : OperationalError,
 }
 
-def raise_mysql_error(errno, message=''):
-    """Raise the appropriate exception based on the given errno
+def mysql_error(errno, message=''):
+    """Create the appropriate exception for the given errno
 
     See:
         http://dev.mysql.com/doc/refman/5.5/en/error-handling.html
     """
     errorclass = errno_to_exception.get(errno, InternalError)
-    raise errorclass(errno, message)
+    return errorclass(errno, message)
+
+def raise_mysql_error(errno, message=''):
+    """Raise the appropriate exception based on the given errno"""
+    raise mysql_error(errno, message)
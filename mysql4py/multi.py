@@ -0,0 +1,240 @@
+"""Run queries on many connections at once from a single thread
+
+`fan_out` sends one query per connection and drives all of them with a
+non-blocking selector loop around the sans-IO `engine.Engine`, so the time
+taken is that of the slowest server rather than the sum of all of them::
+
+    for index, outcome in fan_out(connections, 'SHOW GLOBAL STATUS'):
+        if isinstance(outcome, Exception):
+            ...
+        else:
+            rows = outcome[0].rows
+
+Connections are regular `dbapi.Connection` objects; they are used
+non-blocking for the duration of the call and can be used normally
+afterwards.  SSL and compressed connections are not supported.  A LOAD
+DATA LOCAL INFILE request fails the query and closes its connection.
+"""
+
+import errno
+import socket
+import time
+
+try:
+    import selectors
+except ImportError:
+    # python < 3.4
+    selectors = None
+    import select
+
+import constants
+import errors
+from engine import Engine, ResultHeader, Row
+from protocol import OK, EOF, Field, STATE_READY
+
+RECV_SIZE = 65536
+
+class Result(object):
+    """One result of a fanned out query
+
+    ``fields`` and ``rows`` are empty for statements without a resultset.
+    """
+    def __init__(self):
+        self.fields = []
+        self.rows = []
+        self.affected_rows = 0
+        self.insert_id = None
+
+class _SelectSelector(object):
+    """Minimal stand-in for selectors.DefaultSelector built on select()"""
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+
+    def register(self, sock, events, data):
+        if events & EVENT_READ:
+            self.readers[sock] = data
+        if events & EVENT_WRITE:
+            self.writers[sock] = data
+
+    def unregister(self, sock):
+        self.readers.pop(sock, None)
+        self.writers.pop(sock, None)
+
+    def modify(self, sock, events, data):
+        self.unregister(sock)
+        self.register(sock, events, data)
+
+    def select(self, timeout=None):
+        readable, writable, _ = select.select(list(self.readers),
+                                              list(self.writers), [], timeout)
+        return [(_Key(self.readers[sock]), EVENT_READ) for sock in readable] + \
+               [(_Key(self.writers[sock]), EVENT_WRITE) for sock in writable]
+
+    def close(self):
+        self.readers.clear()
+        self.writers.clear()
+
+class _Key(object):
+    def __init__(self, data):
+        self.data = data
+
+if selectors is not None:
+    EVENT_READ = selectors.EVENT_READ
+    EVENT_WRITE = selectors.EVENT_WRITE
+    DefaultSelector = selectors.DefaultSelector
+else:
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+    DefaultSelector = _SelectSelector
+
+class _Job(object):
+    """State of the query running on one connection"""
+
+    def __init__(self, index, connection, sql):
+        protocol = connection.protocol
+        if protocol.requested_feature(constants.CLIENT_SSL) or \
+           protocol.compress_algorithm is not None:
+            raise errors.NotSupportedError(-1, "fan_out() does not support "
+                                               "SSL or compressed connections")
+        protocol.sync()
+        self.index = index
+        self.connection = connection
+        self.socket = protocol.channel.socket
+        self.engine = Engine(charset=protocol.charset,
+                             row_decoder=protocol.row_decoder)
+        self.engine.state = STATE_READY
+        self.output = self.engine.query(sql)
+        self.sent = 0
+        self.results = []
+        self.result = None
+        self.error = None
+
+    def send(self):
+        """Send more of the query; returns True once all of it is sent"""
+        try:
+            self.sent += self.socket.send(self.output[self.sent:])
+        except socket.error, exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            raise errors.OperationalError(2006, "MySQL server has gone away")
+        return self.sent == len(self.output)
+
+    def receive(self):
+        """Read available data; returns True once the response is complete
+        """
+        try:
+            data = self.socket.recv(RECV_SIZE)
+        except socket.error, exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            data = None
+        if not data:
+            raise errors.OperationalError(2013, "Lost connection to MySQL "
+                                                "server during query")
+        engine = self.engine
+        engine.receive_data(data)
+        for event in engine.events():
+            if isinstance(event, Row):
+                self.result.rows.append(event.values)
+            elif isinstance(event, ResultHeader):
+                self.result = Result()
+                self.results.append(self.result)
+            elif isinstance(event, Field):
+                self.result.fields.append(event)
+            elif isinstance(event, OK):
+                result = Result()
+                result.affected_rows = event.affected_rows
+                result.insert_id = event.insert_id
+                self.results.append(result)
+            elif isinstance(event, errors.Error):
+                # the server ends the command after an error
+                self.error = event
+            elif not isinstance(event, EOF):
+                raise errors.NotSupportedError(-1, "Unsupported response "
+                                                   "%r" % event)
+        return engine.state == STATE_READY
+
+    def outcome(self):
+        if self.error is not None:
+            return self.error
+        return self.results
+
+def fan_out(connections, queries, timeout=None):
+    """Run a query on each of ``connections`` concurrently
+
+    :param connections: sequence of `dbapi.Connection`
+    :param queries: one SQL string for all connections, or a sequence with
+                    one query per connection
+    :param timeout: overall time limit in seconds; connections that have
+                    not answered in time are closed and reported with an
+                    OperationalError
+    :returns: iterator of (connection index, outcome) in completion order;
+              the outcome is the list of `Result` of the query or the
+              exception it failed with.  Connections still running when
+              iteration is abandoned are closed.
+    """
+    if isinstance(queries, basestring):
+        queries = [queries] * len(connections)
+    elif len(queries) != len(connections):
+        raise errors.ProgrammingError(-1, "fan_out() needs one query per "
+                                          "connection")
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    selector = DefaultSelector()
+    pending = {}
+    try:
+        for index, connection in enumerate(connections):
+            try:
+                job = _Job(index, connection, queries[index])
+            except errors.Error, exc:
+                yield index, exc
+                continue
+            job.socket.setblocking(False)
+            selector.register(job.socket, EVENT_WRITE, job)
+            pending[index] = job
+
+        while pending:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+            for key, events in selector.select(wait):
+                job = key.data
+                if job.index not in pending:
+                    continue
+                broken = False
+                try:
+                    if events & EVENT_WRITE:
+                        if job.send():
+                            selector.modify(job.socket, EVENT_READ, job)
+                        continue
+                    if not job.receive():
+                        continue
+                    outcome = job.outcome()
+                except errors.Error, exc:
+                    outcome = exc
+                    broken = True
+                # a closed socket can no longer be unregistered
+                selector.unregister(job.socket)
+                del pending[job.index]
+                if broken:
+                    job.connection.protocol.channel.close()
+                else:
+                    job.socket.setblocking(True)
+                yield job.index, outcome
+
+        # timed out: the protocol state of these connections is unknown
+        for index in sorted(pending):
+            job = pending.pop(index)
+            selector.unregister(job.socket)
+            job.connection.protocol.channel.close()
+            yield index, errors.OperationalError(2013, "Query timed out")
+    finally:
+        for job in pending.values():
+            selector.unregister(job.socket)
+            job.connection.protocol.channel.close()
+        selector.close()
@@ -0,0 +1,130 @@
+"""NumPy conversion of columnar resultsets
+
+Batches read with `protocol.ResultSet.columns` are turned into NumPy arrays
+without materializing per-row python objects: numeric columns are wrapped
+in place and fixed width text (dates, datetimes) is parsed by NumPy in one
+vectorized call.  Columns containing NULLs become masked arrays.
+
+NumPy is optional; ``numpy`` is None here when it is not installed.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from conversions import TYPE_MAP, to_decimal, parse_date, parse_datetime
+
+# rows per batch when none is requested
+BATCH_SIZE = 65536
+
+def field_dtype(field):
+    """Derive the NumPy dtype for a text column from its TYPE_MAP converter
+
+    Integer and float columns are handled by `columnar.NumericColumn`.
+    DECIMAL columns are converted to float64; strings and blobs are kept
+    as objects.
+    """
+    convert = TYPE_MAP.get(field.type_code)
+    if convert is parse_datetime:
+        return numpy.dtype('datetime64[us]')
+    elif convert is parse_date:
+        return numpy.dtype('datetime64[D]')
+    elif convert is to_decimal:
+        return numpy.dtype('float64')
+    return numpy.dtype(object)
+
+def null_mask(column):
+    """Expand a column's NULL bitmap into a boolean array"""
+    bits = numpy.frombuffer(column.nulls, dtype=numpy.uint8)
+    # the bitmap is least significant bit first; unpackbits() only gained
+    # its bitorder argument in numpy 1.17, so reverse the bits of each byte
+    return numpy.unpackbits(bits).reshape(-1, 8)[:, ::-1].ravel() \
+                [:len(column)].astype(bool)
+
+def column_values(column, mask):
+    """Convert the non-NULL values of a `columnar.BinaryColumn`"""
+    dtype = field_dtype(column.field)
+    offsets = numpy.frombuffer(column.offsets,
+                               dtype=column.offsets.typecode)
+    starts = offsets[:-1][~mask]
+    lengths = numpy.diff(offsets)[~mask]
+
+    if dtype.kind != 'O' and len(lengths) and lengths[0] and \
+       (lengths == lengths[0]).all():
+        # fixed width text is contiguous in the buffer; view it as an
+        # array of strings without copying
+        raw = numpy.frombuffer(column.data, dtype='S%d' % lengths[0])
+    else:
+        data = column.data
+        raw = [bytes(data[start:start + length])
+               for start, length in zip(starts.tolist(), lengths.tolist())]
+        if dtype.kind == 'O':
+            if column.field.type_code not in TYPE_MAP:
+                raw = [value.decode('utf8') for value in raw]
+            values = numpy.empty(len(raw), dtype=object)
+            values[:] = raw
+            return values
+        raw = numpy.array(raw)
+
+    try:
+        return raw.astype(dtype)
+    except ValueError:
+        # zero dates ('0000-00-00') and the like
+        return numpy.array([_parse_or_nat(value, dtype) for value in raw],
+                           dtype=dtype)
+
+def _parse_or_nat(value, dtype):
+    """Parse one value, mapping invalid dates to NaT"""
+    try:
+        return numpy.array(value).astype(dtype)
+    except ValueError:
+        return numpy.datetime64('NaT')
+
+def column_array(column):
+    """Convert a `columnar.Column` into a NumPy (masked) array"""
+    if hasattr(column, 'values'):
+        values = numpy.frombuffer(column.values,
+                                  dtype=column.values.typecode)
+        if not column.null_count:
+            return values
+        return numpy.ma.MaskedArray(values, mask=null_mask(column))
+
+    mask = null_mask(column)
+    values = column_values(column, mask)
+    if not column.null_count:
+        return values
+    result = numpy.zeros(len(column), dtype=values.dtype)
+    result[~mask] = values
+    if result.dtype.kind == 'O':
+        result[mask] = None
+    return numpy.ma.MaskedArray(result, mask=mask)
+
+def columns_to_dict(columns):
+    """Convert a list of columns into a dict of arrays keyed by name"""
+    result = {}
+    for column in columns:
+        result[column.field.column.decode('utf8')] = column_array(column)
+    return result
+
+def columns_to_records(columns):
+    """Convert a list of columns into a structured array
+
+    A masked structured array is returned if any column contains NULLs.
+    """
+    names = [column.field.column.decode('utf8') for column in columns]
+    arrays = [column_array(column) for column in columns]
+    n_rows = len(columns[0])
+    records = numpy.zeros(n_rows,
+                          dtype=[(name, array.dtype)
+                                 for name, array in zip(names, arrays)])
+    mask = numpy.zeros(n_rows, dtype=[(name, bool) for name in names])
+    masked = False
+    for name, array in zip(names, arrays):
+        records[name] = numpy.ma.getdata(array)
+        if numpy.ma.isMaskedArray(array):
+            mask[name] = numpy.ma.getmaskarray(array)
+            masked = True
+    if masked:
+        return numpy.ma.MaskedArray(records, mask=mask)
+    return records
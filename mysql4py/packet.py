@@ -1,81 +1,106 @@
 import socket
 import struct
 import zlib
-from array import array
+from struct import Struct
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional
+    zstandard = None
 
-from util import ByteStream
-from errors import raise_mysql_error
+from util import ByteStream, unpack_int8, unpack_int32
+from errors import mysql_error, raise_mysql_error
 
-def pkt2mysqlerror(data):
+# largest payload that fits in a single packet; larger payloads are split
+# into continuation packets
+MAX_PAYLOAD_SIZE = 0x00ffffff
+
+# compressed frame header: frame length/seqno, uncompressed length
+unpack_frame_header = Struct('<IHB').unpack_from
+
+def split_payload(data, seqno=0):
+    """Split a payload into logical packets
+
+    Payloads of MAX_PAYLOAD_SIZE bytes or more are split across
+    continuation packets terminated by a shorter (possibly empty) packet.
+
+    :returns: tuple of (list of header and payload buffers, next seqno)
+    """
+    data = memoryview(data)
+    size = len(data)
+    buffers = []
+    offset = 0
+    while True:
+        chunk = min(size - offset, MAX_PAYLOAD_SIZE)
+        buffers.append(struct.pack('<I', chunk | (seqno << 24)))
+        buffers.append(data[offset:offset + chunk])
+        seqno = (seqno + 1) & 0xff
+        offset += chunk
+        if chunk < MAX_PAYLOAD_SIZE:
+            break
+    return buffers, seqno
+
+def pkt2error(data):
+    """Create the exception for the payload of an error packet"""
     errno, sqlstate = struct.unpack('<xH6s', data[0:9])
     msg = data[9:].decode('utf8')
-    raise_mysql_error(errno, msg)
+    return mysql_error(errno, msg)
+
+def pkt2mysqlerror(data):
+    raise pkt2error(data)
 
 class Packet(ByteStream):
-    __slots__ = ( 'size', 'seqno', 'data', 'index' )
+    __slots__ = ( 'size', 'seqno' )
     def __init__(self, size=None, seqno=0, data=None):
         self.size = size
         self.seqno = seqno
         self.data = data
         self.index = 0
 
+    def first_byte(self):
+        """Return the first byte of this packet's payload"""
+        return unpack_int8(self.data, 0)[0]
+
     def is_ok_packet(self):
         """Check if this packet is an 'OK' packet"""
-        return self.data[0] == 0x00
+        return self.first_byte() == 0x00
 
     def is_error_packet(self):
         """Check if this packet is an error packet"""
-        return self.data[0] == 0xff
+        return self.first_byte() == 0xff
 
     def is_eof_packet(self):
         """Check if this packet is an EOF packet"""
-        return self.data[0] == 0xfe
-
+        return self.first_byte() == 0xfe
 
-class CompressedPacket(Packet):
-    def __init__(self, size=None, seqno=0, full_size=0, data=None):
-        Packet.__init__(self, size, seqno, data)
-        self.full_size = full_size
-
-    def next_packet(self):
-        """Return next logical packet from our buffers, or None
-        if we do not have a full packet remaining"""
-        try:
-            size_seqno, = struct.unpack('<I', self.data[self.index:self.index+4])
-        except struct.error:
-            raise IndexError(self.data[self.index:])
-        self.index += 4
-        size, seqno = size_seqno & 0x00ffffff, size_seqno >> 24
-        data = self.data[self.index:self.index+size]
-        if len(data) < size:
-            self.index -= 4 # unread header
-            raise IndexError(self.data[self.index:])
-        self.index += size
-        if data[0] == 0xff:
-            pkt2mysqlerror(data.tostring())
-        return Packet(size, seqno, data)
 
 class BasePacketStream(object):
     def __init__(self, channel):
         self.channel = channel
 
     def read(self, n_bytes):
-        result = array('B')
-        while n_bytes:
-            chunk = self.channel.read(n_bytes)
-            if not chunk:
-                # MySQL server has gone away
-                raise_mysql_error(errno=2006,
-                                  message='MySQL server has gone away')
-            result.extend(chunk)
-            n_bytes -= len(chunk)
-        return result
+        """Read exactly n_bytes from the channel
+
+        Returns a memoryview that is only valid until the next read
+        """
+        try:
+            return self.channel.read(n_bytes)
+        except socket.error:
+            # MySQL server has gone away
+            raise_mysql_error(errno=2006,
+                              message='MySQL server has gone away')
 
     def write(self, data):
         try:
-            while data:
-                n = self.channel.write(data)
-                data = data[n:]
+            self.channel.write(data)
+        except socket.error:
+            raise_mysql_error(errno=2006,
+                              message='MySQL server has gone away')
+
+    def writev(self, buffers):
+        """Write a sequence of buffers in as few system calls as possible"""
+        try:
+            self.channel.writev(buffers)
         except socket.error:
             raise_mysql_error(errno=2006,
                               message='MySQL server has gone away')
@@ -89,69 +114,228 @@ class BasePacketStream(object):
 
 class RawPacketStream(BasePacketStream):
     def next_packet(self):
-        i, = struct.unpack('<I', self.read(4))
+        i, = unpack_int32(self.read(4))
         size, seqno = i & 0x00ffffff, i >> 24
         data = self.read(size)
-        if data[0] == 0xff:
-            pkt2mysqlerror(data.tostring())
+        pkt = Packet(size, seqno, data)
+        if pkt.is_error_packet():
+            pkt2mysqlerror(data.tobytes())
 
-        while size == 0x00ffffff:
-            i, = struct.unpack('<I', self.read(4))
-            size, seqno = i & 0x00ffffff, i >> 24
-            data.extend(self.read(size))
-        size = len(data)
-        return Packet(size, seqno, data)
+        if size == 0x00ffffff:
+            # the payload continues in following packets; the channel
+            # reuses its buffer so the pieces are joined into our own copy
+            data = bytearray(data)
+            while size == 0x00ffffff:
+                i, = unpack_int32(self.read(4))
+                size, seqno = i & 0x00ffffff, i >> 24
+                data += self.read(size)
+            pkt = Packet(len(data), seqno, memoryview(data))
+        return pkt
 
     def send_packet(self, data, seqno=0):
-        size = len(data)
-        self.write(struct.pack('<I', size | (seqno << 24)) + data)
+        """Send ``data`` as a single logical packet
+
+        Large payloads are split with `split_payload`; headers and payload
+        views are written together without joining them.
+
+        :returns: the sequence number following the last packet sent
+        """
+        buffers, seqno = split_payload(data, seqno)
+        self.writev(buffers)
+        return seqno
 
 
 
 class CompressedPacketStream(BasePacketStream):
-    def __init__(self, channel):
+    """Packet stream for the compressed protocol
+
+    Logical packets are carried inside compressed frames, each with a
+    7-byte header (frame length, frame seqno, uncompressed length).  Frames
+    are inflated as they arrive from the channel and logical packets are
+    handed out as views into the inflated frame; only packets that span
+    frames are copied.
+    """
+    # payloads shorter than this are sent uncompressed (libmysql's
+    # MIN_COMPRESS_LENGTH)
+    COMPRESS_THRESHOLD = 50
+    COMPRESS_LEVEL = 6
+    # compressed data is fed to the inflater at most this many bytes at a
+    # time so large frames never have to be buffered whole
+    INFLATE_CHUNK_SIZE = 32768
+
+    def __init__(self, channel, threshold=None, level=None):
         BasePacketStream.__init__(self, channel)
-        # maintain a buffer of any trailing data
-        self.buffer = array('B')
-        self.packet = None # partial data from last packet
+        if threshold is None:
+            threshold = self.COMPRESS_THRESHOLD
+        if level is None:
+            level = self.COMPRESS_LEVEL
+        self.threshold = threshold
+        self.level = level
+        # inflated data of the current frame and our offset into it
+        self.window = memoryview(''.encode('utf8'))
+        self.index = 0
+        # compressed frames are numbered separately from logical packets
+        self.compressed_seqno = 0
+
+    def compress(self, buffers):
+        """Compress the buffers making up a frame payload"""
+        compressor = zlib.compressobj(self.level)
+        output = [compressor.compress(memoryview(buf).tobytes())
+                  for buf in buffers]
+        output.append(compressor.flush())
+        return ''.encode('utf8').join(output)
 
-    def next_compressed_packet(self, remaining=None):
+    def inflater(self):
+        """Create a streaming decompressor for the next frame"""
+        return zlib.decompressobj()
+
+    def next_frame(self):
+        """Read the next compressed frame into our window"""
         header = self.read(7)
-        size_seq, uzlen0, uzlen1 = struct.unpack('<IHB', header)
+        size_seq, uzlen0, uzlen1 = unpack_frame_header(header)
         size, seqno = size_seq & 0x00ffffff, size_seq >> 24
         uzlen = uzlen0 | uzlen1 << 16
-        buffer = array('B')
-
-        if remaining:
-            buffer.extend(remaining)
+        self.compressed_seqno = (seqno + 1) & 0xff
 
-        data = self.read(size)
+        if not uzlen:
+            # payload was sent uncompressed; use it straight from the
+            # channel buffer
+            self.window = self.read(size)
+            self.index = 0
+            return
 
-        if uzlen:
-            buffer.fromstring(zlib.decompress(data))
+        inflater = self.inflater()
+        chunks = []
+        remaining = size
+        while remaining:
+            data = self.read(min(remaining, self.INFLATE_CHUNK_SIZE))
+            remaining -= len(data)
+            chunks.append(inflater.decompress(data.tobytes()))
+        chunks.append(inflater.flush())
+        chunks = [chunk for chunk in chunks if chunk]
+        if len(chunks) == 1:
+            window = chunks[0]
         else:
-            buffer.fromstring(data)
+            window = ''.encode('utf8').join(chunks)
+        if len(window) != uzlen:
+            raise_mysql_error(errno=1157, # ER_NET_UNCOMPRESS_ERROR
+                              message="Couldn't uncompress communication "
+                                      "packet")
+        self.window = memoryview(window)
+        self.index = 0
+
+    def read_window(self, n_bytes):
+        """Read n_bytes of inflated data, crossing frames as needed"""
+        window = self.window
+        index = self.index
+        if index + n_bytes <= len(window):
+            self.index = index + n_bytes
+            return window[index:index + n_bytes]
 
-        return CompressedPacket(size, seqno, uzlen + len(remaining or ''), buffer)
+        # spans frames - copy what we have before the window is replaced
+        data = bytearray(window[index:])
+        while len(data) < n_bytes:
+            self.next_frame()
+            wanted = min(n_bytes - len(data), len(self.window))
+            data += self.window[0:wanted]
+            self.index = wanted
+        return memoryview(data)
 
     def next_packet(self):
-        if not self.packet:
-            self.packet = self.next_compressed_packet()
+        i, = unpack_int32(self.read_window(4))
+        size, seqno = i & 0x00ffffff, i >> 24
+        data = self.read_window(size)
+        pkt = Packet(size, seqno, data)
+        if pkt.is_error_packet():
+            pkt2mysqlerror(data.tobytes())
 
-        try:
-            pkt = self.packet.next_packet()
-        except IndexError, exc:
-            remaining = exc.args[0]
-            self.packet = self.next_compressed_packet(remaining)
-            pkt = self.packet.next_packet()
+        if size == 0x00ffffff:
+            data = bytearray(data)
+            while size == 0x00ffffff:
+                i, = unpack_int32(self.read_window(4))
+                size, seqno = i & 0x00ffffff, i >> 24
+                data += self.read_window(size)
+            pkt = Packet(len(data), seqno, memoryview(data))
         return pkt
 
     def send_packet(self, data, seqno=0):
-        # 4 byte packet header + size of payload (excluding 7-byte compression
-        # header)
-        total_size = 4 + len(data)
-        size = len(data)
-        payload = struct.pack('<I3xI',
-                              total_size | (seqno << 24), # compression header
-                              size | (seqno << 24)) + data
-        self.write(payload)
+        """Send ``data`` as a single logical packet
+
+        Frame payloads of at least ``threshold`` bytes are compressed;
+        smaller payloads, or ones that do not shrink, are sent as is.
+
+        :returns: the sequence number following the last packet sent
+        """
+        if seqno == 0:
+            # a new command restarts the frame numbering as well
+            self.compressed_seqno = 0
+        buffers, seqno = split_payload(data, seqno)
+        if len(buffers) == 2:
+            # the common case: a single packet in a single frame
+            frames = [(buffers, len(buffers[0]) + len(buffers[1]))]
+        else:
+            frames = split_frames(buffers, MAX_PAYLOAD_SIZE)
+
+        output = []
+        for frame, size in frames:
+            uzlen = 0
+            if size >= self.threshold:
+                payload = self.compress(frame)
+                if len(payload) < size:
+                    frame, uzlen, size = [payload], size, len(payload)
+            header = struct.pack('<IHB',
+                                 size | (self.compressed_seqno << 24),
+                                 uzlen & 0xffff, uzlen >> 16)
+            self.compressed_seqno = (self.compressed_seqno + 1) & 0xff
+            output.append(header)
+            output.extend(frame)
+        self.writev(output)
+        return seqno
+
+class ZstdCompressedPacketStream(CompressedPacketStream):
+    """Packet stream for the zstd compressed protocol (MySQL 8.0.18+)
+
+    The framing is identical to the zlib compressed protocol; only the
+    algorithm used for frame payloads differs.  Requires the optional
+    ``zstandard`` module.
+    """
+    COMPRESS_LEVEL = 3
+
+    def __init__(self, channel, threshold=None, level=None):
+        CompressedPacketStream.__init__(self, channel, threshold, level)
+        self.compressor = zstandard.ZstdCompressor(level=self.level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, buffers):
+        """Compress the buffers making up a frame payload"""
+        return self.compressor.compress(
+            ''.encode('utf8').join([memoryview(buf).tobytes()
+                                    for buf in buffers]))
+
+    def inflater(self):
+        """Create a streaming decompressor for the next frame"""
+        return self.decompressor.decompressobj()
+
+def split_frames(buffers, limit):
+    """Regroup a list of buffers into frames of at most ``limit`` bytes
+
+    :returns: list of (list of buffers, frame size) tuples
+    """
+    frames = []
+    frame = []
+    frame_size = 0
+    for buf in buffers:
+        buf = memoryview(buf)
+        offset = 0
+        while offset < len(buf):
+            wanted = min(len(buf) - offset, limit - frame_size)
+            frame.append(buf[offset:offset + wanted])
+            frame_size += wanted
+            offset += wanted
+            if frame_size == limit:
+                frames.append((frame, frame_size))
+                frame = []
+                frame_size = 0
+    if frame:
+        frames.append((frame, frame_size))
+    return frames
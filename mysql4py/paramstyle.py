@@ -1,6 +1,16 @@
 """dbapi 2.0 paramstyle implementations"""
 
-from pycompat import Scanner
+import binascii
+import datetime
+import inspect
+import re
+try:
+    from decimal import Decimal
+except ImportError:
+    # python 2.3 does not support Decimal
+    Decimal = float
+
+from util import LRUCache
 
 class ParamFormatError(Exception):
     """Raised when there is a problem formatting a query according to a given
@@ -10,19 +20,156 @@ class ParamFormatError(Exception):
 def quote_identifier(identifier):
     return identifier.replace('`', '``')
 
+# replacements for the characters that must be escaped in string literals
+ESCAPES = {
+    '\0'    : '\\0',
+    '\n'    : '\\n',
+    '\r'    : '\\r',
+    '\\'    : '\\\\',
+    "'"     : "\\'",
+    '"'     : '\\"',
+    '\x1a'  : '\\Z',
+}
+
+# unicode.translate() table built from ESCAPES
+ESCAPE_TABLE = dict([(ord(char), unicode(escaped))
+                     for char, escaped in ESCAPES.items()])
+
+_escape_pattern = re.compile(r'''[\x00\n\r\x1a\\'"]''')
+
+def _escape_match(match):
+    return ESCAPES[match.group()]
+
 def escape_string(value):
-    mysql_meta = {
-        '\0'    : '\\0',
-        '\n'    : "\\n",
-        '\r'    : "\\r",
-        '\\'    : "\\",
-        "'"     : "\\'",
-        '"'     : '\\"',
-        '\x1a'  : '\\Z'
-    }
-    return "'%s'" % re.sub(r'''([\x00\n\r\x1a\\'"])''',
-                           lambda m: mysql_meta[m.group(1)],
-                           value)
+    """Quote ``value`` as a MySQL string literal"""
+    if isinstance(value, unicode):
+        return "'%s'" % value.translate(ESCAPE_TABLE)
+    return "'%s'" % _escape_pattern.sub(_escape_match, value)
+
+def encode_null(value):
+    return 'NULL'
+
+def encode_bool(value):
+    return value and '1' or '0'
+
+def encode_bytes(value):
+    """Encode binary data as a hex literal"""
+    return "X'%s'" % binascii.hexlify(value).decode('ascii')
+
+def encode_datetime(value):
+    return "'%s'" % value.isoformat(' ')
+
+def encode_isoformat(value):
+    return "'%s'" % value.isoformat()
+
+def encode_timedelta(value):
+    """Encode a timedelta as a TIME literal (which may exceed 24 hours)"""
+    sign = ''
+    if value < datetime.timedelta(0):
+        sign = '-'
+        value = -value
+    minutes, seconds = divmod(value.seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    hours += value.days * 24
+    if value.microseconds:
+        return "'%s%d:%02d:%02d.%06d'" % (sign, hours, minutes, seconds,
+                                          value.microseconds)
+    return "'%s%d:%02d:%02d'" % (sign, hours, minutes, seconds)
+
+# SQL literal encoders keyed by parameter type
+ENCODERS = {
+    type(None)          : encode_null,
+    bool                : encode_bool,
+    int                 : str,
+    long                : str,
+    float               : repr,
+    Decimal             : str,
+    str                 : escape_string,
+    unicode             : escape_string,
+    bytearray           : encode_bytes,
+    datetime.datetime   : encode_datetime,
+    datetime.date       : encode_isoformat,
+    datetime.time       : encode_isoformat,
+    datetime.timedelta  : encode_timedelta,
+}
+if bytes is not str:
+    # only binary data has its own type, str is text
+    ENCODERS[bytes] = encode_bytes
+
+def encode_literal(value):
+    """Encode a parameter as a SQL literal
+
+    Numbers are sent unquoted, None as NULL, binary data as hex literals
+    and strings quoted and escaped.  Subclasses of the types in ENCODERS
+    use the encoder of their nearest base class.
+
+    :raises: ParamFormatError for unsupported types
+    """
+    try:
+        return ENCODERS[type(value)](value)
+    except KeyError:
+        pass
+    # inspect.getmro also handles python 2 old-style classes
+    for base in inspect.getmro(value.__class__)[1:]:
+        if base in ENCODERS:
+            return ENCODERS[base](value)
+    raise ParamFormatError("Unsupported parameter type %r" % type(value))
+
+def format_to_qmark(query):
+    """Rewrite a 'format' paramstyle query to the '?' placeholders used by
+    server side prepared statements
+
+    Like `FormatParamStyle`, every %s is a placeholder and %% is a literal %
+    """
+    return re.sub(r'%([%s])',
+                  lambda m: m.group(1) == 's' and '?' or '%',
+                  query)
+
+# Quoted strings and identifiers are matched whole so that placeholders
+# are only recognized in the query text itself
+_QUOTED = r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`"""
+
+# number of parsed queries kept per paramstyle
+TEMPLATE_CACHE_SIZE = 256
+
+def compile_tokenizer(placeholder):
+    """Compile the pattern used by `split_query` for a placeholder regex
+
+    Group 1 is a placeholder, group 2 the opening quote of an unterminated
+    string or identifier.
+    """
+    return re.compile(r"""%s|(%s)|(['"`])""" % (_QUOTED, placeholder),
+                      re.DOTALL)
+
+def split_query(query, tokenizer):
+    """Split a query around its placeholders in a single pass
+
+    :returns: tuple of (text fragments, placeholders); there is always one
+              more fragment than placeholders
+    :raises: ParamFormatError on unterminated quotes
+    """
+    fragments = []
+    params = []
+    offset = 0
+    for match in tokenizer.finditer(query):
+        param, quote = match.group(1, 2)
+        if param is not None:
+            fragments.append(query[offset:match.start()])
+            params.append(param)
+            offset = match.end()
+        elif quote is not None:
+            raise ParamFormatError("Error parsing query at offset %d: "
+                                   "unterminated %s" %
+                                   (match.start(), quote))
+    fragments.append(query[offset:])
+    return fragments, params
+
+def join_template(fragments, values):
+    """Interleave query fragments with the escaped parameter values"""
+    parts = [None] * (len(fragments) + len(values))
+    parts[::2] = fragments
+    parts[1::2] = values
+    return ''.join(parts)
 
 class AbstractParamStyle(object):
     """Base class for formatting a query with a given paramstyle"""
@@ -42,79 +189,72 @@ class AbstractParamStyle(object):
         arguments"""
         raise NotImplementedError()
 
-class QmarkParamStyle(AbstractParamStyle):
-    scanner = Scanner([
-        (r"'((?:[^\\']|\\[^']|''|\\')*)'", None),
-        (r'"((?:[^\\"]|\\[^"]|""|\\")*)"', None),
-        (r'`((?:[^\\`]|\\[^`]|``|\\`)*)`', None),
-        (r'\s+', None),
-        (r'''[^?'"`]+''', None),
-        (r'[?]', lambda x,y: (y, x.match.start(), x.match.end())),
-    ])
+class TemplateParamStyle(AbstractParamStyle):
+    """Base class for paramstyles whose placeholders have to be found by
+    parsing the query
+
+    Subclasses set ``tokenizer`` (see `compile_tokenizer`) and their own
+    ``templates`` cache.  Each query is parsed once into fragments and
+    placeholders; later calls with the same query text only escape and
+    join the parameters.  The caches are shared by all connections;
+    `LRUCache` locks around every access.
+    """
+    tokenizer = None
+    templates = None
+
+    @classmethod
+    def param_key(cls, token):
+        """Map a placeholder token to the parameter it refers to"""
+        return token
+
+    @classmethod
+    def template(cls, query):
+        """Return the cached (fragments, parameter keys) for ``query``"""
+        template = cls.templates.get(query)
+        if template is None:
+            fragments, params = split_query(query, cls.tokenizer)
+            template = fragments, [cls.param_key(param) for param in params]
+            cls.templates.put(query, template)
+        return template
+
+class QmarkParamStyle(TemplateParamStyle):
+    tokenizer = compile_tokenizer(r'[?]')
+    templates = LRUCache(TEMPLATE_CACHE_SIZE)
 
     @classmethod
     def format(cls, query, *args, **kwargs):
-        matches, unparsed = cls.scanner.scan(query)
-
-        if unparsed:
-            raise ParamFormatError("Error parsing query at offset %d" %
-                    len(query) - len(unparsed))
-
-        # offset into the query text
-        offset = 0
-        # list of query fragments - broken into text,replaced param[, text...]
-        fragments = []
-        for idx, (param, start, stop) in enumerate(matches):
-            fragments.append(query[offset:start])
-            fragments.append(escape_string(args[idx]))
-            offset = stop
-        if not fragments:
+        fragments, params = cls.template(query)
+        if not params:
             return query
-        else:
-            return ''.join(fragments)
-
-class NamedParamStyle(AbstractParamStyle):
-    scanner = Scanner([
-        (r"'(?:[^']|(?:\\[^'])|(?:'')|(?:\\'))*'", None),
-        (r'"((?:[^\\"]|\\[^"]|""|\\")*)"', None),
-        (r'`((?:[^\\`]|\\[^`]|``|\\`)*)`', None),
-        (r'\s+', None),
-        (r'''[^:'"`]+''', None),
-        (r'[:][a-zA-Z0-9_]+', lambda x,y: (y, x.match.start(), x.match.end())),
-    ])
+        if len(args) != len(params):
+            raise ParamFormatError("Query expects %d parameters, got %d" %
+                                   (len(params), len(args)))
+        return join_template(fragments, [encode_literal(arg) for arg in args])
+
+class NamedParamStyle(TemplateParamStyle):
+    tokenizer = compile_tokenizer(r'[:][a-zA-Z0-9_]+')
+    templates = LRUCache(TEMPLATE_CACHE_SIZE)
+
+    @classmethod
+    def param_key(cls, token):
+        return token[1:]
 
     @classmethod
     def format(cls, query, **kwargs):
-        matches, unparsed = cls.scanner.scan(query)
-
-        if unparsed:
-            raise ParamFormatError("Error parsing query at offset %d" %
-                    len(query) - len(unparsed))
-
-        # offset into the query text
-        offset = 0
-        # list of query fragments - broken into text,replaced param[, text...]
-        fragments = []
-        for param, start, stop in matches:
-            name = param[1:]
-            fragments.append(query[offset:start])
-            fragments.append(escape_string(kwargs[name]))
-            offset = stop
-        if not fragments:
+        fragments, params = cls.template(query)
+        if not params:
             return query
-        else:
-            return ''.join(fragments)
+        return join_template(fragments,
+                             [encode_literal(kwargs[name]) for name in params])
 
 
-class NumericParamStyle(AbstractParamStyle):
-    scanner = Scanner([
-        (r"'(?:[^']|(?:\\[^'])|(?:'')|(?:\\'))*'", None),
-        (r'"((?:[^\\"]|\\[^"]|""|\\")*)"', None),
-        (r'`((?:[^\\`]|\\[^`]|``|\\`)*)`', None),
-        (r'\s+', None),
-        (r'''[^:'"`]+''', None),
-        (r'[:][0-9]+', lambda x,y: (y, x.match.start(), x.match.end())),
-    ])
+class NumericParamStyle(TemplateParamStyle):
+    tokenizer = compile_tokenizer(r'[:][0-9]+')
+    templates = LRUCache(TEMPLATE_CACHE_SIZE)
+
+    @classmethod
+    def param_key(cls, token):
+        return int(token[1:])
 
     @classmethod
     def format(cls, query, *args, **kwargs):
@@ -122,25 +262,11 @@ class NumericParamStyle(AbstractParamStyle):
             raise ValueError("numeric paramstyle only supports "
                              "positional arguments")
 
-        matches, unparsed = cls.scanner.scan(query)
-
-        if unparsed:
-            raise ParamFormatError("Error parsing query at offset %d" %
-                    len(query) - len(unparsed))
-
-        # offset into the query text
-        offset = 0
-        # list of query fragments - broken into text,replaced param[, text...]
-        fragments = []
-        for param, start, stop in matches:
-            param_offset = int(param[1:])
-            fragments.append(query[offset:start])
-            fragments.append(escape_string(args[param_offset]))
-            offset = stop
-        if not fragments:
+        fragments, params = cls.template(query)
+        if not params:
             return query
-        else:
-            return ''.join(fragments)
+        return join_template(fragments,
+                             [encode_literal(args[index]) for index in params])
 
 class FormatParamStyle(AbstractParamStyle):
     """DBAPI format formatting"""
@@ -151,7 +277,7 @@ class FormatParamStyle(AbstractParamStyle):
             raise ValueError("format paramstyle does not support "
                              "named parameters")
 
-        return query % tuple([escape_string(arg) for arg in args])
+        return query % tuple([encode_literal(arg) for arg in args])
 
 
 class PyFormatParamStyle(AbstractParamStyle):
@@ -162,7 +288,7 @@ class PyFormatParamStyle(AbstractParamStyle):
                              "positional parameters")
 
         for key, value in kwargs.items():
-            kwargs[key] = escape_string(value)
+            kwargs[key] = encode_literal(value)
         return query % kwargs
 
 
@@ -0,0 +1,253 @@
+"""Thread-safe pool of DBAPI connections"""
+
+import threading
+import time
+
+import errors
+from dbapi import Connection
+
+class PooledConnection(object):
+    """Bookkeeping for a connection owned by a `ConnectionPool`"""
+    def __init__(self, connection, now):
+        self.connection = connection
+        self.created = now
+        self.last_used = now
+
+class ConnectionPool(object):
+    """A bounded pool of `dbapi.Connection` objects shared between threads
+
+    Connections are created on demand up to ``max_size`` and ``min_size``
+    are opened up front.  acquire() hands out the most recently returned
+    idle connection, or blocks for up to ``timeout`` seconds when
+    ``max_size`` connections are in use.  release() resets the session
+    (see `protocol.Protocol.reset_session`) and sets it up again with
+    `dbapi.Connection.init_session` before the connection is reused.
+
+    A connection idle for more than ``ping_interval`` seconds is checked
+    with a ping before it is handed out; recently used connections are
+    assumed alive.  Connections idle for more than ``max_idle`` seconds
+    (beyond the first ``min_size``) or older than ``max_age`` seconds are
+    closed when the pool is next used or `evict` is called.
+
+    Any other keyword arguments are passed to `dbapi.Connection`.
+    """
+
+    def __init__(self,
+                 min_size=0,
+                 max_size=10,
+                 timeout=None,
+                 ping_interval=30,
+                 max_idle=600,
+                 max_age=3600,
+                 connection_factory=Connection,
+                 **connect_args):
+        if max_size < 1 or min_size > max_size:
+            raise errors.ProgrammingError(-1, "invalid pool size %d..%d" %
+                                              (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.connection_factory = connection_factory
+        self.connect_args = connect_args
+        self.closed = False
+
+        self._cond = threading.Condition(threading.Lock())
+        # idle connections, most recently returned last
+        self._idle = []
+        # id(connection) -> PooledConnection for connections handed out
+        self._in_use = {}
+        # number of open connections, including ones being opened
+        self._size = 0
+
+        for i in xrange(min_size):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def _open(self):
+        """Open a new connection; the caller has accounted for it in _size"""
+        try:
+            connection = self.connection_factory(**self.connect_args)
+        except:
+            self._cond.acquire()
+            try:
+                self._size -= 1
+                self._cond.notify()
+            finally:
+                self._cond.release()
+            raise
+        return PooledConnection(connection, time.time())
+
+    def _discard(self, entry):
+        """Close a connection that leaves the pool"""
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        try:
+            entry.connection.close()
+        except (errors.Error, EnvironmentError):
+            # the connection is likely broken already
+            pass
+
+    def _expired(self, entry, now):
+        return self.max_age is not None and now - entry.created > self.max_age
+
+    def acquire(self, timeout=None):
+        """Check a connection out of the pool
+
+        :param timeout: seconds to wait for a connection when the pool is
+                        exhausted; defaults to the pool's timeout, None
+                        waits forever
+        :raises: OperationalError if no connection became available in time
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            self.evict()
+            entry = None
+            create = False
+            self._cond.acquire()
+            try:
+                while True:
+                    if self.closed:
+                        raise errors.InterfaceError(-1, "pool is closed")
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise errors.OperationalError(-1,
+                                "Timed out waiting for a pooled connection")
+                    self._cond.wait(remaining)
+            finally:
+                self._cond.release()
+
+            if create:
+                entry = self._open()
+            elif not self._check(entry):
+                self._discard(entry)
+                continue
+
+            self._cond.acquire()
+            try:
+                self._in_use[id(entry.connection)] = entry
+            finally:
+                self._cond.release()
+            return entry.connection
+
+    def _check(self, entry):
+        """Check that an idle connection is still usable"""
+        now = time.time()
+        if self._expired(entry, now):
+            return False
+        if self.ping_interval is None or \
+           now - entry.last_used < self.ping_interval:
+            return True
+        try:
+            entry.connection.ping()
+        except (errors.Error, EnvironmentError):
+            return False
+        entry.last_used = now
+        return True
+
+    def release(self, connection):
+        """Return a connection to the pool
+
+        Unread results are discarded and the session is reset: open
+        transactions are rolled back and session variables, temporary
+        tables and prepared statements dropped.  The connect-time session
+        setup is then repeated, turning autocommit off.  Connections
+        failing to reset, past their maximum age or returned to a closed
+        pool are closed instead.
+
+        :raises: ProgrammingError if ``connection`` is not checked out of
+                 this pool
+        """
+        self._cond.acquire()
+        try:
+            entry = self._in_use.pop(id(connection), None)
+        finally:
+            self._cond.release()
+        if entry is None:
+            raise errors.ProgrammingError(-1, "connection was not acquired "
+                                              "from this pool or was "
+                                              "already released")
+
+        try:
+            connection.protocol.reset_session()
+            # the reset restored the server defaults, autocommit included
+            connection.init_session()
+        except (errors.Error, EnvironmentError):
+            self._discard(entry)
+            return
+
+        now = time.time()
+        if self.closed or self._expired(entry, now):
+            self._discard(entry)
+            return
+        entry.last_used = now
+        self._cond.acquire()
+        try:
+            self._idle.append(entry)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def evict(self):
+        """Close idle connections past their maximum idle time or age"""
+        now = time.time()
+        evicted = []
+        self._cond.acquire()
+        try:
+            keep = []
+            # the longest idle connections come first
+            for entry in self._idle:
+                if self._expired(entry, now):
+                    evicted.append(entry)
+                elif self.max_idle is not None and \
+                     now - entry.last_used > self.max_idle and \
+                     self._size - len(evicted) > self.min_size:
+                    evicted.append(entry)
+                else:
+                    keep.append(entry)
+            self._idle[:] = keep
+        finally:
+            self._cond.release()
+        for entry in evicted:
+            self._discard(entry)
+        return len(evicted)
+
+    def close(self):
+        """Close all idle connections
+
+        Connections still checked out are closed when they are released.
+        """
+        self._cond.acquire()
+        try:
+            self.closed = True
+            idle = self._idle[:]
+            del self._idle[:]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for entry in idle:
+            self._discard(entry)
+
+    def __len__(self):
+        """Number of open connections, idle or in use"""
+        return self._size
@@ -1,5 +1,8 @@
 """MySQL protocol support"""
 
+import array
+import os
+from collections import deque
 from struct import pack
 try:
     from hashlib import sha1
@@ -7,12 +10,41 @@ except ImportError:
     from sha import new as sha1
 
 import packet
+import columnar
 import constants
-from errors import InterfaceError, OperationalError
+import conversions
+from errors import InterfaceError, OperationalError, ProgrammingError, \
+                   NotSupportedError, DatabaseError, PipelineError
+from util import LRUCache, decode_lcs_list
 
 # default to 16MB
 MAX_PACKET_SIZE = 2**24
 
+# compression algorithms tried, in order, when compression is enabled
+COMPRESSION_ALGORITHMS = ('zstd', 'zlib')
+
+# zstd level requested when none is given
+ZSTD_DEFAULT_LEVEL = 3
+
+# number of prepared statement handles kept open per connection
+STATEMENT_CACHE_SIZE = 64
+
+# bytes of pipelined commands sent ahead of the response being read;
+# kept well below the socket buffers so that writing never blocks while
+# the server is blocked writing responses nobody reads yet
+PIPELINE_WINDOW = 1 << 16
+
+# bytes of a long parameter sent per COM_STMT_SEND_LONG_DATA packet
+LONG_DATA_CHUNK_SIZE = 1 << 20
+
+# largest chunk of LOAD DATA LOCAL INFILE data sent per packet; the server
+# refuses packets over max_allowed_packet (4MB by default on 5.x)
+LOCAL_INFILE_CHUNK_SIZE = 1 << 20
+
+# COM_STMT_EXECUTE flags
+CURSOR_TYPE_NO_CURSOR = 0x00
+CURSOR_TYPE_READ_ONLY = 0x01
+
 
 STATE_INIT      = 0   # initial state before anything is done
 STATE_AUTH      = 2   # middle of authenticating
@@ -20,6 +52,8 @@ STATE_READY     = 4   # ready to issue command
 STATE_FIELDS    = 8   # reading field data (call fields())
 STATE_DATA      = 16  # reading row data (call rows())
 STATE_RESULT    = 32  # another resultset is available (call nextset())
+STATE_PREPARE   = 64  # a statement is being prepared (call read_prepare())
+STATE_FETCH     = 128 # a cursor chunk was requested (see CursorResult)
 
 def protected_state(state):
     """Wrap a `Protocol` method and raise an exception if method is called
@@ -44,6 +78,8 @@ class Protocol(object):
         self.channel = channel
         self.state = STATE_INIT
         self.info = None
+        # (user, password, schema) given to authenticate
+        self.credentials = (None, None, None)
         # set in the authetnicate reply to enable features
         self.flags = 0
         self.packet = packet.RawPacketStream(channel)
@@ -52,9 +88,41 @@ class Protocol(object):
         # SSL params
         self.ssl_ca = None
 
+        # compression params
+        self.compress_threshold = None
+        self.compress_level = None
+        self.compress_algorithms = COMPRESSION_ALGORITHMS
+        self.zstd_level = None
+        # algorithm negotiated with the server, if any
+        self.compress_algorithm = None
+
         # active result, if any
         self.result = None
 
+        # factory for the function decoding each resultset's rows
+        self.row_decoder = raw_row_decoder
+        # ... and for resultsets of prepared statements
+        self.binary_row_decoder = conversions.binary_row_decoder
+        # whether the pending result uses the binary row format
+        self.binary_result = False
+        # (statement, fetch size) if the pending result opens a server side
+        # cursor
+        self.server_cursor = None
+        # true while pipelined commands follow the one being read
+        self.pipelined = False
+        # SQL of the statement sent by send_prepare()
+        self.preparing = None
+
+        # prepared statements keyed by their SQL text
+        self.statements = LRUCache(STATEMENT_CACHE_SIZE,
+                                   on_evict=self.__evict_statement)
+
+        # in-memory LOAD DATA LOCAL INFILE data keyed by file name: an
+        # iterable of byte chunks, sent once when the server requests it
+        self.local_infile_sources = {}
+        # files on disk the server may request with LOAD DATA LOCAL INFILE
+        self.local_infile_paths = ()
+
     # These raise InterfaceError if called anytime after server handshake
     # (self.server_info is not None)
     def enable_ssl(self, ssl_ca, ssl_key, ssl_cert):
@@ -64,9 +132,24 @@ class Protocol(object):
         self.ssl_key = ssl_key
         self.ssl_cert = ssl_cert
 
-    def enable_compression(self):
-        """Enable compression support"""
+    def enable_compression(self, threshold=None, level=None,
+                           algorithms=None, zstd_level=None):
+        """Enable compression support
+
+        :param threshold: packets smaller than this many bytes are sent
+                          uncompressed
+        :param level: zlib compression level for outgoing packets
+        :param algorithms: compression algorithms in order of preference;
+                           the first one supported by both sides is used
+        :param zstd_level: zstd compression level requested of the server
+                           and used for outgoing packets
+        """
         self.flags |= constants.CLIENT_COMPRESS
+        self.compress_threshold = threshold
+        self.compress_level = level
+        if algorithms is not None:
+            self.compress_algorithms = tuple(algorithms)
+        self.zstd_level = zstd_level
 
     def requested_feature(self, flag):
         """Check if a feature has been requested of the protocol"""
@@ -84,19 +167,10 @@ class Protocol(object):
     def authenticate(self, user=None, password=None, schema=None):
         """Authenticate to a MySQL server"""
         self.info = Handshake.decode(self.packet.next_packet())
-        flags = self.info.server_capabilities & \
-                     ~(constants.CLIENT_SSL|
-                       constants.CLIENT_COMPRESS|
-                       #constants.CLIENT_LOCAL_FILES|
-                       constants.CLIENT_INTERACTIVE|
-                       constants.CLIENT_NO_SCHEMA)
-        flags |= (constants.CLIENT_MULTI_RESULTS|
-                  constants.CLIENT_MULTI_STATEMENTS|
-                  constants.CLIENT_SECURE_CONNECTION
-                 )
-
+        # kept for COM_CHANGE_USER, see `reset_session`
+        self.credentials = (user, password, schema)
         # enable compression and/or ssl, if requested
-        self.flags |= flags
+        self.flags |= client_flags(self.info.server_capabilities)
 
         authentication = self.__authenticate_plain
         if self.requested_feature(constants.CLIENT_SSL):
@@ -106,10 +180,8 @@ class Protocol(object):
                                        "(SSL not supported by server)")
             authentication = self.__authenticate_ssl
 
-        if self.requested_feature(constants.CLIENT_COMPRESS) and \
-                not self.info.supports_feature(constants.CLIENT_COMPRESS):
-            raise OperationalError(1157, # (?)ER_NET_UNCOMPRESS_ERROR
-                                   "Server does not support compression")
+        if self.requested_feature(constants.CLIENT_COMPRESS):
+            self.compress_algorithm = self.__negotiate_compression()
 
         token = scramble(password, self.info.salt)
 
@@ -117,13 +189,48 @@ class Protocol(object):
             # fallback to 3.23 style crypt() passwords
             self.__send_old_password(password, self.info.salt[0:8])
 
-        if self.requested_feature(constants.CLIENT_COMPRESS):
+        if self.compress_algorithm == 'zstd':
+            self.packet = packet.ZstdCompressedPacketStream(
+                                self.channel,
+                                threshold=self.compress_threshold,
+                                level=self.zstd_level)
+        elif self.compress_algorithm == 'zlib':
             # all future packets will use the compressed format after auth
             # switch to the compressed_packet parser
-            self.packet = packet.CompressedPacketStream(self.channel)
+            self.packet = packet.CompressedPacketStream(
+                                self.channel,
+                                threshold=self.compress_threshold,
+                                level=self.compress_level)
 
         self.state = STATE_READY
 
+    def __negotiate_compression(self):
+        """Pick the first requested compression algorithm the server (and
+        this python) supports and set the matching client flag
+
+        zlib is selected with CLIENT_COMPRESS and zstd with
+        CLIENT_ZSTD_COMPRESSION_ALGORITHM; the server gives zlib precedence
+        so only one of the two flags is ever sent.
+        """
+        for algorithm in self.compress_algorithms:
+            if algorithm == 'zstd':
+                if packet.zstandard is None or \
+                   not self.info.supports_feature(
+                        constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM):
+                    continue
+                self.flags &= ~constants.CLIENT_COMPRESS
+                self.flags |= constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM
+                return algorithm
+            elif algorithm == 'zlib':
+                if not self.info.supports_feature(constants.CLIENT_COMPRESS):
+                    continue
+                return algorithm
+            else:
+                raise InterfaceError(-1, "Unknown compression algorithm %r" %
+                                     algorithm)
+        raise OperationalError(1157, # (?)ER_NET_UNCOMPRESS_ERROR
+                               "Server does not support compression")
+
     def __authenticate_plain(self, user, token, schema):
         """Standard (non-ssl) authentication.  Uses 4.1 auth by default
         w/ fallback to 3.23 old_passwords mode if necessary
@@ -137,7 +244,8 @@ class Protocol(object):
                                     schema=schema,
                                     charset=33, # utf8
                                     client_flags=self.flags,
-                                    max_packet_size=MAX_PACKET_SIZE)
+                                    max_packet_size=MAX_PACKET_SIZE,
+                                    zstd_level=self.zstd_level)
         self.packet.send_packet(auth.serialize(), seqno=1)
         pkt = self.packet.next_packet()
         return pkt.is_ok_packet()
@@ -155,7 +263,8 @@ class Protocol(object):
                                     schema=schema,
                                     charset=33, # utf8
                                     client_flags=self.flags,
-                                    max_packet_size=MAX_PACKET_SIZE)
+                                    max_packet_size=MAX_PACKET_SIZE,
+                                    zstd_level=self.zstd_level)
         self.packet.send_packet(auth.serialize(), seqno=1)
         try:
             self.channel.start_ssl(ssl_ca=self.ssl_ca,
@@ -168,7 +277,7 @@ class Protocol(object):
         pkt = self.packet.next_packet()
         return pkt.is_ok_packet()
 
-    def __send_old_password(self, password, salt):
+    def __send_old_password(self, password, salt, seqno=3):
         """Send the requested password token in 3.23 format.
 
         If a password is in old_password format the server will reply
@@ -177,7 +286,7 @@ class Protocol(object):
         """
         # send a packet containing just the scrambled password token
         token = scramble_323(password, salt)
-        self.packet.send_packet(token, seqno=3)
+        self.packet.send_packet(token, seqno=seqno)
         # ignore response - if it's an error the generator will raise it
         self.packet.next_packet()
 
@@ -197,10 +306,58 @@ class Protocol(object):
         self.nextset()
         return True
 
+    def reset_session(self):
+        """Reset the session to the state right after authentication
+
+        User variables, temporary tables, session variables, open
+        transactions, table locks and prepared statements are all dropped.
+        Uses COM_RESET_CONNECTION, or re-authenticates with COM_CHANGE_USER
+        on servers older than MySQL 5.7.3.  The statement cache is cleared
+        since the server deallocated its statements.
+        """
+        self.sync()
+        message = pack('B', constants.COM_RESET_CONNECTION)
+        self.packet.send_packet(message, seqno=0)
+        try:
+            self.packet.next_packet()
+        except DatabaseError, exc:
+            if exc.args[0] != 1047: # ER_UNKNOWN_COM_ERROR
+                raise
+            self.change_user(*self.credentials)
+        self.statements.clear()
+
+    def change_user(self, user=None, password=None, schema=None):
+        """Re-authenticate with COM_CHANGE_USER, which also resets the
+        session
+
+        The handshake salt of the connection is reused; prepared statements
+        are deallocated, so the statement cache is cleared.
+        """
+        self.sync()
+        NUL = '\x00'.encode('utf8')
+        token = scramble(password, self.info.salt)
+        message = (pack('B', constants.COM_CHANGE_USER) +
+                   (user or '').encode('utf8') + NUL +
+                   pack('B', len(token)) + token +
+                   (schema or '').encode('utf8') + NUL +
+                   pack('<H', 33)) # utf8
+        self.packet.send_packet(message, seqno=0)
+        if not self.packet.next_packet().is_ok_packet():
+            # fallback to 3.23 style crypt() passwords
+            self.__send_old_password(password, self.info.salt[0:8], seqno=2)
+        self.credentials = (user, password, schema)
+        self.statements.clear()
+
     def sync(self):
         while self.state != STATE_READY:
-            for row in self.result: pass
-            self.nextset()
+            if self.state == STATE_PREPARE:
+                # nobody is going to use or close the statement
+                self.__send_close(self.read_prepare())
+            elif self.state == STATE_FETCH:
+                self.result.read_fetch()
+            else:
+                for row in self.result: pass
+                self.nextset()
 
     # simple com_query interface
     # raises InternalError if called with an active resultset
@@ -215,8 +372,255 @@ class Protocol(object):
             "Query in state %d but expected STATE_READY"
         message = pack('B', constants.COM_QUERY) + sql.encode(self.charset)
         self.packet.send_packet(message, seqno=0)
+        self.binary_result = False
+        self.server_cursor = None
         self.state = STATE_RESULT
 
+    def pipeline(self, queries, window=PIPELINE_WINDOW):
+        """Send several queries without waiting for each response
+
+        COM_QUERY packets totalling up to ``window`` bytes are written
+        ahead of the response being read, so the round trip time is paid
+        about once per window instead of once per query; a larger query is
+        sent on its own.  Responses are read in order and resultsets are
+        stored (see `ResultSet.store`).  A failing query does not stop the
+        following ones.
+
+        LOAD DATA LOCAL INFILE can only be pipelined as the last query sent:
+        if the server requests a file while other queries are queued behind
+        the request, they would be read as the file's data, so the
+        connection is closed.
+
+        :returns: list with the list of results of each query
+        :raises: PipelineError if any query failed, after all responses
+                 have been read
+        :raises: InterfaceError on a LOAD DATA LOCAL INFILE request
+                 followed by other queries
+        """
+        self.sync()
+        queries = iter(queries)
+        results = []
+        # sizes of the commands sent and not answered yet
+        in_flight = deque()
+        in_flight_bytes = 0
+        message = None
+        first_error = None
+        while True:
+            while True:
+                if message is None:
+                    try:
+                        sql = queries.next()
+                    except StopIteration:
+                        break
+                    message = pack('B', constants.COM_QUERY) + \
+                              sql.encode(self.charset)
+                if in_flight and in_flight_bytes + len(message) > window:
+                    break
+                self.packet.send_packet(message, seqno=0)
+                in_flight.append(len(message))
+                in_flight_bytes += len(message)
+                message = None
+            if not in_flight:
+                break
+            self.pipelined = len(in_flight) > 1
+            try:
+                response = self.__read_response()
+            finally:
+                self.pipelined = False
+            if first_error is None and isinstance(response, DatabaseError):
+                first_error = len(results)
+            results.append(response)
+            in_flight_bytes -= in_flight.popleft()
+        if first_error is not None:
+            raise PipelineError(first_error, results)
+        return results
+
+    def __read_response(self):
+        """Read and store all results of one pipelined command
+
+        :returns: list of results, or the server error for the command
+        """
+        self.binary_result = False
+        self.server_cursor = None
+        self.state = STATE_RESULT
+        results = []
+        try:
+            while self.state == STATE_RESULT:
+                result = self.nextset()
+                if result:
+                    result = result.store()
+                results.append(result)
+        except DatabaseError, exc:
+            if exc.args[0] >= 2000:
+                # client side errors, e.g. a lost connection
+                raise
+            self.state = STATE_READY
+            return exc
+        return results
+
+    def prepare(self, sql, cache=True):
+        """Prepare a statement on the server
+
+        Statement handles are cached by SQL text, so preparing the same
+        statement again reuses the existing handle.  When the cache is full
+        the least recently used statement is closed on the server.
+
+        :param cache: if false, always prepare a new handle and leave it out
+                      of the cache; the caller must close it with
+                      `close_statement`
+        :returns: `PreparedStatement` instance
+        """
+        if cache:
+            statement = self.statements.get(sql)
+            if statement is not None:
+                return statement
+
+        self.send_prepare(sql)
+        statement = self.read_prepare()
+        if cache:
+            self.statements.put(sql, statement)
+        return statement
+
+    def send_prepare(self, sql):
+        """Send COM_STMT_PREPARE without waiting for the reply
+
+        This allows preparing a statement on several connections in one
+        round trip.  The reply is read with `read_prepare`; if the
+        connection is used for anything else first, the statement is
+        closed again.
+        """
+        self.sync()
+        message = pack('B', constants.COM_STMT_PREPARE) + \
+                  sql.encode(self.charset)
+        self.packet.send_packet(message, seqno=0)
+        self.preparing = sql
+        self.state = STATE_PREPARE
+
+    def read_prepare(self):
+        """Read the reply to `send_prepare`
+
+        :returns: `PreparedStatement` instance, not cached; the caller must
+                  close it with `close_statement`
+        """
+        if self.state != STATE_PREPARE:
+            raise InterfaceError(-1, "No statement is being prepared")
+        # the command ends here, even if the server refused the statement
+        self.state = STATE_READY
+        statement = PreparedStatement.decode(self.packet.next_packet(),
+                                             self.preparing)
+        if statement.param_count:
+            statement.params = self.__read_fields()
+        if statement.field_count:
+            statement.fields = self.__read_fields()
+        return statement
+
+    def execute(self, statement, params=(), fetch_size=None):
+        """Execute a prepared statement with the given parameters
+
+        Like `query`, the response is read with nextset(); resultsets use
+        the binary row format.
+
+        File-like objects and `LongData` chunk iterables among ``params``
+        are streamed to the server with `send_long_data` before the
+        statement is executed, so they never have to be held in memory as a
+        whole.
+
+        :param fetch_size: if given, ask the server to keep the resultset
+                           in a read-only cursor and return it in chunks of
+                           this many rows (see `CursorResult`)
+        """
+        self.sync()
+        request = StatementExecute(statement, params, charset=self.charset)
+        try:
+            for index in request.long_data:
+                self.send_long_data(statement, index, params[index])
+        except Exception:
+            # discard the data already sent before giving up
+            self.reset_statement(statement)
+            raise
+        if fetch_size:
+            flags = CURSOR_TYPE_READ_ONLY
+            self.server_cursor = (statement, fetch_size)
+        else:
+            flags = CURSOR_TYPE_NO_CURSOR
+            self.server_cursor = None
+        request.flags = flags
+        self.packet.send_packet(request.serialize(), seqno=0)
+        self.binary_result = True
+        self.state = STATE_RESULT
+
+    def send_long_data(self, statement, index, source):
+        """Stream parameter ``index`` of ``statement`` to the server
+
+        ``source`` is a file-like object or a `LongData` iterable of byte
+        strings.  It is sent in COM_STMT_SEND_LONG_DATA packets of at most
+        LONG_DATA_CHUNK_SIZE bytes; the server does not reply.  Files
+        supporting readinto() are read straight into the packet buffer.
+        Empty data is sent as one empty packet so the parameter is bound
+        to '' rather than left unset.
+        """
+        header = pack('<BIH', constants.COM_STMT_SEND_LONG_DATA,
+                      statement.statement_id, index)
+        send_packet = self.packet.send_packet
+        sent = False
+        if hasattr(source, 'readinto'):
+            buf = bytearray(len(header) + LONG_DATA_CHUNK_SIZE)
+            buf[:len(header)] = header
+            view = memoryview(buf)
+            while True:
+                n = source.readinto(view[len(header):])
+                if not n:
+                    break
+                send_packet(view[:len(header) + n], seqno=0)
+                sent = True
+        else:
+            if hasattr(source, 'read'):
+                source = read_chunks(source, LONG_DATA_CHUNK_SIZE)
+            for chunk in source:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode(self.charset)
+                for offset in xrange(0, len(chunk), LONG_DATA_CHUNK_SIZE):
+                    send_packet(header +
+                                chunk[offset:offset + LONG_DATA_CHUNK_SIZE],
+                                seqno=0)
+                    sent = True
+        if not sent:
+            send_packet(header, seqno=0)
+
+    def reset_statement(self, statement):
+        """Discard long data sent for ``statement`` and close its cursor"""
+        self.sync()
+        message = pack('<BI', constants.COM_STMT_RESET,
+                       statement.statement_id)
+        self.packet.send_packet(message, seqno=0)
+        self.packet.next_packet()
+
+    def close_statement(self, statement):
+        """Deallocate a prepared statement on the server"""
+        if self.statements.get(statement.sql) is statement:
+            self.statements.pop(statement.sql)
+        self.sync()
+        self.__send_close(statement)
+
+    def __evict_statement(self, sql, statement):
+        """Close a statement pushed out of the statement cache"""
+        self.__send_close(statement)
+
+    def __send_close(self, statement):
+        """Send COM_STMT_CLOSE; the server does not reply"""
+        message = pack('<BI', constants.COM_STMT_CLOSE,
+                       statement.statement_id)
+        self.packet.send_packet(message, seqno=0)
+
+    def __read_fields(self):
+        """Read field definitions up to the terminating EOF packet"""
+        fields = []
+        pkt = self.packet.next_packet()
+        while not pkt.is_eof_packet():
+            fields.append(Field.decode(pkt))
+            pkt = self.packet.next_packet()
+        return fields
+
     #@protected_state(STATE_RESULT)
     def nextset(self):
         """Process the next resulset
@@ -226,7 +630,12 @@ class Protocol(object):
         if self.state != STATE_RESULT:
             return None
 
-        response = self.packet.next_packet()
+        try:
+            response = self.packet.next_packet()
+        except DatabaseError:
+            # an error ends the command; no further results follow
+            self.state = STATE_READY
+            raise
         # OK packet -> INSERT/UPDATE/etc. only rows affected/insert_id
         # returned
         if response.is_ok_packet():
@@ -238,42 +647,87 @@ class Protocol(object):
 
             return self.result
         # LOAD DATA LOCAL INFILE response
-        elif response.data[0] == 0xfb:
+        elif response.first_byte() == 0xfb:
             # packet[0] = \xfb
             # packet[1:] = file we should load
-            # send multiple packets of file data
-            response.skip(1) # skip the known 0xfb byte
-            try:
-                fileobj = open(response.read_all().tostring(), 'rb')
-            except IOError, exc:
-                # Sending an empty packet
-                self.packet.send_packet(''.encode(self.charset), seqno=2)
+            if self.pipelined:
+                # the server would read the queued commands as file data
                 self.state = STATE_READY
-                raise
+                self.channel.close()
+                raise InterfaceError(2014, "Commands out of sync: LOAD DATA "
+                                           "LOCAL INFILE requested in the "
+                                           "middle of a pipeline; the "
+                                           "connection was closed")
+            response.skip(1) # skip the known 0xfb byte
+            return self.__send_local_infile(response.read())
+        elif self.server_cursor is not None:
+            statement, fetch_size = self.server_cursor
+            self.server_cursor = None
+            self.result = CursorResult(response, self, statement, fetch_size)
+            return self.result
+        else:
+            self.result = ResultSet(response, self)
+            self.state = STATE_DATA
+            return self.result
 
+    def __send_local_infile(self, filename):
+        """Answer a LOAD DATA LOCAL INFILE request
+
+        The data comes from the source registered for ``filename`` in
+        local_infile_sources, or from the file itself if it is one of
+        local_infile_paths.  Other requests are refused by sending no data,
+        as is done when reading the data fails before any was sent; the
+        command is completed before the error is raised.  Ending the data
+        after part of it was sent would load that part, so on later
+        failures the connection is closed instead, which makes the server
+        abort the statement.
+        """
+        error = None
+        chunks = fileobj = None
+        try:
+            chunks, fileobj = open_local_infile(filename.decode(self.charset),
+                                                self.local_infile_sources,
+                                                self.local_infile_paths)
+        except (OperationalError, IOError), exc:
+            error = exc
+
+        pktnr = 2
+        sent = False
+        if chunks is not None:
             try:
-                data = fileobj.read(65535)
-                pktnr = 2
-                while data:
-                    self.packet.send_packet(data, pktnr)
-                    data = fileobj.read(65535)
-                    pktnr += 1
-                self.packet.send_packet(''.encode(self.charset), pktnr)
-                self.state = STATE_READY
+                try:
+                    for chunk in chunks:
+                        # an empty packet would end the data early
+                        for offset in xrange(0, len(chunk),
+                                             LOCAL_INFILE_CHUNK_SIZE):
+                            pktnr = self.packet.send_packet(
+                                chunk[offset:offset + LOCAL_INFILE_CHUNK_SIZE],
+                                pktnr)
+                            sent = True
+                except Exception, exc:
+                    error = exc
             finally:
-                fileobj.close()
+                if fileobj is not None:
+                    fileobj.close()
+        if error is not None and sent:
+            self.state = STATE_READY
+            self.channel.close()
+            raise error
+        self.packet.send_packet(''.encode(self.charset), pktnr)
+        self.state = STATE_READY
 
+        try:
             pkt = self.packet.next_packet()
-            response = SimpleResult(pkt)
-            if response.more_results():
-                self.state = STATE_RESULT
-            else:
-                self.state = STATE_READY
-            return response
-        else:
-            self.result = ResultSet(response, self)
-            self.state = STATE_DATA
-            return self.result
+        except DatabaseError:
+            if error is None:
+                raise
+            raise error
+        if error is not None:
+            raise error
+        response = SimpleResult(pkt)
+        if response.more_results():
+            self.state = STATE_RESULT
+        return response
 
 class SimpleResult(object):
     def __init__(self, response):
@@ -308,6 +762,12 @@ class ResultSet(object):
         self.field_count = response.read_lcb()
         self.protocol = protocol
         self.fields = self.__fields()
+        self.binary = protocol.binary_result
+        if self.binary:
+            row_decoder = protocol.binary_row_decoder
+        else:
+            row_decoder = protocol.row_decoder
+        self.decode_row = row_decoder(self.fields, protocol.charset)
 
     #@protected_state(STATE_FIELDS)
     def __fields(self):
@@ -321,6 +781,7 @@ class ResultSet(object):
         while not pkt.is_eof_packet():
             fields.append(Field.decode(pkt))
             pkt = self.protocol.packet.next_packet()
+        self.status = EOF.decode(pkt).status
         self.protocol.state = STATE_DATA
         return fields
 
@@ -333,16 +794,86 @@ class ResultSet(object):
         rows if requested.
         """
         if not self.protocol:
-            raise StopIteration
-        n_fields = self.field_count
+            return
+        decode_row = self.decode_row
         next_packet = self.protocol.packet.next_packet
         pkt = next_packet()
         #for pkt in self.packet:
-        while not pkt.data[0] == 0xfe:
-            if pkt.data[0] == 0xfe:
+        while not pkt.is_eof_packet():
+            yield decode_row(pkt.data)
+            pkt = next_packet()
+        self._finish(pkt)
+
+    def fetchmany(self, size=None):
+        """Read up to ``size`` rows (all remaining rows if size is None)
+
+        Rows are decoded in a single loop straight into the returned list.
+        """
+        rows = []
+        if not self.protocol:
+            return rows
+        append = rows.append
+        decode_row = self.decode_row
+        next_packet = self.protocol.packet.next_packet
+        while size is None or len(rows) < size:
+            pkt = next_packet()
+            if pkt.is_eof_packet():
+                self._finish(pkt)
+                break
+            append(decode_row(pkt.data))
+        return rows
+
+    def columns(self, max_rows=None):
+        """Read the remaining rows of this resultset column by column
+
+        Values are accumulated into compact per-column buffers (see
+        `columnar`) instead of per-row tuples.
+
+        :param max_rows: stop after this many rows; the rest of the
+                         resultset can be read by further calls
+        :returns: list of `columnar.Column` instances in field order
+        """
+        if self.binary:
+            raise NotSupportedError(-1, "Columnar fetch is not supported "
+                                        "for prepared statement results")
+        columns = [columnar.make_column(field) for field in self.fields]
+        if not self.protocol:
+            return columns
+        appenders = [column.append for column in columns]
+        n_fields = self.field_count
+        next_packet = self.protocol.packet.next_packet
+        n_rows = 0
+        while max_rows is None or n_rows < max_rows:
+            pkt = next_packet()
+            if pkt.is_eof_packet():
+                self._finish(pkt)
                 break
-            yield tuple(pkt.read_n_lcs(n_fields))
+            values = decode_lcs_list(pkt.data, 0, n_fields)[0]
+            for append, value in zip(appenders, values):
+                append(value)
+            n_rows += 1
+        return columns
+
+    def store(self):
+        """Read all remaining rows into a `StoredResult`
+
+        After this the connection is free for the next command.
+        """
+        stored = StoredResult(self.fields, self.decode_row, self.binary)
+        if not self.protocol:
+            return stored
+        append = stored.append
+        next_packet = self.protocol.packet.next_packet
+        while True:
             pkt = next_packet()
+            if pkt.is_eof_packet():
+                self._finish(pkt)
+                break
+            append(pkt.data)
+        return stored
+
+    def _finish(self, pkt):
+        """Process the EOF packet terminating this resultset's rows"""
         info = EOF.decode(pkt)
         if info.status & constants.SERVER_MORE_RESULTS_EXISTS:
             self.protocol.state = STATE_RESULT
@@ -355,6 +886,215 @@ class ResultSet(object):
         # True = is a resultset and can be iterated over
         return True
 
+class CursorResult(ResultSet):
+    """Resultset of a prepared statement executed with a server side cursor
+
+    The server keeps the rows and sends them in chunks of ``fetch_size``
+    rows, each requested with COM_STMT_FETCH.  Between chunks the
+    connection is idle, so other commands - including other cursors'
+    fetches - may be issued on it.  Executing or closing ``statement``
+    closes the server side cursor.
+
+    A chunk may be requested ahead with `send_fetch`; its rows are read by
+    the next fetch, or before the next command on the connection.
+
+    If the server did not open a cursor (e.g. for statements that cannot use
+    one), the rows follow immediately and are read as in `ResultSet`.
+    """
+
+    def __init__(self, response, protocol, statement, fetch_size):
+        ResultSet.__init__(self, response, protocol)
+        self.statement = statement
+        self.fetch_size = fetch_size
+        self.server_cursor = bool(self.status &
+                                  constants.SERVER_STATUS_CURSOR_EXISTS)
+        # decoded rows of the current chunk not yet returned
+        self.pending = []
+        # true while a requested chunk has not been read
+        self.fetching = False
+        if self.server_cursor:
+            protocol.state = STATE_READY
+
+    def send_fetch(self):
+        """Request the next chunk of rows without waiting for it
+
+        Does nothing if a chunk was already requested, all rows were sent
+        or the server did not open a cursor.
+        """
+        if not self.server_cursor or self.fetching or not self.protocol:
+            return
+        protocol = self.protocol
+        protocol.sync()
+        message = pack('<BII', constants.COM_STMT_FETCH,
+                       self.statement.statement_id, self.fetch_size)
+        protocol.packet.send_packet(message, seqno=0)
+        protocol.result = self
+        protocol.state = STATE_FETCH
+        self.fetching = True
+
+    def read_fetch(self, handle=None):
+        """Read the chunk requested with `send_fetch`
+
+        :param handle: function called with each row payload; by default
+                       rows are decoded for the following fetches
+        """
+        if handle is None:
+            decode_row = self.decode_row
+            append = self.pending.append
+            handle = lambda payload: append(decode_row(payload))
+        protocol = self.protocol
+        self.fetching = False
+        protocol.state = STATE_READY
+        next_packet = protocol.packet.next_packet
+        pkt = next_packet()
+        while not pkt.is_eof_packet():
+            handle(pkt.data)
+            pkt = next_packet()
+        status = EOF.decode(pkt).status
+        if status & constants.SERVER_STATUS_LAST_ROW_SENT or \
+           not status & constants.SERVER_STATUS_CURSOR_EXISTS:
+            self.protocol = None
+
+    def __iter__(self):
+        if not self.server_cursor:
+            return ResultSet.__iter__(self)
+        return self.__iter_chunks()
+
+    def __iter_chunks(self):
+        while True:
+            rows = self.fetchmany(self.fetch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def fetchmany(self, size=None):
+        """Read up to ``size`` rows (all remaining rows if size is None),
+        fetching further chunks from the server as needed"""
+        if not self.server_cursor:
+            return ResultSet.fetchmany(self, size)
+        rows = []
+        pending = self.pending
+        while size is None or len(rows) < size:
+            if not pending:
+                if not self.protocol:
+                    break
+                self.send_fetch()
+                self.read_fetch()
+                continue
+            if size is None:
+                n = len(pending)
+            else:
+                n = size - len(rows)
+            rows.extend(pending[:n])
+            del pending[:n]
+        return rows
+
+    def store(self):
+        """Fetch all remaining rows into a `StoredResult`"""
+        if not self.server_cursor:
+            return ResultSet.store(self)
+        stored = StoredResult(self.fields, self.decode_row, self.binary)
+        if self.pending:
+            raise InterfaceError(-1, "Cannot store a partially fetched "
+                                     "server side cursor")
+        while self.protocol:
+            self.send_fetch()
+            self.read_fetch(stored.append)
+        return stored
+
+class StoredResult(object):
+    """All rows of a resultset held in client memory
+
+    Undecoded row payloads are kept back to back in a single buffer, with
+    ``offsets[i]:offsets[i + 1]`` delimiting row ``i``.  Rows are decoded
+    only when they are fetched.  Fetching starts at ``position`` and
+    advances it; it may be moved freely with `scroll`.
+    """
+
+    def __init__(self, fields, decode_row, binary=False):
+        self.fields = fields
+        self.field_count = len(fields)
+        self.decode_row = decode_row
+        self.binary = binary
+        self.data = bytearray()
+        self.offsets = array.array(columnar.UINT64, [0])
+        self.position = 0
+        self._view = None
+
+    def append(self, payload):
+        """Store the payload of the next row"""
+        self.data += payload
+        self.offsets.append(len(self.data))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __nonzero__(self):
+        # True = is a resultset and can be iterated over
+        return True
+
+    def payload(self, index):
+        """Return a view of the undecoded payload of row ``index``"""
+        if self._view is None:
+            # no more rows are appended once rows are being read
+            self._view = memoryview(self.data)
+        offsets = self.offsets
+        return self._view[offsets[index]:offsets[index + 1]]
+
+    def __getitem__(self, index):
+        """Decode the row at ``index`` without moving the position"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self.decode_row(self.payload(index))
+
+    def scroll(self, position):
+        """Move the position of the next row to fetch"""
+        if not 0 <= position <= len(self):
+            raise IndexError("scroll out of range")
+        self.position = position
+
+    def fetchmany(self, size=None):
+        """Decode up to ``size`` rows (all remaining if size is None) from
+        the current position"""
+        start = self.position
+        end = len(self)
+        if size is not None:
+            end = min(start + size, end)
+        decode_row = self.decode_row
+        payload = self.payload
+        rows = [decode_row(payload(index)) for index in xrange(start, end)]
+        self.position = end
+        return rows
+
+    def columns(self, max_rows=None):
+        """Return the rows from the current position as
+        `columnar.Column` instances (see `ResultSet.columns`)"""
+        if self.binary:
+            raise NotSupportedError(-1, "Columnar fetch is not supported "
+                                        "for prepared statement results")
+        columns = [columnar.make_column(field) for field in self.fields]
+        appenders = [column.append for column in columns]
+        start = self.position
+        end = len(self)
+        if max_rows is not None:
+            end = min(start + max_rows, end)
+        n_fields = self.field_count
+        for index in xrange(start, end):
+            values = decode_lcs_list(self.payload(index), 0, n_fields)[0]
+            for append, value in zip(appenders, values):
+                append(value)
+        self.position = end
+        return columns
+
+    def __iter__(self):
+        while self.position < len(self):
+            index = self.position
+            self.position += 1
+            yield self.decode_row(self.payload(index))
+
 class Handshake(object):
     """Initial server handshake"""
     def __init__(self,
@@ -388,7 +1128,9 @@ class Handshake(object):
         server_capabilities = pkt.read_int16()
         charset = pkt.read_int8()
         server_status = pkt.read_int16()
-        pkt.skip(13)
+        # upper 16 bits of the capability flags
+        server_capabilities |= pkt.read_int16() << 16
+        pkt.skip(11)
         salt += pkt.read(12)
         return Handshake(protocol_version=protocol_version,
                          server_version=server_version,
@@ -399,6 +1141,23 @@ class Handshake(object):
                          server_status=server_status)
     decode = staticmethod(decode)
 
+def client_flags(server_capabilities):
+    """Capabilities to reply to a server handshake with
+
+    Only the capabilities we know how to speak are echoed back; SSL and
+    compression are added by `Protocol` when they were enabled.
+    """
+    flags = server_capabilities & 0xffff & \
+                 ~(constants.CLIENT_SSL|
+                   constants.CLIENT_COMPRESS|
+                   #constants.CLIENT_LOCAL_FILES|
+                   constants.CLIENT_INTERACTIVE|
+                   constants.CLIENT_NO_SCHEMA)
+    flags |= (constants.CLIENT_MULTI_RESULTS|
+              constants.CLIENT_MULTI_STATEMENTS|
+              constants.CLIENT_SECURE_CONNECTION)
+    return flags
+
 class ClientAuthentication(object):
     """Client reply to server handshake"""
     def __init__(self,
@@ -407,15 +1166,19 @@ class ClientAuthentication(object):
                  charset=33,
                  user='',
                  token='',
-                 schema=''):
+                 schema='',
+                 zstd_level=None):
         if max_packet_size is None:
             max_packet_size = MAX_PACKET_SIZE
+        if zstd_level is None:
+            zstd_level = ZSTD_DEFAULT_LEVEL
         self.client_flags = client_flags
         self.max_packet_size = max_packet_size
         self.charset = charset
         self.user = user
         self.token = token
         self.schema = schema
+        self.zstd_level = zstd_level
 
     def serialize(self):
         """Serialize this authentication request into the packed
@@ -428,10 +1191,13 @@ class ClientAuthentication(object):
                                   self.charset)
         packed_data += (self.user or '').encode('utf8')
         packed_data += NUL # null terminated user name
-        packed_data += chr(len(self.token or '')).encode('utf8')
-        packed_data += (self.token or '').encode('utf8') # LCB password
+        # the scrambled token is binary, not text
+        token = self.token or ''.encode('utf8')
+        packed_data += pack('B', len(token)) + token # LCB password
         packed_data += (self.schema or '').encode('utf8')
         packed_data += NUL # null terminated schema
+        if self.client_flags & constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM:
+            packed_data += pack('B', self.zstd_level)
         return packed_data
 
 class OK(object):
@@ -464,6 +1230,139 @@ class OK(object):
     decode = staticmethod(decode)
 
 
+class PreparedStatement(object):
+    """COM_STMT_PREPARE response: a server side statement handle"""
+    def __init__(self,
+                 sql,
+                 statement_id,
+                 field_count,
+                 param_count,
+                 warning_count):
+        self.sql = sql
+        self.statement_id = statement_id
+        self.field_count = field_count
+        self.param_count = param_count
+        self.warning_count = warning_count
+        # Field definitions of the parameters and result columns
+        self.params = []
+        self.fields = []
+
+    #@staticmethod
+    def decode(pkt, sql):
+        """Decode a COM_STMT_PREPARE OK packet"""
+        pkt.skip(1) # always 0x00
+        statement_id = pkt.read_int32()
+        field_count = pkt.read_int16()
+        param_count = pkt.read_int16()
+        pkt.skip(1) # filler
+        warning_count = pkt.read_int16()
+        return PreparedStatement(sql=sql,
+                                 statement_id=statement_id,
+                                 field_count=field_count,
+                                 param_count=param_count,
+                                 warning_count=warning_count)
+    decode = staticmethod(decode)
+
+def read_chunks(fileobj, size):
+    """Iterate over ``fileobj`` in chunks of up to ``size`` bytes"""
+    chunk = fileobj.read(size)
+    while chunk:
+        yield chunk
+        chunk = fileobj.read(size)
+
+def open_local_infile(filename, sources, paths):
+    """Find the data to send for a LOAD DATA LOCAL INFILE request
+
+    :param sources: dict of in-memory data keyed by file name, as chunk
+                    iterables; the entry for ``filename`` is removed
+    :param paths: files on disk that may be sent
+    :returns: tuple of (iterable of byte chunks, file object to close once
+              they are read, or None)
+    :raises: OperationalError if ``filename`` may not be sent, IOError if
+             it cannot be opened
+    """
+    chunks = sources.pop(filename, None)
+    if chunks is not None:
+        return chunks, None
+    allowed = [os.path.realpath(path) for path in paths]
+    if os.path.realpath(filename) not in allowed:
+        raise OperationalError(2068, "LOAD DATA LOCAL INFILE file request "
+                                     "rejected due to restrictions on "
+                                     "access: %s" % filename)
+    fileobj = open(filename, 'rb')
+    return read_chunks(fileobj, LOCAL_INFILE_CHUNK_SIZE), fileobj
+
+class LongData(object):
+    """Wrap an iterable of byte (or unicode) chunks to stream it to the
+    server as a prepared statement parameter, see `Protocol.execute`"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+def is_long_data(value):
+    """Check whether a parameter value is to be streamed to the server
+    (a file-like object or `LongData`) rather than sent inline"""
+    return isinstance(value, LongData) or hasattr(value, 'read')
+
+class StatementExecute(object):
+    """COM_STMT_EXECUTE request"""
+    def __init__(self,
+                 statement,
+                 params,
+                 flags=CURSOR_TYPE_NO_CURSOR,
+                 charset='utf8'):
+        n_params = statement.param_count
+        if len(params) != n_params:
+            raise ProgrammingError(1210, # ER_WRONG_ARGUMENTS
+                                   "Statement expects %d parameters, "
+                                   "got %d" % (n_params, len(params)))
+        self.statement = statement
+        self.params = params
+        self.flags = flags
+        self.charset = charset
+        # indexes of the parameters sent with COM_STMT_SEND_LONG_DATA
+        self.long_data = [index for index, value in enumerate(params)
+                          if is_long_data(value)]
+
+    def serialize(self):
+        """Serialize this request, binary encoding all parameters"""
+        n_params = self.statement.param_count
+        long_data = self.long_data
+        parts = [pack('<BIBI',
+                      constants.COM_STMT_EXECUTE,
+                      self.statement.statement_id,
+                      self.flags,
+                      1)] # iteration count
+        if not n_params:
+            return parts[0]
+
+        nulls = bytearray((n_params + 7) // 8)
+        types = []
+        values = []
+        for index, value in enumerate(self.params):
+            if value is None:
+                nulls[index >> 3] |= 1 << (index & 7)
+                types.append(pack('<BB', constants.FIELD_TYPE_NULL, 0))
+                continue
+            if long_data and index in long_data:
+                # the value was already sent; only its type goes here
+                types.append(pack('<BB', constants.FIELD_TYPE_BLOB, 0))
+                continue
+            try:
+                type_code, flags, data = \
+                    conversions.encode_binary_param(value, self.charset)
+            except TypeError, exc:
+                raise ProgrammingError(-1, str(exc))
+            types.append(pack('<BB', type_code, flags))
+            values.append(data)
+        parts.append(bytes(nulls))
+        parts.append(pack('B', 1)) # new parameter types bound
+        parts.extend(types)
+        parts.extend(values)
+        return ''.encode('utf8').join(parts)
+
 class EOF(object):
     """End-of-Field/End-of-Data protocol message"""
     def __init__(self, warnings, status):
@@ -488,7 +1387,6 @@ class Field(object):
         'column',
         'type_code',
         'charset',
-        'convert',
         'flags',
     )
 
@@ -546,6 +1444,18 @@ class RowData(object):
         return pkt.read_n_lcs(n_fields)
     decode = staticmethod(decode)
 
+def raw_row_decoder(fields, charset=None):
+    """Build a row decoder returning the undecoded column values
+
+    This is the default for a `Protocol`; the dbapi layer installs
+    `conversions.row_decoder` instead.
+    """
+    n_fields = len(fields)
+    def decode_row(data):
+        """Decode a row into a tuple of bytes/None values"""
+        return tuple(decode_lcs_list(data, 0, n_fields)[0])
+    return decode_row
+
 def scramble(password, message):
     """Generate a hashed password suitable for passing to MySQL 4.1+
 
@@ -562,8 +1472,9 @@ def scramble(password, message):
     stage3.update(stage2)
     stage1 = array.array('B', stage1)
     stage3 = array.array('B', stage3.digest())
-    return array.array('B',
-                       [a ^ b for a, b in zip(stage1, stage3)]).tostring()
+    # array.tostring() is gone in python 3.9
+    return pack('%dB' % len(stage1),
+                *[a ^ b for a, b in zip(stage1, stage3)])
 
 def scramble_323(password, message):
     """Scramble a password in the old (insecure) format"""
@@ -577,9 +1488,9 @@ def scramble_323(password, message):
         add = 7
         nr2 = 0x12345671
 
-        for char in password:
+        for char in bytearray(password):
             # skip whitespace in password
-            if chr(char) in " \t":
+            if char in (32, 9): # ' ', '\t'
                 continue
             tmp = char
             nr ^= (((nr & 63) + add)*tmp) + (nr << 8)
@@ -606,7 +1517,9 @@ def scramble_323(password, message):
     if not password:
         return ''.encode('utf8')
 
-    token = password.encode('utf8')
+    token = password
+    if isinstance(token, unicode):
+        token = token.encode('utf8')
 
     hash_pass = hash_password(token)
     hash_mesg = hash_password(message)
@@ -617,4 +1530,4 @@ def scramble_323(password, message):
     result = [i ^ extra for i in result]
     #result += '\x00'.encode('utf8')
 
-    return pack('8B', result)
+    return pack('8B', *result)
@@ -0,0 +1,146 @@
+"""Queries across a set of sharded servers"""
+
+import heapq
+
+import errors
+from dbapi import paramstyle
+from paramstyle import paramstyles, format_to_qmark
+from multi import fan_out
+
+# rows fetched per server side cursor round trip when merging
+FETCH_SIZE = 1000
+
+class _Reversed(object):
+    """Sort key wrapper inverting the order of the wrapped key"""
+    __slots__ = ('key',)
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+class ShardedExecutor(object):
+    """Run queries on every shard of a sharded table
+
+    ``connections`` are `dbapi.Connection` objects, one per shard.
+    """
+
+    def __init__(self, connections, fetch_size=FETCH_SIZE):
+        self.connections = list(connections)
+        self.fetch_size = fetch_size
+
+    def execute(self, operation, params=(), timeout=None):
+        """Run an operation on all shards in parallel
+
+        :returns: list with the `multi.Result` list of each shard, in shard
+                  order
+        :raises: the first error of any shard, after all shards completed
+        """
+        sql = paramstyles[paramstyle].format(operation, *params or ())
+        outcomes = [None] * len(self.connections)
+        for index, outcome in fan_out(self.connections, sql, timeout):
+            outcomes[index] = outcome
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome
+        return outcomes
+
+    def merge(self, operation, params=(), key=None, reverse=False,
+              limit=None, offset=0):
+        """Run a query on all shards and merge the rows in sorted order
+
+        Each shard must return its rows already sorted by ``key`` (e.g. with
+        a matching ORDER BY clause and, if limit is given, LIMIT
+        offset + limit).  The statement is prepared, executed and its first
+        rows fetched on all shards in parallel: each request is sent to
+        every shard before any reply is read.  The rows are streamed
+        through a k-way heap merge.  Each shard's
+        rows are read through a server side cursor, so once ``limit`` rows
+        have been produced the remaining rows are discarded on the servers
+        instead of being transferred.
+
+        :param key: column index or function computing the sort key of a
+                    row; by default rows are compared as a whole
+        :param reverse: merge rows sorted in descending order
+        :returns: iterator over the merged rows
+        """
+        if key is None:
+            key = lambda row: row
+        elif isinstance(key, (int, long)):
+            column = key
+            key = lambda row: row[column]
+        if reverse:
+            sort_key = lambda row: _Reversed(key(row))
+        else:
+            sort_key = key
+        fetch_size = self.fetch_size
+        if limit is not None:
+            fetch_size = max(1, min(fetch_size, offset + limit))
+
+        sql = format_to_qmark(operation)
+        protocols = [connection.protocol for connection in self.connections]
+        statements = []
+        try:
+            # every request is sent to all shards before any reply is read,
+            # so each step waits for the slowest shard rather than for all
+            # of them in turn
+            for protocol in protocols:
+                protocol.send_prepare(sql)
+            error = None
+            for protocol in protocols:
+                try:
+                    statements.append(protocol.read_prepare())
+                except errors.Error, exc:
+                    statements.append(None)
+                    if error is None:
+                        error = exc
+            if error is not None:
+                raise error
+            for protocol, statement in zip(protocols, statements):
+                protocol.execute(statement, params or (),
+                                 fetch_size=fetch_size)
+            results = []
+            for protocol in protocols:
+                try:
+                    results.append(protocol.nextset())
+                except errors.Error, exc:
+                    results.append(None)
+                    if error is None:
+                        error = exc
+            if error is not None:
+                raise error
+            for result in results:
+                result.send_fetch()
+
+            heap = []
+            for index, result in enumerate(results):
+                rows = result.fetchmany(fetch_size)
+                if rows:
+                    heap.append((sort_key(rows[0]), index, 0, rows))
+            heapq.heapify(heap)
+
+            produced = 0
+            while heap:
+                if limit is not None and produced >= offset + limit:
+                    break
+                sort_value, index, position, rows = heap[0]
+                if produced >= offset:
+                    yield rows[position]
+                produced += 1
+                position += 1
+                if position == len(rows):
+                    rows = results[index].fetchmany(fetch_size)
+                    position = 0
+                if rows:
+                    heapq.heapreplace(heap, (sort_key(rows[position]),
+                                             index, position, rows))
+                else:
+                    heapq.heappop(heap)
+        finally:
+            # closing the statements also closes their server side cursors
+            for protocol, statement in zip(protocols, statements):
+                if statement is not None:
+                    protocol.close_statement(statement)
@@ -1,11 +1,22 @@
-import struct
+import threading
+from collections import OrderedDict
+from struct import Struct, pack
+
+# precompiled decoders for the fixed width integers used by the protocol
+unpack_int8 = Struct('<B').unpack_from
+unpack_int16 = Struct('<H').unpack_from
+unpack_int24 = Struct('<HB').unpack_from
+unpack_int32 = Struct('<I').unpack_from
+unpack_int64 = Struct('<Q').unpack_from
 
 class ByteStream(object):
     """A seekable byte stream
 
-    Expects a data object that provides integer values, such as a
-    py3 byearray or array('B')
+    Expects a memoryview over the packet payload.  Integers are decoded in
+    place with precompiled structs; string values are copied out exactly
+    once.
     """
+    __slots__ = ('index', 'data')
 
     def __init__(self, data):
         self.index = 0
@@ -15,49 +26,43 @@ class ByteStream(object):
         """Read the requested number of bytes from this packet chain"""
         index = self.index
         if n_bytes is None:
-            return self.data[index:]
+            self.index = len(self.data)
+            return self.data[index:].tobytes()
         result = self.data[index:index + n_bytes]
-        result[n_bytes-1]
+        if len(result) != n_bytes:
+            raise IndexError("read past end of packet")
         self.index += n_bytes
-        return result
+        return result.tobytes()
 
     def read_int8(self):
         """Read a 8-bit/one-byte integer from packet"""
-        result = self.data[self.index]
+        result = unpack_int8(self.data, self.index)[0]
         self.index += 1
         return result
 
     def read_int16(self):
         """Read a 16-bit/two-byte integer from packet"""
-        index = self.index
-        self.data[index+1] # index error check
+        result = unpack_int16(self.data, self.index)[0]
         self.index += 2
-        return struct.unpack('<H', self.data[index:index+2])[0]
+        return result
 
     def read_int24(self):
         """Read a 24-bit/3-byte integer from packet"""
-        index = self.index
-        result = self.data[index:index+3]
-        result[2] # length check
-        result.append(0)
+        low, high = unpack_int24(self.data, self.index)
         self.index += 3
-        return struct.unpack('<I', result)[0]
+        return low | high << 16
 
     def read_int32(self):
         """Read a 32-bit/3 byte integer from packet"""
-        index = self.index
-        result = self.data[index:index+4]
-        result[3] # length check
+        result = unpack_int32(self.data, self.index)[0]
         self.index += 4
-        return struct.unpack('<I', result)[0]
+        return result
 
     def read_int64(self):
         """Read a 64-bit/8 byte integer from packet"""
-        index = self.index
-        result = self.data[index:index+8]
-        result[7] # length check
+        result = unpack_int64(self.data, self.index)[0]
         self.index += 8
-        return struct.unpack('<Q', result)[0]
+        return result
 
     def skip(self, n_bytes):
         """Skip the requested number of bytes in packet"""
@@ -65,102 +70,173 @@ class ByteStream(object):
 
     def read_lcb(self):
         """Read length code binary from this packet"""
-        data = self.data
-        index = self.index
-        first = data[index]
-
-        if first == 251: # NULL
-            self.index += 1
-            return None
-
-        if first < 251:
-            self.index += 1
-            return first
-
-        size = first - 250
-        if size < 4:
-            i_bytes = data[index+1:index+size+1]
-            i_bytes[size-1] # length check
-            # pad buffer to 4 bytes for struct.unpack
-            i_bytes.extend([0]*(4 - size))
-            # consume first byte + size bytes (either 2 or 3)
-            self.index += size + 1
-            return struct.unpack('<I', i_bytes)[0]
-        else:
-            # size > 250, but not null and not a 2 or 3 byte int
-            # must be 64-bit integer
-            i_bytes = data[index+1:index+8+1]
-            i_bytes[7] # length check
-            self.index += 8 + 1
-            return struct.unpack('<Q', i_bytes)
+        value, self.index = decode_lcb(self.data, self.index)
+        return value
 
     def read_lcs(self):
         """Read a length coded binary from packet"""
-        data = self.data
-        first = data[self.index]
-        self.index += 1
-
-        if first < 251:
-            size = first
-        elif first == 0xfb: # NULL
+        size = self.read_lcb()
+        if size is None:
             return None
-        elif first == 252:
-            size = self.read_int16()
-        elif first == 253:
-            size = self.read_int24()
-        elif first == 254:
-            size = self.read_int64()
-
-        if size:
-            return self.read(size).tostring()
-
-    # we try to be atomic here, largely for the compressed protocol
-    # XXX: pretty this up
-    def read_n_lcs(self, n_fields):
-        data = self.data
-        index = self.index
-        results = []
-        append = results.append
+        return self.read(size)
 
-        while n_fields:
-            first = data[index]
-            if first == 251: # NULL
-                index += 1
-                n_fields -= 1
-                append(None)
-                continue
+    def read_n_lcs(self, n_fields):
+        """Read ``n_fields`` consecutive length coded strings
 
-            if first < 251:
-                index += 1
-                size = first
-            else:
-                size = first - 250
-                if size < 4:
-                    i_bytes = data[index+1:index+size+1]
-                    i_bytes[size-1] # length check
-                    # pad buffer to 4 bytes for struct.unpack
-                    i_bytes.extend([0]*(4 - size))
-                    # consume first byte + size bytes (either 2 or 3)
-                    index += size + 1
-                    size = struct.unpack('<I', i_bytes)[0]
-                else:
-                    # size > 250, but not null and not a 2 or 3 byte int
-                    # must be 64-bit integer
-                    i_bytes = data[index+1:index+8+1]
-                    i_bytes[7] # length check
-                    index += 8 + 1
-                    size = struct.unpack('<Q', i_bytes)
-
-            data[index+size - 1]
-            index += size
-            append(data[index-size:index].tostring())
-            n_fields -= 1
-        self.index = index
+        Each value is copied straight out of the packet buffer, so every
+        column costs exactly one new object.
+        """
+        results, self.index = decode_lcs_list(self.data, self.index,
+                                              n_fields)
         return results
 
     def read_nullstr(self):
         """Read a null terminated string from this packet"""
-        data = self.data
         index = self.index
-        self.index = data.index(0x00) + 1
-        return self.data[index:self.index - 1].tostring()
+        data = self.data[index:].tobytes()
+        end = data.index('\x00'.encode('utf8'))
+        self.index = index + end + 1
+        return data[:end]
+
+def encode_lcb(value):
+    """Encode an integer as a length coded binary"""
+    if value < 251:
+        return pack('B', value)
+    elif value < 1 << 16:
+        return pack('<BH', 252, value)
+    elif value < 1 << 24:
+        return pack('<BHB', 253, value & 0xffff, value >> 16)
+    return pack('<BQ', 254, value)
+
+def decode_lcb(data, index):
+    """Decode a length coded binary at ``index`` in ``data``
+
+    :returns: tuple of (value, index following the value)
+    """
+    first = unpack_int8(data, index)[0]
+    if first < 251:
+        return first, index + 1
+    elif first == 251: # NULL
+        return None, index + 1
+    elif first == 252:
+        return unpack_int16(data, index + 1)[0], index + 3
+    elif first == 253:
+        low, high = unpack_int24(data, index + 1)
+        return low | high << 16, index + 4
+    else:
+        # must be a 64-bit integer
+        return unpack_int64(data, index + 1)[0], index + 9
+
+def decode_lcs_list(data, index, n_fields):
+    """Decode ``n_fields`` length coded strings from the buffer ``data``
+
+    Values are sliced from a memoryview over ``data`` and copied out once
+    as bytes.
+
+    :returns: tuple of (list of values, index following the last value)
+    """
+    raw = memoryview(data)
+    results = []
+    append = results.append
+    int8 = unpack_int8
+    end = len(raw)
+
+    while n_fields:
+        size = int8(raw, index)[0]
+        index += 1
+        if size >= 251:
+            if size == 251: # NULL
+                append(None)
+                n_fields -= 1
+                continue
+            elif size == 252:
+                size = unpack_int16(raw, index)[0]
+                index += 2
+            elif size == 253:
+                low, high = unpack_int24(raw, index)
+                size = low | high << 16
+                index += 3
+            else:
+                size = unpack_int64(raw, index)[0]
+                index += 8
+        if index + size > end:
+            raise IndexError("read past end of packet")
+        append(raw[index:index + size].tobytes())
+        index += size
+        n_fields -= 1
+    return results, index
+
+class LRUCache(object):
+    """A bounded mapping that discards the least recently used entries
+
+    If given, ``on_evict(key, value)`` is called for every entry pushed out
+    of the cache to make room for a new one.  It is called after the
+    cache's lock is released, so it may use the cache itself.
+
+    The cache is safe to share between threads.
+    """
+
+    def __init__(self, capacity, on_evict=None):
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Look up ``key`` and mark it as most recently used"""
+        self.lock.acquire()
+        try:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """Insert ``key``, evicting the least recently used entries if the
+        cache is full"""
+        evicted = []
+        self.lock.acquire()
+        try:
+            data = self.data
+            data.pop(key, None)
+            data[key] = value
+            while len(data) > self.capacity:
+                evicted.append(data.popitem(last=False))
+        finally:
+            self.lock.release()
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        """Remove ``key`` without calling on_evict"""
+        self.lock.acquire()
+        try:
+            return self.data.pop(key, default)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Remove all entries without calling on_evict"""
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+    def values(self):
+        self.lock.acquire()
+        try:
+            return list(self.data.values())
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,122 @@
+"""Helpers for tests running the protocol against canned server responses"""
+
+import struct
+
+from mysql4py import constants, protocol
+from mysql4py.channel import BufferedChannel
+
+class FakeSocket(object):
+    """In-memory socket; received data arrives in small pieces"""
+    def __init__(self, data=b'', piece=7):
+        self.input = data
+        self.piece = piece
+        self.sent = []
+        self.closed = False
+
+    def recv_into(self, view):
+        n = min(len(view), len(self.input), self.piece)
+        view[0:n] = self.input[:n]
+        self.input = self.input[n:]
+        return n
+
+    def send(self, data):
+        self.sent.append(memoryview(data).tobytes())
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+    def output(self):
+        return b''.join(self.sent)
+
+def make_protocol(data=b'', piece=7):
+    """Create a `protocol.Protocol` ready for commands, reading ``data``
+
+    :returns: tuple of (protocol, socket)
+    """
+    sock = FakeSocket(data, piece)
+    proto = protocol.Protocol(BufferedChannel(sock))
+    proto.state = protocol.STATE_READY
+    return proto, sock
+
+def response(payloads):
+    """Frame the packets of a command response, starting at seqno 1"""
+    return packets(payloads, 1)
+
+def pkt(payload, seqno=0):
+    """Frame ``payload`` as a packet"""
+    return struct.pack('<I', len(payload) | seqno << 24) + payload
+
+def packets(payloads, seqno=0):
+    """Frame consecutive packets"""
+    return b''.join([pkt(payload, seqno + i)
+                     for i, payload in enumerate(payloads)])
+
+def unframe(data):
+    """Split data written by the client into (seqno, payload) tuples"""
+    result = []
+    offset = 0
+    while offset < len(data):
+        i, = struct.unpack('<I', data[offset:offset + 4])
+        size = i & 0xffffff
+        result.append((i >> 24, data[offset + 4:offset + 4 + size]))
+        offset += 4 + size
+    return result
+
+def handshake(capabilities=0xf7ff, salt=b'abcdefgh12345678abcd'):
+    return (b'\x0a5.7.0\x00' + struct.pack('<I', 7) + salt[:8] + b'\x00' +
+            struct.pack('<HBHH', capabilities & 0xffff, 33, 2,
+                        capabilities >> 16) +
+            b'\x15' + b'\x00' * 10 + salt[8:] + b'\x00')
+
+def ok(affected_rows=0, insert_id=0, status=constants.SERVER_STATUS_AUTOCOMMIT):
+    return struct.pack('<BBBHH', 0, affected_rows, insert_id, status, 0)
+
+def eof(status=constants.SERVER_STATUS_AUTOCOMMIT):
+    return struct.pack('<BHH', 0xfe, 0, status)
+
+def error(errno=1064, message=b'You have an error'):
+    return struct.pack('<BH', 0xff, errno) + b'#42000' + message
+
+def lcs(value):
+    if value is None:
+        return b'\xfb'
+    return struct.pack('B', len(value)) + value
+
+def field(name, type_code=constants.FIELD_TYPE_VAR_STRING, flags=0,
+          charset=33):
+    return (b''.join([lcs(part) for part in
+                      [b'def', b'db', b't', b't', name, name]]) +
+            struct.pack('<BHIBHBxx', 0x0c, charset, 11, type_code, flags, 0))
+
+def text_row(values):
+    return b''.join([lcs(value) for value in values])
+
+def resultset(fields, rows, status=constants.SERVER_STATUS_AUTOCOMMIT):
+    """Payloads of a text protocol resultset"""
+    return ([struct.pack('B', len(fields))] + fields + [eof()] +
+            [text_row(row) for row in rows] + [eof(status)])
+
+def stmt_prepared(statement_id, field_count=0, param_count=0):
+    """COM_STMT_PREPARE OK payload"""
+    return struct.pack('<BIHHxH', 0, statement_id, field_count, param_count,
+                       0)
+
+def binary_row(values):
+    """Binary protocol row of LONGLONG values, none of them NULL"""
+    return (b'\x00' + b'\x00' * ((len(values) + 9) // 8) +
+            b''.join([struct.pack('<q', value) for value in values]))
+
+CURSOR_EXISTS = constants.SERVER_STATUS_AUTOCOMMIT | \
+                constants.SERVER_STATUS_CURSOR_EXISTS
+
+def cursor_opened(fields):
+    """Payloads of an execute response opening a server side cursor"""
+    return [struct.pack('B', len(fields))] + fields + [eof(CURSOR_EXISTS)]
+
+def cursor_fetched(rows, last=False):
+    """Payloads of a COM_STMT_FETCH response with LONGLONG ``rows``"""
+    status = CURSOR_EXISTS
+    if last:
+        status |= constants.SERVER_STATUS_LAST_ROW_SENT
+    return [binary_row(row) for row in rows] + [eof(status)]
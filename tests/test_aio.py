@@ -0,0 +1,182 @@
+import unittest
+
+from mysql4py import aio, constants, errors, protocol
+
+from support import pkt, response, unframe, handshake, ok, error, field, \
+                    resultset
+
+MORE = constants.SERVER_STATUS_AUTOCOMMIT | \
+       constants.SERVER_MORE_RESULTS_EXISTS
+
+class FakeTransport(object):
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+        self.paused = False
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def sent(self):
+        """(seqno, payload) of the packets written so far, then forget
+        them"""
+        packets, self.data = unframe(self.data), b''
+        return packets
+
+class AioTest(unittest.TestCase):
+    def setUp(self):
+        if aio.asyncio is None:
+            self.skipTest('asyncio is not available')
+        self.loop = aio.asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def connection(self):
+        connection = aio.Connection(self.loop)
+        transport = FakeTransport()
+        connection.connection_made(transport)
+        connection.engine.state = protocol.STATE_READY
+        return connection, transport
+
+    def test_connect(self):
+        connection = aio.Connection(self.loop)
+        connecting = connection._start('user', None, 'db')
+        transport = FakeTransport()
+        connection.connection_made(transport)
+        connection.data_received(pkt(handshake()))
+        seqno, auth = transport.sent()[0]
+        self.assertEqual(seqno, 1)
+        self.assertTrue(b'user\x00\x00db\x00' in auth)
+        connection.data_received(pkt(ok(), 2))
+        self.assertEqual(transport.sent(), [(0, b'\x03SET autocommit=0')])
+        connection.data_received(response([ok()]))
+        self.assertTrue(self.wait(connecting) is connection)
+
+    def test_authentication_error(self):
+        connection = aio.Connection(self.loop)
+        connecting = connection._start('user', None, None)
+        transport = FakeTransport()
+        connection.connection_made(transport)
+        connection.data_received(pkt(handshake()) +
+                                 pkt(error(1045, b'Access denied'), 2))
+        self.assertRaises(errors.OperationalError, self.wait, connecting)
+        self.assertTrue(transport.closed)
+
+    def test_resultset(self):
+        connection, transport = self.connection()
+        cursor = connection.cursor()
+        executed = cursor.execute('SELECT %s', (1,))
+        self.assertEqual(transport.sent(), [(0, b'\x03SELECT 1')])
+        connection.data_received(response(resultset([field(b'a')],
+                                                    [[b'x'], [None]])))
+        self.assertTrue(self.wait(executed) is cursor)
+        self.assertEqual(cursor.description[0][0], b'a')
+        self.assertEqual(self.wait(cursor.fetchall()), [(u'x',), (None,)])
+        self.assertEqual(self.wait(cursor.fetchone()), None)
+
+    def test_async_iteration(self):
+        connection, transport = self.connection()
+        cursor = connection.cursor()
+        executed = cursor.execute('SELECT a')
+        connection.data_received(response(resultset([field(b'a')],
+                                                    [[b'1'], [b'2']])))
+        self.wait(executed)
+        rows = cursor.__aiter__()
+        self.assertEqual(self.wait(rows.__anext__()), (u'1',))
+        self.assertEqual(self.wait(rows.__anext__()), (u'2',))
+        self.assertRaises(StopAsyncIteration, self.wait, rows.__anext__())
+
+    def test_rows_arriving_later(self):
+        connection, transport = self.connection()
+        cursor = connection.cursor()
+        data = response(resultset([field(b'a')], [[b'1'], [b'2']]))
+        executed = cursor.execute('SELECT a')
+        connection.data_received(data[:-20])
+        self.wait(executed)
+        fetched = cursor.fetchall()
+        self.loop.call_soon(connection.data_received, data[-20:])
+        self.assertEqual(self.wait(fetched), [(u'1',), (u'2',)])
+
+    def test_flow_control(self):
+        connection, transport = self.connection()
+        size = aio.ROW_BUFFER_SIZE
+        aio.ROW_BUFFER_SIZE = 4
+        try:
+            cursor = connection.cursor()
+            executed = cursor.execute('SELECT a')
+            data = response(resultset([field(b'a')], [[b'1']] * 10))
+            # all rows but not the final EOF packet
+            connection.data_received(data[:-9])
+            self.wait(executed)
+            self.assertTrue(transport.paused)
+            self.assertEqual(len(self.wait(cursor.fetchmany(9))), 9)
+            self.assertFalse(transport.paused)
+            connection.data_received(data[-9:])
+            self.assertEqual(len(self.wait(cursor.fetchall())), 1)
+        finally:
+            aio.ROW_BUFFER_SIZE = size
+
+    def test_multiple_results(self):
+        connection, transport = self.connection()
+        cursor = connection.cursor()
+        executed = cursor.execute('UPDATE t SET a = 1; SELECT a')
+        connection.data_received(response(
+            [ok(3, status=MORE)] + resultset([field(b'a')], [[b'1']])))
+        self.wait(executed)
+        self.assertEqual(cursor.rowcount, 3)
+        self.assertEqual(self.wait(cursor.nextset()), True)
+        self.assertEqual(self.wait(cursor.fetchall()), [(u'1',)])
+        self.assertEqual(self.wait(cursor.nextset()), None)
+
+    def test_commands_wait_for_previous_results(self):
+        connection, transport = self.connection()
+        first = connection.query('SELECT a')
+        second = connection.query('DO 1')
+        self.assertEqual(transport.sent(), [(0, b'\x03SELECT a')])
+        data = response(resultset([field(b'a')], [[b'1']] * 3))
+        connection.data_received(data[:-9])
+        result = self.wait(first)
+        self.assertEqual(transport.sent(), [])
+        # the unread rows are dropped to send the next command
+        connection.data_received(data[-9:])
+        self.assertEqual(transport.sent(), [(0, b'\x03DO 1')])
+        self.assertEqual(self.wait(result.fetchmany()), [])
+        connection.data_received(response([ok()]))
+        self.assertEqual(self.wait(second).affected_rows, 0)
+
+    def test_server_error(self):
+        connection, transport = self.connection()
+        executed = connection.cursor().execute('SELEC 1')
+        connection.data_received(response([error()]))
+        self.assertRaises(errors.ProgrammingError, self.wait, executed)
+        # the connection is ready for the next command
+        pinged = connection.ping()
+        self.assertEqual(transport.sent()[-1], (0, b'\x0e'))
+        connection.data_received(response([ok()]))
+        self.assertTrue(self.wait(pinged))
+
+    def test_connection_lost(self):
+        connection, transport = self.connection()
+        executed = connection.query('SELECT 1')
+        connection.connection_lost(None)
+        self.assertRaises(errors.OperationalError, self.wait, executed)
+        self.wait(connection.close())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from mysql4py.channel import BufferedChannel
+
+class FakeSocket(object):
+    """Socket without sendmsg() recording each send() call"""
+    def __init__(self, max_send=None):
+        self.sent = []
+        self.max_send = max_send
+
+    def recv_into(self, view):
+        return 0
+
+    def send(self, data):
+        data = memoryview(data).tobytes()
+        if self.max_send is not None:
+            data = data[:self.max_send]
+        self.sent.append(data)
+        return len(data)
+
+class WritevFallbackTest(unittest.TestCase):
+    def test_small_buffers_are_joined(self):
+        sock = FakeSocket()
+        channel = BufferedChannel(sock)
+        size = channel.writev([b'\x05\x00\x00\x00', b'\x03SELE'])
+        self.assertEqual(size, 9)
+        self.assertEqual(sock.sent, [b'\x05\x00\x00\x00\x03SELE'])
+
+    def test_large_buffers_are_sent_alone(self):
+        sock = FakeSocket()
+        channel = BufferedChannel(sock)
+        channel.JOIN_THRESHOLD = 8
+        payload = b'x' * 20
+        channel.writev([b'head', payload, b'ab', b'cd'])
+        self.assertEqual(sock.sent, [b'head', payload, b'abcd'])
+
+    def test_partial_sends(self):
+        sock = FakeSocket(max_send=3)
+        channel = BufferedChannel(sock)
+        self.assertEqual(channel.writev([b'abcd', b'efgh']), 8)
+        self.assertEqual(b''.join(sock.sent), b'abcdefgh')
+
+if __name__ == '__main__':
+    unittest.main()
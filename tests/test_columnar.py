@@ -0,0 +1,52 @@
+import unittest
+
+from mysql4py import columnar, constants
+from mysql4py.protocol import Field
+
+def make_field(type_code, flags=0):
+    return Field(schema='db', table='t', column='c', type_code=type_code,
+                 charset=33, flags=flags)
+
+class ColumnTest(unittest.TestCase):
+    def test_integer_column(self):
+        column = columnar.make_column(make_field(constants.FIELD_TYPE_LONG))
+        for value in [b'-1', None, b'3']:
+            column.append(value)
+        self.assertEqual(column.values.typecode, 'i')
+        self.assertEqual(len(column), 3)
+        self.assertEqual(column.null_count, 1)
+        self.assertEqual([column[i] for i in range(3)], [-1, None, 3])
+
+    def test_unsigned_bigint_column(self):
+        column = columnar.make_column(make_field(
+                                        constants.FIELD_TYPE_LONGLONG,
+                                        constants.UNSIGNED_FLAG))
+        column.append(b'18446744073709551615')
+        self.assertEqual(column.values.typecode, columnar.UINT64)
+        self.assertEqual(column[0], 18446744073709551615)
+
+    def test_float_column(self):
+        column = columnar.make_column(make_field(constants.FIELD_TYPE_DOUBLE))
+        column.append(b'2.5')
+        self.assertEqual(column[0], 2.5)
+
+    def test_binary_column(self):
+        column = columnar.make_column(
+                    make_field(constants.FIELD_TYPE_VAR_STRING))
+        for value in [b'ab', None, b'', b'cde']:
+            column.append(value)
+        self.assertEqual(bytes(column.data), b'abcde')
+        self.assertEqual(list(column.offsets), [0, 2, 2, 2, 5])
+        self.assertEqual([column[i] for i in range(4)],
+                         [b'ab', None, b'', b'cde'])
+
+    def test_null_bitmap_spans_bytes(self):
+        column = columnar.make_column(make_field(constants.FIELD_TYPE_LONG))
+        for i in range(10):
+            column.append(i % 3 and b'1' or None)
+        self.assertEqual(len(column.nulls), 2)
+        self.assertEqual([column.is_null(i) for i in range(10)],
+                         [i % 3 == 0 for i in range(10)])
+
+if __name__ == '__main__':
+    unittest.main()
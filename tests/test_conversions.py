@@ -0,0 +1,263 @@
+import datetime
+import struct
+import unittest
+from decimal import Decimal
+
+from mysql4py import constants, conversions
+from mysql4py.protocol import Field, raw_row_decoder
+from mysql4py.util import encode_lcb
+
+def make_field(type_code, name='c', charset=33, flags=0):
+    return Field(schema='db', table='t', column=name, type_code=type_code,
+                 charset=charset, flags=flags)
+
+def text_row(values):
+    data = b''
+    for value in values:
+        if value is None:
+            data += b'\xfb'
+        else:
+            data += encode_lcb(len(value)) + value
+    return memoryview(data)
+
+class RowDecoderTest(unittest.TestCase):
+    def test_types(self):
+        fields = [make_field(constants.FIELD_TYPE_LONG),
+                  make_field(constants.FIELD_TYPE_NEWDECIMAL),
+                  make_field(constants.FIELD_TYPE_DOUBLE),
+                  make_field(constants.FIELD_TYPE_VAR_STRING),
+                  make_field(constants.FIELD_TYPE_BLOB, charset=63),
+                  make_field(constants.FIELD_TYPE_DATETIME),
+                  make_field(constants.FIELD_TYPE_TIME),
+                  make_field(constants.FIELD_TYPE_SET)]
+        decode_row = conversions.row_decoder(fields)
+        row = decode_row(text_row([b'-12', b'1.50', b'2.5',
+                                   u'caf\xe9'.encode('utf8'), b'\x00\xff',
+                                   b'2020-01-02 03:04:05', b'10:20:30',
+                                   b'a,b']))
+        self.assertEqual(row, (-12, Decimal('1.50'), 2.5, u'caf\xe9',
+                               b'\x00\xff',
+                               datetime.datetime(2020, 1, 2, 3, 4, 5),
+                               datetime.timedelta(hours=10, minutes=20,
+                                                  seconds=30),
+                               [u'a', u'b']))
+
+    def test_null_and_long_values(self):
+        fields = [make_field(constants.FIELD_TYPE_LONG),
+                  make_field(constants.FIELD_TYPE_VAR_STRING),
+                  make_field(constants.FIELD_TYPE_BLOB)]
+        decode_row = conversions.row_decoder(fields)
+        long_value = b'x' * 70000
+        self.assertEqual(decode_row(text_row([None, None, long_value])),
+                         (None, None, long_value))
+
+    def test_charset(self):
+        decode_row = conversions.row_decoder(
+                        [make_field(constants.FIELD_TYPE_VAR_STRING)],
+                        charset='latin1')
+        self.assertEqual(decode_row(text_row([b'caf\xe9'])), (u'caf\xe9',))
+
+    def test_truncated_row(self):
+        decode_row = conversions.row_decoder(
+                        [make_field(constants.FIELD_TYPE_LONG)] * 2)
+        self.assertRaises(IndexError, decode_row, memoryview(b'\x011\x0512'))
+
+    def test_no_columns(self):
+        self.assertEqual(conversions.row_decoder([])(memoryview(b'')), ())
+
+    def test_raw_row_decoder(self):
+        decode_row = raw_row_decoder([make_field(constants.FIELD_TYPE_LONG),
+                                      make_field(constants.FIELD_TYPE_LONG)])
+        self.assertEqual(decode_row(text_row([b'1', None])), (b'1', None))
+
+def binary_row(nulls, values):
+    """Binary protocol row: header, NULL bitmap and encoded values"""
+    n_columns = len(nulls)
+    bitmap = bytearray((n_columns + 7 + 2) // 8)
+    for n, null in enumerate(nulls):
+        if null:
+            bitmap[(n + 2) >> 3] |= 1 << ((n + 2) & 7)
+    return memoryview(b'\x00' + bytes(bitmap) + b''.join(values))
+
+class BinaryRowDecoderTest(unittest.TestCase):
+    def test_fixed_width_types(self):
+        fields = [make_field(constants.FIELD_TYPE_TINY),
+                  make_field(constants.FIELD_TYPE_SHORT,
+                             flags=constants.UNSIGNED_FLAG),
+                  make_field(constants.FIELD_TYPE_LONG),
+                  make_field(constants.FIELD_TYPE_LONGLONG,
+                             flags=constants.UNSIGNED_FLAG),
+                  make_field(constants.FIELD_TYPE_DOUBLE)]
+        decode_row = conversions.binary_row_decoder(fields)
+        row = decode_row(binary_row([False] * 5,
+                                    [struct.pack('<b', -1),
+                                     struct.pack('<H', 65535),
+                                     struct.pack('<i', -7),
+                                     struct.pack('<Q', 2 ** 64 - 1),
+                                     struct.pack('<d', 0.5)]))
+        self.assertEqual(row, (-1, 65535, -7, 2 ** 64 - 1, 0.5))
+
+    def test_nulls(self):
+        # enough columns for the bitmap to span two bytes
+        fields = [make_field(constants.FIELD_TYPE_LONG)] * 8
+        nulls = [n % 3 == 0 for n in range(8)]
+        values = [struct.pack('<i', n) for n in range(8) if not nulls[n]]
+        row = conversions.binary_row_decoder(fields)(binary_row(nulls,
+                                                                values))
+        self.assertEqual(row, tuple([not null and n or None
+                                     for n, null in enumerate(nulls)]))
+
+    def test_temporal_types(self):
+        fields = [make_field(constants.FIELD_TYPE_DATE),
+                  make_field(constants.FIELD_TYPE_DATETIME),
+                  make_field(constants.FIELD_TYPE_DATETIME),
+                  make_field(constants.FIELD_TYPE_TIMESTAMP),
+                  make_field(constants.FIELD_TYPE_TIME),
+                  make_field(constants.FIELD_TYPE_TIME)]
+        decode_row = conversions.binary_row_decoder(fields)
+        row = decode_row(binary_row([False] * 6, [
+                    struct.pack('<BHBB', 4, 2020, 1, 2),
+                    struct.pack('<BHBBBBB', 7, 2020, 1, 2, 3, 4, 5),
+                    struct.pack('<BHBBBBBI', 11, 2020, 1, 2, 3, 4, 5, 6),
+                    b'\x00',
+                    struct.pack('<BBIBBB', 8, 1, 1, 2, 3, 4),
+                    struct.pack('<BBIBBBI', 12, 0, 0, 2, 3, 4, 5)]))
+        self.assertEqual(row, (
+            datetime.datetime(2020, 1, 2),
+            datetime.datetime(2020, 1, 2, 3, 4, 5),
+            datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+            None,
+            -datetime.timedelta(days=1, hours=2, minutes=3, seconds=4),
+            datetime.timedelta(hours=2, minutes=3, seconds=4,
+                               microseconds=5)))
+
+    def test_length_coded_types(self):
+        fields = [make_field(constants.FIELD_TYPE_VAR_STRING),
+                  make_field(constants.FIELD_TYPE_BLOB, charset=63),
+                  make_field(constants.FIELD_TYPE_NEWDECIMAL)]
+        decode_row = conversions.binary_row_decoder(fields)
+        row = decode_row(binary_row([False] * 3,
+                                    [b'\x05caf\xc3\xa9', b'\x02\x00\xff',
+                                     b'\x041.50']))
+        self.assertEqual(row, (u'caf\xe9', b'\x00\xff', Decimal('1.50')))
+
+    def test_truncated_row(self):
+        decode_row = conversions.binary_row_decoder(
+                        [make_field(constants.FIELD_TYPE_LONGLONG)])
+        self.assertRaises((struct.error, IndexError), decode_row,
+                          binary_row([False], [b'\x01\x02']))
+
+class EncodeBinaryParamTest(unittest.TestCase):
+    def test_integers(self):
+        encode = conversions.encode_binary_param
+        self.assertEqual(encode(-1),
+                         (constants.FIELD_TYPE_LONGLONG, 0, b'\xff' * 8))
+        self.assertEqual(encode(-2 ** 63),
+                         (constants.FIELD_TYPE_LONGLONG, 0,
+                          b'\x00' * 7 + b'\x80'))
+        self.assertEqual(encode(2 ** 64 - 1),
+                         (constants.FIELD_TYPE_LONGLONG, 0x80, b'\xff' * 8))
+
+    def test_integers_beyond_64_bits(self):
+        encode = conversions.encode_binary_param
+        self.assertEqual(encode(2 ** 64),
+                         (constants.FIELD_TYPE_NEWDECIMAL, 0,
+                          b'\x1418446744073709551616'))
+        self.assertEqual(encode(-2 ** 63 - 1),
+                         (constants.FIELD_TYPE_NEWDECIMAL, 0,
+                          b'\x14-9223372036854775809'))
+
+    def test_strings(self):
+        encode = conversions.encode_binary_param
+        self.assertEqual(encode(u'caf\xe9'),
+                         (constants.FIELD_TYPE_VAR_STRING, 0,
+                          b'\x05caf\xc3\xa9'))
+        self.assertEqual(encode(bytearray(b'\x00\x01')),
+                         (constants.FIELD_TYPE_BLOB, 0, b'\x02\x00\x01'))
+        self.assertEqual(encode(memoryview(b'\x00\x01')),
+                         (constants.FIELD_TYPE_BLOB, 0, b'\x02\x00\x01'))
+        if bytes is str:
+            # python 2 byte strings are text, as in the text protocol
+            self.assertEqual(encode(b'abc'),
+                             (constants.FIELD_TYPE_VAR_STRING, 0, b'\x03abc'))
+        else:
+            self.assertEqual(encode(b'abc'),
+                             (constants.FIELD_TYPE_BLOB, 0, b'\x03abc'))
+
+    def test_other_types(self):
+        encode = conversions.encode_binary_param
+        self.assertEqual(encode(1.5),
+                         (constants.FIELD_TYPE_DOUBLE, 0,
+                          struct.pack('<d', 1.5)))
+        self.assertEqual(encode(Decimal('-1.50')),
+                         (constants.FIELD_TYPE_NEWDECIMAL, 0, b'\x05-1.50'))
+        self.assertEqual(encode(datetime.datetime(2020, 1, 2, 3, 4, 5, 6)),
+                         (constants.FIELD_TYPE_DATETIME, 0,
+                          struct.pack('<BHBBBBBI', 11, 2020, 1, 2, 3, 4, 5,
+                                      6)))
+        self.assertEqual(encode(datetime.date(2020, 1, 2)),
+                         (constants.FIELD_TYPE_DATE, 0,
+                          struct.pack('<BHBB', 4, 2020, 1, 2)))
+        self.assertEqual(encode(-datetime.timedelta(days=1, seconds=1)),
+                         (constants.FIELD_TYPE_TIME, 0,
+                          struct.pack('<BBIBBBI', 12, 1, 1, 0, 0, 1, 0)))
+        self.assertRaises(TypeError, encode, object())
+
+class Text(type(u'')):
+    pass
+
+class OldStyle:
+    pass
+
+class TsvTest(unittest.TestCase):
+    def test_fields(self):
+        encode = conversions.encode_tsv_field
+        self.assertEqual(encode(None), b'\\N')
+        self.assertEqual(encode(True), b'1')
+        self.assertEqual(encode(-12), b'-12')
+        self.assertEqual(encode(0.5), b'0.5')
+        self.assertEqual(encode(Decimal('1.50')), b'1.50')
+        self.assertEqual(encode(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                         b'2020-01-02 03:04:05')
+        self.assertEqual(encode(datetime.date(2020, 1, 2)), b'2020-01-02')
+        self.assertEqual(encode(-datetime.timedelta(hours=25)),
+                         b'-25:00:00')
+
+    def test_escapes(self):
+        encode = conversions.encode_tsv_field
+        self.assertEqual(encode(b'a\tb\nc\\d\x00\r'),
+                         b'a\\tb\\nc\\\\d\\0\\r')
+        self.assertEqual(encode(u'caf\xe9\t'), b'caf\xc3\xa9\\t')
+        self.assertEqual(encode(u'caf\xe9', 'latin1'), b'caf\xe9')
+        self.assertEqual(encode(bytearray(b'\\N')), b'\\\\N')
+
+    def test_subclasses(self):
+        encode = conversions.encode_tsv_field
+        self.assertEqual(encode(Text(u'a\tb')), b'a\\tb')
+        self.assertRaises(TypeError, encode, object())
+        self.assertRaises(TypeError, encode, OldStyle())
+
+    def test_chunks(self):
+        rows = [(1, u'a'), (2, None), (3, b'c\td')]
+        self.assertEqual(list(conversions.tsv_chunks(rows)),
+                         [b'1\ta\n2\t\\N\n3\tc\\td\n'])
+        # each line is 4 bytes; a chunk holds two of them
+        chunks = list(conversions.tsv_chunks([(n, n) for n in range(5)],
+                                             chunk_size=9))
+        self.assertEqual(chunks, [b'0\t0\n1\t1\n', b'2\t2\n3\t3\n',
+                                  b'4\t4\n'])
+        # a line longer than chunk_size is a chunk of its own
+        self.assertEqual(list(conversions.tsv_chunks([(b'x' * 20,), (1,)],
+                                                     chunk_size=8)),
+                         [b'x' * 20 + b'\n', b'1\n'])
+        self.assertEqual(list(conversions.tsv_chunks([])), [])
+
+    def test_chunks_are_lazy(self):
+        def rows():
+            yield (1,)
+            raise ValueError('stop')
+        chunks = conversions.tsv_chunks(rows())
+        self.assertRaises(ValueError, list, chunks)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import struct
+import sys
+import unittest
+
+from mysql4py import constants, errors, protocol
+from mysql4py.dbapi import Cursor, BufferedCursor, ServerSideCursor
+
+from support import make_protocol, response, unframe, ok, eof, error, \
+                    field, resultset, stmt_prepared, binary_row, \
+                    cursor_opened, cursor_fetched
+
+MORE = constants.SERVER_STATUS_AUTOCOMMIT | \
+       constants.SERVER_MORE_RESULTS_EXISTS
+
+class ConnectionStub(object):
+    charset = 'utf8'
+
+    def __init__(self, data, max_allowed_packet=1024):
+        self.protocol, self.socket = make_protocol(data)
+        self.packet_size = max_allowed_packet
+
+    def max_allowed_packet(self):
+        return self.packet_size
+
+    def sent(self):
+        """Payloads of the commands sent so far"""
+        return [payload for seqno, payload in unframe(self.socket.output())]
+
+class ExecuteManyTest(unittest.TestCase):
+    def test_multi_row_insert(self):
+        connection = ConnectionStub(response([ok(2)]))
+        cursor = Cursor(connection)
+        cursor.executemany("INSERT INTO t (a, b) /* 100%% */ VALUES (%s, %s) "
+                           "ON DUPLICATE KEY UPDATE b = '50%%'",
+                           [(1, 'a'), (2, 'b')])
+        self.assertEqual(connection.sent(),
+                         [b"\x03INSERT INTO t (a, b) /* 100% */ VALUES "
+                          b"(1, 'a'),(2, 'b') "
+                          b"ON DUPLICATE KEY UPDATE b = '50%'"])
+        self.assertEqual(cursor.rowcount, 2)
+
+    def test_split_by_packet_size(self):
+        connection = ConnectionStub(response([ok(2)]) + response([ok(1)]),
+                                    max_allowed_packet=34)
+        cursor = Cursor(connection)
+        cursor.executemany('INSERT INTO t VALUES (%s)', [(1,), (22,), (333,)])
+        self.assertEqual(connection.sent(),
+                         [b'\x03INSERT INTO t VALUES (1),(22)',
+                          b'\x03INSERT INTO t VALUES (333)'])
+        self.assertEqual(cursor.rowcount, 3)
+
+class ExecuteBatchTest(unittest.TestCase):
+    def test_results(self):
+        connection = ConnectionStub(
+                        response([ok(1, status=MORE)] +
+                                 resultset([field(b'a')], [[b'x'], [b'y']])))
+        results = Cursor(connection).execute_batch(
+                    ['UPDATE t SET a = 1;', ('SELECT %s', (2,))])
+        self.assertEqual(connection.sent(),
+                         [b'\x03UPDATE t SET a = 1;SELECT 2'])
+        self.assertEqual([(result.index, result.rowcount)
+                          for result in results], [(0, 1), (1, 2)])
+        self.assertEqual(list(results[1].rows), [(b'x',), (b'y',)])
+
+    def test_all_statements_sent_when_results_are_ignored(self):
+        connection = ConnectionStub(response([ok(1)]) + response([ok(1)]),
+                                    max_allowed_packet=20)
+        Cursor(connection).execute_batch(['UPDATE t SET a = 1',
+                                          'UPDATE t SET a = 2'])
+        self.assertEqual(len(connection.sent()), 2)
+
+    def test_stream_in_sync_after_error(self):
+        connection = ConnectionStub(response([ok(1, status=MORE),
+                                              error(1146)]) +
+                                    response([ok(3)]))
+        cursor = Cursor(connection)
+        try:
+            cursor.execute_batch(['UPDATE t SET a = 1',
+                                  'UPDATE missing SET a = 1',
+                                  'UPDATE t SET a = 2'])
+        except errors.BatchError:
+            exc = sys.exc_info()[1]
+        else:
+            self.fail('BatchError not raised')
+        self.assertEqual(exc.index, 1)
+        self.assertEqual(exc.args[0], 1146)
+        # the connection is ready for the next command and reads its own
+        # response
+        cursor.execute('UPDATE t SET a = 3')
+        self.assertEqual(cursor.rowcount, 3)
+
+class FetchTest(unittest.TestCase):
+    def execute(self, n_rows):
+        connection = ConnectionStub(
+                        response(resultset([field(b'a')],
+                                           [[str(n).encode('ascii')]
+                                            for n in range(n_rows)])))
+        cursor = Cursor(connection)
+        cursor.execute('SELECT a FROM t')
+        return connection, cursor
+
+    def test_fetchmany_uses_arraysize(self):
+        connection, cursor = self.execute(5)
+        self.assertEqual(cursor.fetchmany(), [(b'0',)])
+        cursor.arraysize = 3
+        self.assertEqual(cursor.fetchmany(), [(b'1',), (b'2',), (b'3',)])
+        self.assertEqual(cursor.fetchmany(2), [(b'4',)])
+        self.assertEqual(connection.protocol.state, protocol.STATE_READY)
+        self.assertEqual(cursor.fetchmany(), [])
+        self.assertEqual(cursor.fetchmany(2), [])
+
+    def test_next(self):
+        connection, cursor = self.execute(2)
+        self.assertEqual(cursor.next(), (b'0',))
+        self.assertEqual(cursor.next(), (b'1',))
+        self.assertRaises(StopIteration, cursor.next)
+
+class BufferedCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = ConnectionStub(
+                            response(resultset([field(b'a')],
+                                               [[b'x'], [b'y'], [b'z']])) +
+                            response([ok(1)]))
+        self.decoded = []
+        def row_decoder(fields, charset):
+            decode_row = protocol.raw_row_decoder(fields, charset)
+            def decode(data):
+                row = decode_row(data)
+                self.decoded.append(row)
+                return row
+            return decode
+        self.connection.protocol.row_decoder = row_decoder
+        self.cursor = BufferedCursor(self.connection)
+        self.cursor.execute('SELECT a FROM t')
+
+    def test_rows_are_stored(self):
+        self.assertEqual(self.cursor.rowcount, 3)
+        self.assertEqual(len(self.cursor), 3)
+        # the connection is free for the next command
+        self.assertEqual(self.connection.protocol.state,
+                         protocol.STATE_READY)
+        other = Cursor(self.connection)
+        other.execute('UPDATE t SET a = 1')
+        self.assertEqual(other.rowcount, 1)
+        self.assertEqual(self.cursor.fetchall(), [(b'x',), (b'y',), (b'z',)])
+
+    def test_rows_are_decoded_when_fetched(self):
+        self.assertEqual(self.decoded, [])
+        self.assertEqual(self.cursor.fetchone(), (b'x',))
+        self.assertEqual(self.decoded, [(b'x',)])
+        self.assertEqual(self.cursor[2], (b'z',))
+        self.assertEqual(self.decoded, [(b'x',), (b'z',)])
+
+    def test_scroll(self):
+        cursor = self.cursor
+        cursor.scroll(2)
+        self.assertEqual(cursor.rownumber, 2)
+        self.assertEqual(cursor.fetchone(), (b'z',))
+        cursor.scroll(-2)
+        self.assertEqual(cursor.fetchone(), (b'y',))
+        cursor.scroll(0, mode='absolute')
+        self.assertEqual(cursor.fetchmany(2), [(b'x',), (b'y',)])
+        # the position after the last row is valid
+        cursor.scroll(3, mode='absolute')
+        self.assertEqual(cursor.fetchone(), None)
+        self.assertRaises(IndexError, cursor.scroll, 1)
+        self.assertRaises(IndexError, cursor.scroll, -1, mode='absolute')
+        self.assertRaises(IndexError, cursor.scroll, -4)
+        self.assertEqual(cursor.rownumber, 3)
+        self.assertRaises(errors.ProgrammingError, cursor.scroll, 0,
+                          mode='sideways')
+
+    def test_random_access(self):
+        self.assertEqual(self.cursor[-1], (b'z',))
+        self.assertRaises(IndexError, self.cursor.__getitem__, 3)
+        self.assertRaises(IndexError, self.cursor.__getitem__, -4)
+        # indexing does not move the position
+        self.assertEqual(self.cursor.rownumber, 0)
+
+ID = field(b'id', constants.FIELD_TYPE_LONGLONG)
+
+def fetch(rows):
+    return struct.pack('<BII', constants.COM_STMT_FETCH, 1, rows)
+
+class ServerSideCursorTest(unittest.TestCase):
+    def execute(self, data, fetch_size=2):
+        connection = ConnectionStub(response([stmt_prepared(1, 1), ID,
+                                              eof()]) + data)
+        cursor = ServerSideCursor(connection)
+        cursor.fetch_size = fetch_size
+        cursor.execute('SELECT id FROM t')
+        del connection.socket.sent[:]
+        return connection, cursor
+
+    def test_rows_are_fetched_in_chunks(self):
+        connection, cursor = self.execute(
+                                response(cursor_opened([ID])) +
+                                response(cursor_fetched([[1], [2]])) +
+                                response(cursor_fetched([[3]], last=True)))
+        self.assertEqual(connection.protocol.state, protocol.STATE_READY)
+        self.assertEqual(connection.sent(), [])
+        self.assertEqual(cursor.fetchone(), (1,))
+        self.assertEqual(connection.sent(), [fetch(2)])
+        # the rest of the chunk is served without a round trip
+        self.assertEqual(cursor.fetchone(), (2,))
+        self.assertEqual(cursor.fetchmany(5), [(3,)])
+        self.assertEqual(connection.sent(), [fetch(2), fetch(2)])
+        # the server reported the last row; nothing more is requested
+        self.assertEqual(cursor.fetchmany(5), [])
+        self.assertEqual(cursor.fetchone(), None)
+        self.assertEqual(len(connection.sent()), 2)
+
+    def test_cursor_closed_by_server(self):
+        # without SERVER_STATUS_CURSOR_EXISTS the cursor is gone as well
+        connection, cursor = self.execute(
+                                response(cursor_opened([ID])) +
+                                response([binary_row([1]), eof()]))
+        self.assertEqual(cursor.fetchall(), [(1,)])
+        self.assertEqual(cursor.fetchall(), [])
+        self.assertEqual(connection.sent(), [fetch(2)])
+
+    def test_no_cursor_opened(self):
+        # the rows of statements the server cannot open a cursor for
+        # follow right away
+        connection, cursor = self.execute(
+                                response([b'\x01', ID, eof(),
+                                          binary_row([1]), binary_row([2]),
+                                          eof()]))
+        self.assertEqual(cursor.fetchall(), [(1,), (2,)])
+        self.assertEqual(connection.sent(), [])
+        self.assertEqual(connection.protocol.state, protocol.STATE_READY)
+
+    def test_commands_between_fetches(self):
+        connection, cursor = self.execute(
+                                response(cursor_opened([ID])) +
+                                response(cursor_fetched([[1], [2]])) +
+                                response(resultset([field(b'a')], [[b'x']])) +
+                                response(cursor_fetched([[3]], last=True)))
+        self.assertEqual(cursor.fetchmany(2), [(1,), (2,)])
+        other = Cursor(connection)
+        other.execute('SELECT a FROM u')
+        self.assertEqual(other.fetchall(), [(b'x',)])
+        self.assertEqual(cursor.fetchall(), [(3,)])
+        self.assertEqual(connection.sent(),
+                         [fetch(2), b'\x03SELECT a FROM u', fetch(2)])
+
+    def test_close_releases_statement(self):
+        connection, cursor = self.execute(response(cursor_opened([ID])))
+        cursor.close()
+        self.assertEqual(connection.sent(),
+                         [struct.pack('<BI', constants.COM_STMT_CLOSE, 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import struct
+import unittest
+
+from mysql4py import constants, errors, packet, protocol
+from mysql4py.engine import Engine, PacketParser, ResultHeader, Row, \
+                            OldPasswordRequest, LocalInfileRequest, \
+                            STATE_LOCAL_INFILE
+
+from support import pkt, packets, response, unframe, handshake, ok, eof, \
+                    error, field, resultset
+
+class PacketParserTest(unittest.TestCase):
+    def test_partial_data(self):
+        parser = PacketParser()
+        data = packets([b'abc', b'', b'defg'])
+        packets_read = []
+        for n in range(len(data)):
+            parser.feed(data[n:n + 1])
+            result = parser.next_packet()
+            while result is not None:
+                packets_read.append((result.seqno, result.data.tobytes()))
+                result = parser.next_packet()
+        self.assertEqual(packets_read, [(0, b'abc'), (1, b''), (2, b'defg')])
+
+    def test_continuation_packets(self):
+        parser = PacketParser()
+        payload = b'x' * packet.MAX_PAYLOAD_SIZE + b'tail'
+        buffers, seqno = packet.split_payload(payload, 3)
+        data = b''.join([memoryview(buf).tobytes() for buf in buffers])
+        parser.feed(data[:-1])
+        self.assertTrue(parser.next_packet() is None)
+        parser.feed(data[-1:] + pkt(b'next', 5))
+        result = parser.next_packet()
+        self.assertEqual(result.seqno, 4)
+        self.assertEqual(len(result.data), len(payload))
+        self.assertEqual(result.data[-4:].tobytes(), b'tail')
+        self.assertEqual(parser.next_packet().data.tobytes(), b'next')
+
+class EngineTest(unittest.TestCase):
+    def connect(self):
+        engine = Engine()
+        engine.receive_data(pkt(handshake()))
+        info = engine.next_event()
+        self.assertTrue(isinstance(info, protocol.Handshake))
+        auth = unframe(engine.authenticate('user', b'secret', 'db'))
+        self.assertEqual(auth[0][0], 1)
+        flags, = struct.unpack('<I', auth[0][1][:4])
+        self.assertEqual(flags, protocol.client_flags(0xf7ff))
+        self.assertFalse(flags & constants.CLIENT_COMPRESS)
+        return engine
+
+    def test_authenticate(self):
+        engine = self.connect()
+        engine.receive_data(pkt(ok(), 2))
+        self.assertTrue(isinstance(engine.next_event(), protocol.OK))
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_authentication_error(self):
+        engine = self.connect()
+        engine.receive_data(pkt(error(1045, b'Access denied'), 2))
+        event = engine.next_event()
+        self.assertTrue(isinstance(event, errors.DatabaseError))
+        self.assertEqual(event.args[0], 1045)
+        self.assertEqual(engine.state, protocol.STATE_AUTH)
+        self.assertRaises(errors.InterfaceError, engine.query, 'SELECT 1')
+
+    def test_old_password(self):
+        engine = self.connect()
+        # a pre-4.1 server asks for the old password with a bare 0xfe
+        engine.receive_data(pkt(b'\xfe', 2))
+        self.assertTrue(isinstance(engine.next_event(), OldPasswordRequest))
+        self.assertEqual(engine.state, protocol.STATE_AUTH)
+        self.assertEqual(unframe(engine.old_password(b'secret')),
+                         [(3, protocol.scramble_323(b'secret',
+                                                    b'abcdefgh'))])
+        engine.receive_data(pkt(ok(), 4))
+        self.assertTrue(isinstance(engine.next_event(), protocol.OK))
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_resultset(self):
+        engine = Engine()
+        engine.state = protocol.STATE_READY
+        self.assertEqual(unframe(engine.query('SELECT a')),
+                         [(0, b'\x03SELECT a')])
+        engine.receive_data(response(resultset([field(b'a')],
+                                               [[b'1'], [None]])))
+        events = list(engine.events())
+        self.assertEqual([event.__class__ for event in events],
+                         [ResultHeader, protocol.Field, protocol.EOF,
+                          Row, Row, protocol.EOF])
+        self.assertEqual([event.values for event in events[3:5]],
+                         [(b'1',), (None,)])
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_query_error(self):
+        engine = Engine()
+        engine.state = protocol.STATE_READY
+        engine.query('SELEC 1')
+        engine.receive_data(response([error()]))
+        self.assertTrue(isinstance(engine.next_event(),
+                                   errors.ProgrammingError))
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_command_while_busy(self):
+        engine = Engine()
+        engine.state = protocol.STATE_READY
+        engine.query('SELECT 1')
+        self.assertRaises(errors.InterfaceError, engine.ping)
+
+    def test_local_infile(self):
+        engine = Engine()
+        engine.state = protocol.STATE_READY
+        engine.query("LOAD DATA LOCAL INFILE 'f' INTO TABLE t")
+        engine.receive_data(response([b'\xfbf']))
+        request = engine.next_event()
+        self.assertTrue(isinstance(request, LocalInfileRequest))
+        self.assertEqual(request.filename, b'f')
+        self.assertEqual(engine.state, STATE_LOCAL_INFILE)
+        self.assertEqual(unframe(engine.local_infile_data([b'1\n', b''])),
+                         [(2, b'1\n'), (3, b'')])
+        engine.receive_data(pkt(ok(1), 4))
+        self.assertEqual(engine.next_event().affected_rows, 1)
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def request_file(self, engine, filename=b'f'):
+        engine.state = protocol.STATE_READY
+        engine.query("LOAD DATA LOCAL INFILE 'f' INTO TABLE t")
+        engine.receive_data(response([b'\xfb' + filename]))
+        return engine.next_event()
+
+    def test_local_infile_source(self):
+        engine = Engine()
+        engine.local_infile_sources[u'f'] = [b'1\n', b'', b'2\n']
+        data = engine.local_infile_reply(self.request_file(engine))
+        self.assertEqual(unframe(data), [(2, b'1\n'), (3, b'2\n'), (4, b'')])
+        self.assertEqual(engine.local_infile_sources, {})
+
+    def test_local_infile_refused(self):
+        engine = Engine()
+        engine.local_infile_paths = ['/etc/hostname']
+        data = engine.local_infile_reply(self.request_file(engine,
+                                                           b'/etc/passwd'))
+        self.assertEqual(unframe(data), [(2, b'')])
+        engine.receive_data(pkt(ok(), 3))
+        event = engine.next_event()
+        self.assertTrue(isinstance(event, errors.OperationalError))
+        self.assertEqual(event.args[0], 2068)
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_local_infile_read_error(self):
+        def chunks():
+            yield b'1\n'
+            raise IOError('disk error')
+        engine = Engine()
+        engine.local_infile_sources[u'f'] = chunks()
+        data = engine.local_infile_reply(self.request_file(engine))
+        # nothing is sent, so no rows are loaded
+        self.assertEqual(unframe(data), [(2, b'')])
+        engine.receive_data(pkt(error(1148), 3))
+        event = engine.next_event()
+        self.assertTrue(isinstance(event, IOError))
+        self.assertEqual(engine.state, protocol.STATE_READY)
+
+    def test_local_infile_packet_size(self):
+        engine = Engine()
+        self.request_file(engine)
+        chunk = b'x' * (protocol.LOCAL_INFILE_CHUNK_SIZE + 1)
+        self.assertEqual([(seqno, len(payload)) for seqno, payload in
+                          unframe(engine.local_infile_data([chunk]))],
+                         [(2, protocol.LOCAL_INFILE_CHUNK_SIZE), (3, 1),
+                          (4, 0)])
+
+if __name__ == '__main__':
+    unittest.main()
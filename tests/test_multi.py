@@ -0,0 +1,128 @@
+import socket
+import unittest
+
+from mysql4py import constants, errors, protocol
+from mysql4py.channel import BufferedChannel
+from mysql4py.multi import fan_out
+
+from support import response, unframe, ok, error, field, resultset
+
+class ConnectionStub(object):
+    """Connection whose server end is a socket of the test"""
+    def __init__(self):
+        self.socket, self.server = socket.socketpair()
+        self.server.settimeout(5)
+        self.protocol = protocol.Protocol(BufferedChannel(self.socket))
+        self.protocol.state = protocol.STATE_READY
+
+    def reply(self, data):
+        self.server.sendall(data)
+
+    def received(self):
+        """Payloads sent by the client up to the first query, or all of
+        them if the connection was closed"""
+        data = self.server.recv(65536)
+        return [payload for seqno, payload in unframe(data)]
+
+    def close(self):
+        self.socket.close()
+        self.server.close()
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+
+    def connect(self, n):
+        self.connections = [ConnectionStub() for i in range(n)]
+        return self.connections
+
+    def test_completion_order(self):
+        slow, fast = self.connect(2)
+        rows = response(resultset([field(b'a')], [[b'1']]))
+        # all but the final EOF packet
+        slow.reply(rows[:-9])
+        fast.reply(rows)
+        outcomes = fan_out([slow, fast], 'SELECT a')
+        index, outcome = next(outcomes)
+        self.assertEqual(index, 1)
+        self.assertEqual([result.rows for result in outcome], [[(b'1',)]])
+        self.assertEqual([column.column for column in outcome[0].fields],
+                         [b'a'])
+        slow.reply(rows[-9:])
+        index, outcome = next(outcomes)
+        self.assertEqual(index, 0)
+        self.assertEqual(outcome[0].rows, [(b'1',)])
+        self.assertRaises(StopIteration, next, outcomes)
+        for connection in (slow, fast):
+            self.assertEqual(connection.received(), [b'\x03SELECT a'])
+            # the connection can be used normally again
+            self.assertEqual(connection.protocol.state, protocol.STATE_READY)
+            self.assertEqual(connection.socket.gettimeout(), None)
+
+    def test_one_query_per_connection(self):
+        first, second = self.connect(2)
+        first.reply(response([ok(1)]))
+        second.reply(response([ok(2)]))
+        outcomes = dict(fan_out([first, second], ['UPDATE a', 'UPDATE b']))
+        self.assertEqual([outcomes[index][0].affected_rows
+                          for index in (0, 1)], [1, 2])
+        self.assertEqual(second.received(), [b'\x03UPDATE b'])
+        self.assertRaises(errors.ProgrammingError, list,
+                          fan_out([first, second], ['UPDATE a']))
+
+    def test_server_error_does_not_stop_others(self):
+        failing, working = self.connect(2)
+        failing.reply(response([error(1146)]))
+        working.reply(response([ok(3)]))
+        outcomes = dict(fan_out([failing, working], 'UPDATE t SET a = 1'))
+        self.assertTrue(isinstance(outcomes[0], errors.DatabaseError))
+        self.assertEqual(outcomes[0].args[0], 1146)
+        self.assertEqual(outcomes[1][0].affected_rows, 3)
+        # a server error leaves the connection usable
+        self.assertEqual(failing.protocol.state, protocol.STATE_READY)
+        failing.reply(response([ok(4)]))
+        failing.protocol.query('UPDATE t SET a = 2')
+        self.assertEqual(failing.protocol.nextset().affected_rows, 4)
+
+    def test_ssl_and_compression_are_rejected(self):
+        ssl, compressed, plain = self.connect(3)
+        ssl.protocol.flags |= constants.CLIENT_SSL
+        compressed.protocol.compress_algorithm = 'zlib'
+        plain.reply(response([ok()]))
+        outcomes = dict(fan_out([ssl, compressed, plain], 'DO 1'))
+        self.assertTrue(isinstance(outcomes[0], errors.NotSupportedError))
+        self.assertTrue(isinstance(outcomes[1], errors.NotSupportedError))
+        self.assertEqual(outcomes[2][0].affected_rows, 0)
+        # nothing was sent on the rejected connections
+        ssl.server.settimeout(0.05)
+        self.assertRaises(socket.timeout, ssl.server.recv, 1)
+
+    def test_local_infile_closes_connection(self):
+        loading, other = self.connect(2)
+        loading.reply(response([b'\xfb/etc/passwd']))
+        other.reply(response([ok()]))
+        outcomes = dict(fan_out([loading, other],
+                                "LOAD DATA LOCAL INFILE '/etc/passwd' "
+                                "INTO TABLE t"))
+        self.assertTrue(isinstance(outcomes[0], errors.NotSupportedError))
+        self.assertEqual(outcomes[1][0].affected_rows, 0)
+        # no file data was sent and the server sees the connection close
+        self.assertEqual(len(loading.received()), 1)
+        self.assertEqual(loading.server.recv(1), b'')
+
+    def test_timeout(self):
+        silent, = self.connect(1)
+        outcomes = list(fan_out([silent], 'SELECT SLEEP(10)', timeout=0.05))
+        self.assertEqual(len(outcomes), 1)
+        index, outcome = outcomes[0]
+        self.assertTrue(isinstance(outcome, errors.OperationalError))
+        self.assertEqual(outcome.args[0], 2013)
+        silent.received()
+        self.assertEqual(silent.server.recv(1), b'')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from mysql4py import columnar, constants, errors, numpy_support
+from mysql4py.dbapi import Cursor
+from mysql4py.protocol import Field
+
+numpy = numpy_support.numpy
+
+def make_column(type_code, values, name='c'):
+    column = columnar.make_column(Field(schema='db', table='t', column=name,
+                                        type_code=type_code, charset=33,
+                                        flags=0))
+    for value in values:
+        column.append(value)
+    return column
+
+class NumpyConversionTest(unittest.TestCase):
+    def setUp(self):
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+
+    def test_null_mask(self):
+        values = [b'1', None, b'3', b'4', b'5', b'6', b'7', b'8', None, b'10']
+        column = make_column(constants.FIELD_TYPE_LONG, values)
+        self.assertEqual(numpy_support.null_mask(column).tolist(),
+                         [value is None for value in values])
+
+    def test_numeric_column(self):
+        array = numpy_support.column_array(
+                    make_column(constants.FIELD_TYPE_LONG, [b'1', b'2']))
+        self.assertFalse(numpy.ma.isMaskedArray(array))
+        self.assertEqual(array.tolist(), [1, 2])
+
+    def test_masked_numeric_column(self):
+        array = numpy_support.column_array(
+                    make_column(constants.FIELD_TYPE_DOUBLE,
+                                [b'1.5', None, b'2.5']))
+        self.assertEqual(array.tolist(), [1.5, None, 2.5])
+
+    def test_datetime_column(self):
+        array = numpy_support.column_array(
+                    make_column(constants.FIELD_TYPE_DATETIME,
+                                [b'2020-01-02 03:04:05', None,
+                                 b'2021-02-03 04:05:06']))
+        self.assertEqual(array.dtype, numpy.dtype('datetime64[us]'))
+        self.assertEqual(numpy.ma.getmaskarray(array).tolist(),
+                         [False, True, False])
+        self.assertEqual(str(array[2]), '2021-02-03T04:05:06.000000')
+
+    def test_string_column(self):
+        array = numpy_support.column_array(
+                    make_column(constants.FIELD_TYPE_VAR_STRING,
+                                [b'a', None, u'\xe9'.encode('utf8')]))
+        self.assertEqual(array.tolist(), [u'a', None, u'\xe9'])
+
+    def test_records(self):
+        records = numpy_support.columns_to_records(
+                    [make_column(constants.FIELD_TYPE_LONG, [b'1', b'2'],
+                                 name=b'id'),
+                     make_column(constants.FIELD_TYPE_VAR_STRING,
+                                 [b'a', b'b'], name=b'name')])
+        self.assertEqual(records['id'].tolist(), [1, 2])
+        self.assertEqual(records['name'].tolist(), [u'a', u'b'])
+
+class ConnectionStub(object):
+    protocol = None
+
+class FetchNumpyTest(unittest.TestCase):
+    def test_no_resultset_fails_when_called(self):
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+        cursor = Cursor(ConnectionStub())
+        self.assertRaises(errors.ProgrammingError, cursor.fetch_numpy)
+
+    def test_numpy_missing_fails_when_called(self):
+        cursor = Cursor(ConnectionStub())
+        numpy_support.numpy = None
+        try:
+            self.assertRaises(errors.NotSupportedError, cursor.fetch_numpy)
+        finally:
+            numpy_support.numpy = numpy
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import struct
+import unittest
+import zlib
+
+from mysql4py import errors, packet
+from mysql4py.channel import BufferedChannel
+
+from support import FakeSocket, pkt
+
+def frame(payload, seqno=0, compress=True):
+    """Wrap ``payload`` in a compressed protocol frame"""
+    uzlen = 0
+    if compress:
+        uzlen = len(payload)
+        payload = zlib.compress(payload)
+    return struct.pack('<IHB', len(payload) | seqno << 24,
+                       uzlen & 0xffff, uzlen >> 16) + payload
+
+class SplitTest(unittest.TestCase):
+    def test_split_payload(self):
+        buffers, seqno = packet.split_payload(b'abc', 5)
+        self.assertEqual(seqno, 6)
+        self.assertEqual([memoryview(buf).tobytes() for buf in buffers],
+                         [b'\x03\x00\x00\x05', b'abc'])
+
+    def test_split_frames(self):
+        frames = packet.split_frames([b'abcd', b'efghij', b'k'], 4)
+        self.assertEqual([(b''.join([buf.tobytes() for buf in bufs]), size)
+                          for bufs, size in frames],
+                         [(b'abcd', 4), (b'efgh', 4), (b'ijk', 3)])
+
+class RoundtripTests(object):
+    """Packets written by a compressed stream read back by another"""
+    stream_class = None
+
+    def roundtrip(self, payload, seqno=0):
+        writer = FakeSocket()
+        self.stream_class(BufferedChannel(writer)).send_packet(payload,
+                                                               seqno)
+        reader = self.stream_class(BufferedChannel(FakeSocket(
+                                                    writer.output())))
+        pkt = reader.next_packet()
+        self.assertEqual(pkt.data.tobytes(), payload)
+        self.last_seqno = pkt.seqno
+        return writer.output()
+
+    def test_small_payload_is_not_compressed(self):
+        wire = self.roundtrip(b'\x03SELECT 1')
+        # uncompressed length 0 marks an uncompressed frame
+        self.assertEqual(wire[4:7], b'\x00\x00\x00')
+        self.assertEqual(wire[7:], pkt(b'\x03SELECT 1'))
+
+    def test_large_payload_is_compressed(self):
+        payload = b'\x03SELECT ' + b'1, ' * 1000 + b'1'
+        wire = self.roundtrip(payload, seqno=3)
+        self.assertEqual(self.last_seqno, 3)
+        self.assertTrue(len(wire) < len(payload))
+
+    def test_incompressible_payload_is_sent_as_is(self):
+        payload = b''.join([struct.pack('<I', (i * 2654435761) & 0xffffffff)
+                            for i in range(100)])
+        wire = self.roundtrip(payload)
+        self.assertEqual(wire[4:7], b'\x00\x00\x00')
+
+    def test_payload_over_max_size(self):
+        payload = b'x' * (packet.MAX_PAYLOAD_SIZE + 10)
+        self.roundtrip(payload)
+        # seqno of the terminating continuation packet
+        self.assertEqual(self.last_seqno, 1)
+
+class CompressedPacketStreamTest(RoundtripTests, unittest.TestCase):
+    stream_class = packet.CompressedPacketStream
+
+    def test_packets_sharing_a_frame(self):
+        wire = frame(pkt(b'first', 1) + pkt(b'second', 2))
+        stream = packet.CompressedPacketStream(BufferedChannel(
+                                                    FakeSocket(wire)))
+        self.assertEqual(stream.next_packet().data.tobytes(), b'first')
+        self.assertEqual(stream.next_packet().data.tobytes(), b'second')
+
+    def test_packet_spanning_frames(self):
+        data = pkt(b'spanning frames', 1) + pkt(b'next', 2)
+        wire = frame(data[:9]) + frame(data[9:], 1, compress=False)
+        stream = packet.CompressedPacketStream(BufferedChannel(
+                                                    FakeSocket(wire)))
+        self.assertEqual(stream.next_packet().data.tobytes(),
+                         b'spanning frames')
+        self.assertEqual(stream.next_packet().data.tobytes(), b'next')
+
+    def test_inflated_size_mismatch(self):
+        wire = frame(pkt(b'abc'))
+        wire = wire[:4] + b'\x09' + wire[5:]
+        stream = packet.CompressedPacketStream(BufferedChannel(
+                                                    FakeSocket(wire)))
+        self.assertRaises(errors.Error, stream.next_packet)
+
+    def test_error_packet(self):
+        wire = frame(pkt(b'\xff\x28\x04#42000You have an error', 1))
+        stream = packet.CompressedPacketStream(BufferedChannel(
+                                                    FakeSocket(wire)))
+        self.assertRaises(errors.ProgrammingError, stream.next_packet)
+
+class ZstdCompressedPacketStreamTest(RoundtripTests, unittest.TestCase):
+    stream_class = packet.ZstdCompressedPacketStream
+
+    def setUp(self):
+        if packet.zstandard is None:
+            self.skipTest('zstandard is not installed')
+
+    def test_zstd_frame(self):
+        data = pkt(b'zstd payload ' * 10, 1)
+        payload = packet.zstandard.ZstdCompressor().compress(data)
+        wire = struct.pack('<IHB', len(payload), len(data), 0) + payload
+        stream = packet.ZstdCompressedPacketStream(BufferedChannel(
+                                                    FakeSocket(wire)))
+        self.assertEqual(stream.next_packet().data.tobytes(),
+                         b'zstd payload ' * 10)
+
+if __name__ == '__main__':
+    unittest.main()
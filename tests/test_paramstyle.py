@@ -0,0 +1,106 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from mysql4py.paramstyle import ParamFormatError, QmarkParamStyle, \
+                               NamedParamStyle, NumericParamStyle, \
+                               split_query, format_to_qmark, encode_literal
+
+class Text(type(u'')):
+    pass
+
+class OldStyle:
+    pass
+
+class EncodeLiteralTest(unittest.TestCase):
+    def test_types(self):
+        self.assertEqual(encode_literal(None), 'NULL')
+        self.assertEqual(encode_literal(True), '1')
+        self.assertEqual(encode_literal(12), '12')
+        self.assertEqual(encode_literal(2 ** 70), str(2 ** 70))
+        self.assertEqual(encode_literal(0.1), repr(0.1))
+        self.assertEqual(encode_literal(Decimal('1.50')), '1.50')
+        self.assertEqual(encode_literal(bytearray(b'\x00\xff')), "X'00ff'")
+        self.assertEqual(encode_literal(datetime.date(2020, 1, 2)),
+                         "'2020-01-02'")
+        self.assertEqual(encode_literal(
+                            datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                         "'2020-01-02 03:04:05'")
+
+    def test_escaping(self):
+        self.assertEqual(encode_literal(u'a\'b\\c\n\x00\x1a"'),
+                         u"'a\\'b\\\\c\\n\\0\\Z\\\"'")
+
+    def test_timedelta(self):
+        self.assertEqual(encode_literal(datetime.timedelta(days=1,
+                                                           seconds=3661)),
+                         "'25:01:01'")
+        self.assertEqual(encode_literal(-datetime.timedelta(seconds=1,
+                                                            microseconds=5)),
+                         "'-0:00:01.000005'")
+
+    def test_subclass(self):
+        self.assertEqual(encode_literal(Text(u"it's")), u"'it\\'s'")
+
+    def test_unsupported(self):
+        self.assertRaises(ParamFormatError, encode_literal, object())
+        self.assertRaises(ParamFormatError, encode_literal, OldStyle())
+
+class SplitQueryTest(unittest.TestCase):
+    def split(self, query):
+        return split_query(
+                    query, QmarkParamStyle.tokenizer)
+
+    def test_placeholders(self):
+        self.assertEqual(self.split('SELECT ?, ? FROM t WHERE a = ?'),
+                         (['SELECT ', ', ', ' FROM t WHERE a = ', ''],
+                          ['?', '?', '?']))
+        self.assertEqual(self.split('SELECT 1'), (['SELECT 1'], []))
+
+    def test_quoted_placeholders(self):
+        query = ("SELECT '?', \"it''s ?\", 'a\\'?', `?``?`, ? "
+                 "FROM t")
+        fragments, params = self.split(query)
+        self.assertEqual(params, ['?'])
+        self.assertEqual(fragments[1], ' FROM t')
+
+    def test_unterminated_quote(self):
+        self.assertRaises(ParamFormatError, self.split, "SELECT '?")
+        self.assertRaises(ParamFormatError, self.split, 'SELECT `a, ?')
+
+    def test_named_and_numeric(self):
+        self.assertEqual(NamedParamStyle.template(
+                            'SELECT :a, :b_2, ":c"'),
+                         (['SELECT ', ', ', ', ":c"'], ['a', 'b_2']))
+        self.assertEqual(NumericParamStyle.template(
+                            'SELECT :2, :1'),
+                         (['SELECT ', ', ', ''], [2, 1]))
+
+class FormatTest(unittest.TestCase):
+    def test_qmark(self):
+        self.assertEqual(QmarkParamStyle.format(
+                            "SELECT ?, '?', ?", 1, "it's"),
+                         "SELECT 1, '?', 'it\\'s'")
+        self.assertRaises(ParamFormatError,
+                          QmarkParamStyle.format, 'SELECT ?')
+
+    def test_named(self):
+        self.assertEqual(NamedParamStyle.format(
+                            'SELECT :a, :b, :a', a=None, b=2.5),
+                         'SELECT NULL, 2.5, NULL')
+
+    def test_templates_are_cached(self):
+        query = 'SELECT ? -- cached'
+        QmarkParamStyle.format(query, 1)
+        template = QmarkParamStyle.templates.get(query)
+        self.assertTrue(template is not None)
+        self.assertTrue(QmarkParamStyle.template(query)
+                        is template)
+
+    def test_format_to_qmark(self):
+        self.assertEqual(format_to_qmark(
+                            "SELECT %s, '100%%', %s"),
+                         "SELECT ?, '100%', ?")
+
+if __name__ == '__main__':
+    unittest.main()
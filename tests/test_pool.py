@@ -0,0 +1,40 @@
+import unittest
+
+from mysql4py import errors
+from mysql4py.dbapi import Connection
+from mysql4py.pool import ConnectionPool
+
+from support import make_protocol, response, unframe, ok
+
+class ConnectionStub(Connection):
+    def __init__(self):
+        self.protocol, self.socket = make_protocol(response([ok()]) * 4)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class ReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(max_size=2,
+                                   connection_factory=ConnectionStub)
+
+    def test_session_is_reset(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.assertEqual(unframe(connection.socket.output()),
+                         [(0, b'\x1f'), (0, b'\x03SET autocommit=0')])
+        self.assertTrue(self.pool.acquire() is connection)
+
+    def test_double_release(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.assertRaises(errors.ProgrammingError, self.pool.release,
+                          connection)
+
+    def test_foreign_connection(self):
+        self.assertRaises(errors.ProgrammingError, self.pool.release,
+                          ConnectionStub())
+
+if __name__ == '__main__':
+    unittest.main()
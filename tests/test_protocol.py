@@ -0,0 +1,264 @@
+import io
+import struct
+import sys
+import unittest
+
+from mysql4py import constants, packet, protocol
+from mysql4py.channel import BufferedChannel
+
+from support import FakeSocket, packets, unframe, handshake, ok, eof, \
+                    error, field, make_protocol, response, stmt_prepared
+
+class CompressionNegotiationTest(unittest.TestCase):
+    def authenticate(self, capabilities, algorithms=None, zstd_level=None):
+        sock = FakeSocket(packets([handshake(capabilities)]) +
+                          packets([ok()], 2))
+        proto = protocol.Protocol(BufferedChannel(sock))
+        proto.enable_compression(algorithms=algorithms,
+                                 zstd_level=zstd_level)
+        proto.authenticate('user')
+        seqno, auth = unframe(sock.output())[0]
+        flags, = struct.unpack('<I', auth[:4])
+        return proto, flags, auth
+
+    def test_zstd_preferred(self):
+        if packet.zstandard is None:
+            self.skipTest('zstandard is not installed')
+        proto, flags, auth = self.authenticate(
+                    0xf7ff | constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM,
+                    zstd_level=7)
+        self.assertEqual(proto.compress_algorithm, 'zstd')
+        self.assertTrue(isinstance(proto.packet,
+                                   packet.ZstdCompressedPacketStream))
+        self.assertTrue(flags & constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM)
+        self.assertFalse(flags & constants.CLIENT_COMPRESS)
+        # the requested level ends the handshake response
+        self.assertEqual(auth[-1:], b'\x07')
+
+    def test_zlib_fallback(self):
+        proto, flags, auth = self.authenticate(0xf7ff)
+        self.assertEqual(proto.compress_algorithm, 'zlib')
+        self.assertEqual(type(proto.packet), packet.CompressedPacketStream)
+        self.assertTrue(flags & constants.CLIENT_COMPRESS)
+        self.assertFalse(flags & constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM)
+
+    def test_algorithm_order(self):
+        proto, flags, auth = self.authenticate(
+                    0xf7ff | constants.CLIENT_ZSTD_COMPRESSION_ALGORITHM,
+                    algorithms=['zlib', 'zstd'])
+        self.assertEqual(proto.compress_algorithm, 'zlib')
+
+    def test_unsupported(self):
+        self.assertRaises(protocol.OperationalError, self.authenticate,
+                          0xf7ff & ~constants.CLIENT_COMPRESS, ['zlib'])
+
+class StatementCacheTest(unittest.TestCase):
+    def test_lru_eviction_closes_statement(self):
+        proto, sock = make_protocol(response([stmt_prepared(1)]) +
+                                    response([stmt_prepared(2)]) +
+                                    response([stmt_prepared(3)]))
+        proto.statements.capacity = 2
+        first = proto.prepare('SELECT 1')
+        proto.prepare('SELECT 2')
+        # served from the cache, and now the most recently used
+        self.assertTrue(proto.prepare('SELECT 1') is first)
+        proto.prepare('SELECT 3')
+        commands = [payload for seqno, payload in unframe(sock.output())]
+        self.assertEqual(commands,
+                         [b'\x16SELECT 1', b'\x16SELECT 2', b'\x16SELECT 3',
+                          struct.pack('<BI', constants.COM_STMT_CLOSE, 2)])
+        self.assertEqual(sorted(statement.statement_id for statement
+                                in proto.statements.values()), [1, 3])
+
+    def test_uncached_statement(self):
+        proto, sock = make_protocol(response([stmt_prepared(1)]) +
+                                    response([stmt_prepared(2)]))
+        first = proto.prepare('SELECT 1', cache=False)
+        second = proto.prepare('SELECT 1', cache=False)
+        self.assertNotEqual(first.statement_id, second.statement_id)
+        self.assertEqual(len(proto.statements), 0)
+
+class LongDataTest(unittest.TestCase):
+    def execute(self, params):
+        proto, sock = make_protocol(
+                        response([stmt_prepared(9, 0, len(params))] +
+                                 [field(b'?')] * len(params) + [eof()]) +
+                        response([ok()]))
+        statement = proto.prepare('INSERT INTO t VALUES (?, ?)')
+        del sock.sent[:]
+        proto.execute(statement, params)
+        return unframe(sock.output())
+
+    def test_file_and_chunks(self):
+        sent = self.execute([io.BytesIO(b'file data'),
+                             protocol.LongData([b'ab', u'\xe9'])])
+        header = struct.pack('<BI', constants.COM_STMT_SEND_LONG_DATA, 9)
+        self.assertEqual([payload for seqno, payload in sent[:3]],
+                         [header + b'\x00\x00file data',
+                          header + b'\x01\x00ab',
+                          header + b'\x01\x00\xc3\xa9'])
+        self.assertEqual(sent[3][1][:1], b'\x17') # COM_STMT_EXECUTE
+
+    def test_empty_data_is_sent(self):
+        sent = self.execute([io.BytesIO(b''), protocol.LongData([])])
+        header = struct.pack('<BI', constants.COM_STMT_SEND_LONG_DATA, 9)
+        self.assertEqual([payload for seqno, payload in sent[:2]],
+                         [header + b'\x00\x00', header + b'\x01\x00'])
+        self.assertEqual(len(sent), 3)
+
+    def test_sequences_are_not_streamed(self):
+        self.assertFalse(protocol.is_long_data([b'a', b'b']))
+        self.assertFalse(protocol.is_long_data((b'a',)))
+        self.assertFalse(protocol.is_long_data(b'abc'))
+        self.assertRaises(protocol.ProgrammingError, self.execute,
+                          [[b'a', b'b'], 1])
+
+class ResetSessionTest(unittest.TestCase):
+    def test_reset_connection(self):
+        proto, sock = make_protocol(response([ok()]))
+        proto.statements.put('SELECT 1', object())
+        proto.reset_session()
+        self.assertEqual(unframe(sock.output()), [(0, b'\x1f')])
+        self.assertEqual(len(proto.statements), 0)
+
+    def test_change_user_fallback(self):
+        proto, sock = make_protocol(response([error(1047, b'Unknown command')])
+                                    + response([ok()]))
+        proto.info = protocol.Handshake.decode(
+                        packet.Packet(0, 0, memoryview(handshake())))
+        proto.credentials = ('user', None, 'db')
+        proto.statements.put('SELECT 1', object())
+        proto.reset_session()
+        self.assertEqual(unframe(sock.output()),
+                         [(0, b'\x1f'),
+                          (0, b'\x11user\x00\x00db\x00\x21\x00')])
+        self.assertEqual(len(proto.statements), 0)
+
+    def test_other_errors(self):
+        proto, sock = make_protocol(response([error(1045, b'Denied')]))
+        self.assertRaises(protocol.DatabaseError, proto.reset_session)
+
+class LocalInfileTest(unittest.TestCase):
+    def load(self, data, chunks):
+        proto, sock = make_protocol(response([b'\xfbdata.tsv']) + data)
+        if chunks is not None:
+            proto.local_infile_sources['data.tsv'] = chunks
+        proto.query("LOAD DATA LOCAL INFILE 'data.tsv' INTO TABLE t")
+        return proto, sock
+
+    def test_source(self):
+        proto, sock = self.load(packets([ok(2)], 4), [b'1\n', b'', b'2\n'])
+        self.assertEqual(proto.nextset().affected_rows, 2)
+        self.assertEqual(unframe(sock.output())[1:],
+                         [(2, b'1\n'), (3, b'2\n'), (4, b'')])
+        self.assertEqual(proto.state, protocol.STATE_READY)
+        self.assertFalse('data.tsv' in proto.local_infile_sources)
+
+    def test_unknown_file_is_refused(self):
+        proto, sock = self.load(packets([ok()], 3), None)
+        try:
+            proto.nextset()
+        except protocol.OperationalError:
+            self.assertEqual(sys.exc_info()[1].args[0], 2068)
+        else:
+            self.fail('OperationalError not raised')
+        self.assertEqual(unframe(sock.output())[1:], [(2, b'')])
+        self.assertEqual(proto.state, protocol.STATE_READY)
+
+    def test_failure_before_data_is_sent(self):
+        def chunks():
+            raise TypeError('bad row')
+            yield b''
+        proto, sock = self.load(packets([ok()], 3), chunks())
+        self.assertRaises(TypeError, proto.nextset)
+        # no rows were sent: the empty packet completes the command
+        self.assertEqual(unframe(sock.output())[1:], [(2, b'')])
+        self.assertFalse(sock.closed)
+
+    def test_failure_after_data_was_sent(self):
+        def chunks():
+            yield b'1\n'
+            raise TypeError('bad row')
+        proto, sock = self.load(b'', chunks())
+        self.assertRaises(TypeError, proto.nextset)
+        # ending the data would load the first row
+        self.assertEqual(unframe(sock.output())[1:], [(2, b'1\n')])
+        self.assertTrue(sock.closed)
+
+class RecordingSocket(FakeSocket):
+    """Records how many commands were sent whenever data is received"""
+    def __init__(self, data):
+        FakeSocket.__init__(self, data)
+        self.sent_at_recv = []
+        self.closed = False
+
+    def recv_into(self, view):
+        self.sent_at_recv.append(len(unframe(self.output())))
+        return FakeSocket.recv_into(self, view)
+
+    def close(self):
+        self.closed = True
+
+class PipelineTest(unittest.TestCase):
+    def pipeline(self, data, queries, window=protocol.PIPELINE_WINDOW):
+        sock = RecordingSocket(data)
+        proto = protocol.Protocol(BufferedChannel(sock))
+        proto.state = protocol.STATE_READY
+        return proto, sock, proto.pipeline(queries, window)
+
+    def test_window_counts_bytes(self):
+        # each COM_QUERY is 9 bytes; two fit in the window
+        proto, sock, results = self.pipeline(
+                                    response([ok(1)]) * 3,
+                                    ['SELECT 1', 'SELECT 2', 'SELECT 3'],
+                                    window=20)
+        self.assertEqual([result[0].affected_rows for result in results],
+                         [1, 1, 1])
+        self.assertEqual(sock.sent_at_recv[0], 2)
+        self.assertEqual(sock.sent_at_recv[-1], 3)
+
+    def test_large_query_sent_alone(self):
+        proto, sock, results = self.pipeline(response([ok()]) * 2,
+                                             ['SELECT 1' + ' ' * 50,
+                                              'SELECT 2'],
+                                             window=20)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sock.sent_at_recv[0], 1)
+
+    def test_errors_are_collected(self):
+        try:
+            self.pipeline(response([error()]) + response([ok()]),
+                          ['SELEC 1', 'SELECT 2'])
+        except protocol.PipelineError:
+            exc = sys.exc_info()[1]
+        else:
+            self.fail('PipelineError not raised')
+        self.assertEqual(exc.index, 0)
+        self.assertEqual(len(exc.results[1]), 1)
+
+    def test_local_infile_in_the_middle(self):
+        sock = RecordingSocket(response([b'\xfbdata.tsv']) + response([ok()]))
+        proto = protocol.Protocol(BufferedChannel(sock))
+        proto.state = protocol.STATE_READY
+        self.assertRaises(protocol.InterfaceError, proto.pipeline,
+                          ["LOAD DATA LOCAL INFILE 'data.tsv' INTO TABLE t",
+                           'SELECT 2'])
+        self.assertTrue(sock.closed)
+
+    def test_local_infile_last(self):
+        sock = RecordingSocket(response([ok()]) +
+                               response([b'\xfbdata.tsv']) +
+                               packets([ok(2)], 4))
+        proto = protocol.Protocol(BufferedChannel(sock))
+        proto.state = protocol.STATE_READY
+        proto.local_infile_sources['data.tsv'] = [b'1\n2\n']
+        results = proto.pipeline(
+                    ['SELECT 1',
+                     "LOAD DATA LOCAL INFILE 'data.tsv' INTO TABLE t"])
+        self.assertEqual(results[1][0].affected_rows, 2)
+        self.assertFalse(sock.closed)
+        self.assertEqual(unframe(sock.output())[-2:],
+                         [(2, b'1\n2\n'), (3, b'')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import struct
+import sys
+import unittest
+
+from mysql4py import constants, errors, protocol
+from mysql4py.channel import BufferedChannel
+from mysql4py.shard import ShardedExecutor
+
+from support import FakeSocket, response, unframe, eof, error, field, \
+                    stmt_prepared, cursor_opened, cursor_fetched
+
+ID = field(b'id', constants.FIELD_TYPE_LONGLONG)
+
+PREPARE = b'\x16'
+EXECUTE = b'\x17'
+CLOSE = b'\x19'
+FETCH = b'\x1c'
+
+class LoggingSocket(FakeSocket):
+    """Socket logging the commands sent and the first read after each
+
+    Data arrives one byte at a time, so nothing is read ahead.
+    """
+    def __init__(self, name, data, log):
+        FakeSocket.__init__(self, data, piece=1)
+        self.name = name
+        self.log = log
+        self.reading = False
+
+    def send(self, data):
+        self.log.append((self.name, memoryview(data).tobytes()[4:5]))
+        self.reading = False
+        return FakeSocket.send(self, data)
+
+    def recv_into(self, view):
+        if not self.reading:
+            self.log.append((self.name, 'read'))
+            self.reading = True
+        return FakeSocket.recv_into(self, view)
+
+class ShardStub(object):
+    def __init__(self, name, data, log):
+        self.socket = LoggingSocket(name, data, log)
+        self.protocol = protocol.Protocol(BufferedChannel(self.socket))
+        self.protocol.state = protocol.STATE_READY
+
+    def commands(self):
+        return [payload[:1] for seqno, payload in unframe(self.socket.output())]
+
+def prepared():
+    return response([stmt_prepared(1, 1), ID, eof()])
+
+def cursor(*chunks):
+    """Responses of a shard: prepare, execute and one fetch per chunk of
+    rows; the last chunk ends the cursor"""
+    data = prepared() + response(cursor_opened([ID]))
+    for n, chunk in enumerate(chunks):
+        data += response(cursor_fetched([[value] for value in chunk],
+                                        last=n == len(chunks) - 1))
+    return data
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+
+    def executor(self, *responses, **kwargs):
+        self.shards = [ShardStub(n, data, self.log)
+                       for n, data in enumerate(responses)]
+        return ShardedExecutor(self.shards, **kwargs)
+
+    def test_merge_order(self):
+        executor = self.executor(cursor([1, 4], [6]), cursor([2, 3], [5]),
+                                 fetch_size=2)
+        rows = list(executor.merge('SELECT id FROM t ORDER BY id', key=0))
+        self.assertEqual(rows, [(1,), (2,), (3,), (4,), (5,), (6,)])
+        for shard in self.shards:
+            self.assertEqual(shard.commands(),
+                             [PREPARE, EXECUTE, FETCH, FETCH, CLOSE])
+
+    def test_requests_are_sent_before_replies_are_read(self):
+        executor = self.executor(cursor([1]), cursor([2]))
+        list(executor.merge('SELECT id FROM t ORDER BY id', key=0))
+        self.assertEqual(self.log[:12],
+                         [(0, PREPARE), (1, PREPARE), (0, 'read'), (1, 'read'),
+                          (0, EXECUTE), (1, EXECUTE), (0, 'read'), (1, 'read'),
+                          (0, FETCH), (1, FETCH), (0, 'read'), (1, 'read')])
+
+    def test_reverse(self):
+        executor = self.executor(cursor([6, 4], [1]), cursor([5, 3], [2]),
+                                 fetch_size=2)
+        rows = list(executor.merge('SELECT id FROM t ORDER BY id DESC',
+                                   key=lambda row: row[0], reverse=True))
+        self.assertEqual(rows, [(6,), (5,), (4,), (3,), (2,), (1,)])
+
+    def test_limit_stops_early(self):
+        executor = self.executor(cursor([1, 3, 5], [7]), cursor([2, 4, 6]))
+        rows = list(executor.merge('SELECT id FROM t ORDER BY id', key=0,
+                                   offset=1, limit=2))
+        self.assertEqual(rows, [(2,), (3,)])
+        for shard in self.shards:
+            sent = unframe(shard.socket.output())
+            # only offset + limit rows are requested, and only once
+            self.assertEqual([payload[:1] for seqno, payload in sent],
+                             [PREPARE, EXECUTE, FETCH, CLOSE])
+            self.assertEqual(sent[2][1],
+                             struct.pack('<BII', constants.COM_STMT_FETCH,
+                                         1, 3))
+
+    def test_statements_closed_when_abandoned(self):
+        executor = self.executor(cursor([1, 3]), cursor([2, 4]))
+        rows = executor.merge('SELECT id FROM t ORDER BY id', key=0)
+        self.assertEqual(next(rows), (1,))
+        rows.close()
+        for shard in self.shards:
+            self.assertEqual(shard.commands()[-1], CLOSE)
+            self.assertEqual(shard.protocol.state, protocol.STATE_READY)
+
+    def test_execute_error_on_one_shard(self):
+        executor = self.executor(cursor([1]),
+                                 prepared() + response([error(1146)]))
+        try:
+            list(executor.merge('SELECT id FROM missing', key=0))
+        except errors.Error:
+            self.assertEqual(sys.exc_info()[1].args[0], 1146)
+        else:
+            self.fail('error not raised')
+        for shard in self.shards:
+            self.assertEqual(shard.commands(), [PREPARE, EXECUTE, CLOSE])
+
+    def test_prepare_error_on_one_shard(self):
+        executor = self.executor(response([error(1064)]), cursor([1]))
+        try:
+            list(executor.merge('SELEC id FROM t', key=0))
+        except errors.Error:
+            self.assertEqual(sys.exc_info()[1].args[0], 1064)
+        else:
+            self.fail('error not raised')
+        self.assertEqual(self.shards[0].commands(), [PREPARE])
+        self.assertEqual(self.shards[1].commands(), [PREPARE, CLOSE])
+
+if __name__ == '__main__':
+    unittest.main()
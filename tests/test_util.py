@@ -0,0 +1,93 @@
+import threading
+import unittest
+
+from mysql4py import util
+
+class LengthCodedTest(unittest.TestCase):
+    def test_lcb_roundtrip(self):
+        for value in (0, 250, 251, 0xffff, 0x10000, 0xffffff, 0x1000000,
+                      1 << 40):
+            encoded = util.encode_lcb(value)
+            self.assertEqual(util.decode_lcb(memoryview(encoded), 0),
+                             (value, len(encoded)))
+
+    def test_null(self):
+        self.assertEqual(util.decode_lcb(b'\xfb', 0), (None, 1))
+
+    def test_decode_lcs_list(self):
+        long_value = b'x' * 300
+        data = (b'\x00\x03abc\xfb' + util.encode_lcb(len(long_value)) +
+                long_value + b'tail')
+        values, index = util.decode_lcs_list(memoryview(data), 1, 3)
+        self.assertEqual(values, [b'abc', None, long_value])
+        self.assertEqual(data[index:], b'tail')
+        self.assertEqual(type(values[0]), bytes)
+
+    def test_decode_lcs_list_truncated(self):
+        self.assertRaises(IndexError, util.decode_lcs_list,
+                          memoryview(b'\x05abc'), 0, 1)
+
+class ByteStreamTest(unittest.TestCase):
+    def test_read_n_lcs(self):
+        stream = util.ByteStream(memoryview(b'\x01\x02ab\x01c\xfbrest'))
+        stream.skip(1)
+        self.assertEqual(stream.read_n_lcs(3), [b'ab', b'c', None])
+        self.assertEqual(stream.read(), b'rest')
+
+    def test_integers(self):
+        stream = util.ByteStream(memoryview(
+                        b'\x01\x02\x01\x03\x02\x01\x04\x03\x02\x01abc\x00'))
+        self.assertEqual(stream.read_int8(), 1)
+        self.assertEqual(stream.read_int16(), 0x0102)
+        self.assertEqual(stream.read_int24(), 0x010203)
+        self.assertEqual(stream.read_int32(), 0x01020304)
+        self.assertEqual(stream.read_nullstr(), b'abc')
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction_order(self):
+        evicted = []
+        cache = util.LRUCache(2, lambda key, value: evicted.append(key))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(sorted(cache.values()), [1, 3])
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+
+    def test_pop_and_clear_do_not_evict(self):
+        evicted = []
+        cache = util.LRUCache(2, lambda key, value: evicted.append(key))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(evicted, [])
+
+    def test_evict_callback_may_use_cache(self):
+        seen = []
+        cache = util.LRUCache(1)
+        cache.on_evict = lambda key, value: seen.append(cache.get(key))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(seen, [None])
+        self.assertEqual(cache.values(), [2])
+
+    def test_threads(self):
+        cache = util.LRUCache(8)
+        def worker(n):
+            for i in range(2000):
+                cache.put((n, i % 16), i)
+                cache.get((n, (i + 1) % 16))
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache), 8)
+
+if __name__ == '__main__':
+    unittest.main()